@@ -1,7 +1,12 @@
+import os.path
 from collections import OrderedDict
 
+import transaction
+
 from ..lib.config import Option
 from ..component import Component, require
+from ..models import DBSession
+from ..resource import Resource
 
 from .feature import Feature, FeatureSet
 from .model import Base, LayerField, LayerFieldsMixin
@@ -21,9 +26,14 @@ from .interface import (
     IFeatureQueryIntersects,
     IFeatureQueryClipByBox,
     IFeatureQuerySimplify,
+    IFeatureQueryMVT,
+    IFeatureQueryKeyset,
+    IFeatureQueryStream,
 )
 from .event import on_data_change
 from .extension import FeatureExtension
+from .mvt_cache import MVTCache
+from . import command  # NOQA
 from .api import query_feature_or_not_found
 from .ogrdriver import OGR_DRIVER_NAME_2_EXPORT_FORMATS
 
@@ -47,6 +57,9 @@ __all__ = [
     'IFeatureQueryIntersects',
     'IFeatureQueryClipByBox',
     'IFeatureQuerySimplify',
+    'IFeatureQueryMVT',
+    'IFeatureQueryKeyset',
+    'IFeatureQueryStream',
     'on_data_change',
     'query_feature_or_not_found',
 ]
@@ -59,6 +72,15 @@ class FeatureLayerComponent(Component):
     def initialize(self):
         self.FeatureExtension = FeatureExtension
 
+        opt_mvt = self.options.with_prefix('mvt_cache')
+        if opt_mvt['enabled']:
+            ttl = opt_mvt['ttl']
+            self.mvt_cache = MVTCache(
+                os.path.join(self.env.core.gtsdir(self), 'mvt_cache'),
+                ttl=ttl if ttl > 0 else None)
+        else:
+            self.mvt_cache = None
+
     @require('resource')
     def setup_pyramid(self, config):
         from . import view, api
@@ -80,3 +102,24 @@ class FeatureLayerComponent(Component):
             export_formats=OGR_DRIVER_NAME_2_EXPORT_FORMATS,
             datatypes=FIELD_TYPE.enum,
         )
+
+    def maintenance(self):
+        super().maintenance()
+        self.cleanup()
+
+    def cleanup(self):
+        if self.mvt_cache is None:
+            return
+
+        with transaction.manager:
+            resource_ids = set(r.id for r in DBSession.query(Resource.id))
+
+        deleted = self.mvt_cache.cleanup(resource_ids)
+        self.logger.info("%d vector tile cache databases deleted", deleted)
+
+    option_annotations = (
+        Option('mvt_cache.enabled', bool, default=False,
+               doc="Cache vector tiles returned by MVT API."),
+        Option('mvt_cache.ttl', int, default=0,
+               doc="Vector tile cache TTL in seconds (0 for no expiration)."),
+    )
@@ -1,23 +1,30 @@
 import json
+import logging
 import os
 import re
+import shutil
 import uuid
 import zipfile
-import itertools
 from urllib.parse import unquote
 
 import tempfile
 from collections import OrderedDict
 from datetime import datetime, date, time
 
-from osgeo import ogr, gdal
+import transaction
+import zipstream
+from osgeo import ogr, osr, gdal
 from pyramid.response import Response, FileResponse
 from pyramid.httpexceptions import HTTPNoContent, HTTPNotFound
 from shapely.geometry import box
+from sqlalchemy.orm import object_session
 from sqlalchemy.orm.exc import NoResultFound
 
+from ..models import DBSession
 from ..lib.geometry import Geometry, GeometryNotValid, Transformer
-from ..resource import DataScope, ValidationError, Resource, resource_factory
+from ..resource import (
+    DataScope, ValidationError, Resource, ResourceExportJob, resource_factory,
+    export_job_handler)
 from ..resource.exception import ResourceNotFound
 from ..spatial_ref_sys import SRS
 from .. import geojson
@@ -28,7 +35,14 @@ from .interface import (
     IWritableFeatureLayer,
     IFeatureQueryClipByBox,
     IFeatureQuerySimplify,
-    FIELD_TYPE)
+    IFeatureQueryMVT,
+    IFeatureQueryKeyset,
+    IFeatureQueryStream,
+    GEOM_TYPE,
+    GEOM_TYPE_OGR,
+    FIELD_TYPE,
+    FIELD_TYPE_OGR)
+from .event import on_data_change
 from .feature import Feature
 from .extension import FeatureExtension
 from .ogrdriver import EXPORT_FORMAT_OGR, MVT_DRIVER_EXIST
@@ -39,10 +53,13 @@ from .util import _
 PERM_READ = DataScope.read
 PERM_WRITE = DataScope.write
 
+_logger = logging.getLogger(__name__)
 
-def _ogr_memory_ds():
-    return gdal.GetDriverByName('Memory').Create(
-        '', 0, 0, 0, gdal.GDT_Unknown)
+# Number of features serialized into a single chunk of streamed response
+STREAM_CHUNK_SIZE = 1000
+
+# Number of features written to an exported dataset in a single transaction
+EXPORT_BATCH_SIZE = 10000
 
 
 def _ogr_ds(driver, options):
@@ -62,6 +79,75 @@ def _ogr_layer_from_features(layer, features, name='', ds=None, fid=None):
     return ogr_layer
 
 
+def _ogr_write_features(layer, features, ds, srs, lco=(), fid=None, preserve_fid=False,
+                        batch_size=EXPORT_BATCH_SIZE, progress=None):
+    """ Write features into a layer of an OGR dataset in batches without
+    keeping them in memory, progress is called with a number of written
+    features after each batch """
+
+    ogr_srs = osr.SpatialReference()
+    ogr_srs.ImportFromWkt(srs.wkt)
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        ogr_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+    ogr_layer = ds.CreateLayer(
+        '', srs=ogr_srs,
+        geom_type=GEOM_TYPE_OGR[GEOM_TYPE.enum.index(layer.geometry_type)],
+        options=list(lco))
+
+    # Some drivers don't support all field types or launder field names,
+    # so field indexes are tracked instead of names.
+    fields = list()
+    for field in layer.fields:
+        count = ogr_layer.GetLayerDefn().GetFieldCount()
+        ogr_layer.CreateField(ogr.FieldDefn(
+            field.keyname, FIELD_TYPE_OGR[FIELD_TYPE.enum.index(field.datatype)]))
+        if ogr_layer.GetLayerDefn().GetFieldCount() > count:
+            fields.append((field.keyname, count))
+
+    fid_idx = None
+    if fid is not None:
+        fid_idx = ogr_layer.GetLayerDefn().GetFieldCount()
+        ogr_layer.CreateField(ogr.FieldDefn(fid, ogr.OFTInteger))
+
+    layer_defn = ogr_layer.GetLayerDefn()
+
+    ogr_layer.StartTransaction()
+    for idx, feature in enumerate(features, start=1):
+        ogr_feature = ogr.Feature(layer_defn)
+        if preserve_fid:
+            ogr_feature.SetFID(feature.id)
+        if feature.geom is not None:
+            ogr_feature.SetGeometry(ogr.CreateGeometryFromWkb(feature.geom.wkb))
+
+        for keyname, field_idx in fields:
+            value = feature.fields.get(keyname)
+            if value is not None:
+                ogr_feature[field_idx] = value
+
+        if fid_idx is not None:
+            ogr_feature[fid_idx] = feature.id
+
+        ogr_layer.CreateFeature(ogr_feature)
+
+        if idx % batch_size == 0:
+            ogr_layer.CommitTransaction()
+            ogr_layer.StartTransaction()
+            if progress is not None:
+                progress(idx)
+
+    ogr_layer.CommitTransaction()
+
+
+def _cleanup_after(app_iter, path):
+    """ Remove temporary directory when response is sent """
+    try:
+        for chunk in app_iter:
+            yield chunk
+    finally:
+        shutil.rmtree(path)
+
+
 def _extensions(extensions, layer):
     result = []
 
@@ -81,18 +167,18 @@ def view_geojson(request):
     return export(request)
 
 
-def export(request):
-    request.resource_permission(PERM_READ)
+def export_dataset(resource, params, path, progress=None):
+    """ Export features of a resource into a dataset in given directory
 
-    srs = int(
-        request.GET.get("srs", request.context.srs.id)
-    )
+    Returns dataset file name, flag of archive requirement and content type.
+    Parameters are the same as of export API request. """
+
+    srs = int(params.get("srs", resource.srs.id))
     srs = SRS.filter_by(id=srs).one()
-    fid = request.GET.get("fid")
-    format = request.GET.get("format")
-    encoding = request.GET.get("encoding")
-    zipped = request.GET.get("zipped", "true")
-    zipped = zipped.lower() == "true"
+    fid = params.get("fid")
+    format = params.get("format")
+    encoding = params.get("encoding")
+    zipped = str(params.get("zipped", "true")).lower() == "true"
 
     if format is None:
         raise ValidationError(
@@ -111,8 +197,8 @@ def export(request):
     if driver.dsco_configurable is not None:
         for option in driver.dsco_configurable:
             option = option.split(":")[0]
-            if option in request.GET:
-                dsco.append("%s=%s" % (option, request.GET.get(option)))
+            if option in params:
+                dsco.append("%s=%s" % (option, params.get(option)))
 
     # layer creation options
     lco = list(driver.options or [])
@@ -120,80 +206,125 @@ def export(request):
     if encoding is not None:
         lco.append("ENCODING=%s" % encoding)
 
-    query = request.context.feature_query()
+    query = resource.feature_query()
+    query.srs(srs)
     query.geom()
+    if IFeatureQueryStream.providedBy(query):
+        query.stream()
 
-    ogr_ds = _ogr_memory_ds()
-    ogr_layer = _ogr_layer_from_features(  # NOQA: 841
-        request.context, query(), ds=ogr_ds, fid=fid)
+    filename = "%d.%s" % (
+        resource.id,
+        driver.extension,
+    )
 
-    with tempfile.TemporaryDirectory() as tmp_dir:
-        filename = "%d.%s" % (
-            request.context.id,
-            driver.extension,
-        )
+    ogr_ds = ogr.GetDriverByName(driver.name).CreateDataSource(
+        os.path.join(path, filename), options=dsco)
+    if ogr_ds is None:
+        raise ValidationError(_("Failed to create '%s' dataset.") % (format, ))
 
-        vtopts = (
-            [
-                "-f", driver.name,
-                "-t_srs", srs.wkt,
-            ]
-            + list(itertools.chain(*[("-lco", o) for o in lco]))
-            + list(itertools.chain(*[("-dsco", o) for o in dsco]))
-        )
+    features = query()
 
-        if driver.fid_support and fid is None:
-            vtopts.append('-preserve_fid')
+    written = None
+    if progress is not None:
+        total = features.total_count
+        written = lambda count: progress(count / total)  # NOQA: E731
 
-        gdal.VectorTranslate(
-            os.path.join(tmp_dir, filename), ogr_ds,
-            options=gdal.VectorTranslateOptions(options=vtopts)
-        )
+    _ogr_write_features(
+        resource, features, ogr_ds, srs, lco=lco, fid=fid,
+        preserve_fid=driver.fid_support and fid is None, progress=written)
 
-        if zipped or not driver.single_file:
-            content_type = "application/zip"
-            content_disposition = "attachment; filename=%s" % ("%s.zip" % (filename,))
-            with tempfile.NamedTemporaryFile(suffix=".zip") as tmp_file:
-                with zipfile.ZipFile(tmp_file, "w", zipfile.ZIP_DEFLATED) as zipf:
-                    for root, dirs, files in os.walk(tmp_dir):
-                        for file in files:
-                            path = os.path.join(root, file)
-                            zipf.write(path, os.path.basename(path))
-                response = FileResponse(tmp_file.name, content_type=content_type)
-                response.content_disposition = content_disposition
-                return response
+    # flush changes
+    ogr_ds = None
+
+    return (
+        filename, zipped or not driver.single_file,
+        driver.mime or "application/octet-stream")
+
+
+def export(request):
+    request.resource_permission(PERM_READ)
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        filename, zipped, content_type = export_dataset(
+            request.context, request.GET, tmp_dir)
+
+        if zipped:
+            zip_stream = zipstream.ZipFile(
+                mode='w', compression=zipstream.ZIP_DEFLATED, allowZip64=True)
+            for root, dirs, files in os.walk(tmp_dir):
+                for file in files:
+                    zip_stream.write(os.path.join(root, file), arcname=file)
+
+            response = Response(
+                app_iter=_cleanup_after(zip_stream, tmp_dir),
+                content_type="application/zip")
+            response.content_disposition = "attachment; filename=%s" % (
+                "%s.zip" % (filename,))
+            tmp_dir = None
+            return response
         else:
-            content_type = driver.mime or "application/octet-stream"
-            content_disposition = "attachment; filename=%s" % filename
             response = FileResponse(
-                os.path.join(tmp_dir, filename), content_type=content_type
-            )
-            response.content_disposition = content_disposition
+                os.path.join(tmp_dir, filename),
+                content_type=content_type)
+            response.content_disposition = "attachment; filename=%s" % filename
             return response
 
+    finally:
+        # The file of FileResponse is already open, so it can be removed
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
 
-def mvt(request):
-    if not MVT_DRIVER_EXIST:
-        return HTTPNotFound(explanation='MVT GDAL driver not found')
 
-    z = int(request.GET["z"])
-    x = int(request.GET["x"])
-    y = int(request.GET["y"])
+def _export_job_validate(resource, params):
+    format = params.get("format")
+    if format is None:
+        raise ValidationError(_("Output format is not provided."))
+    if format not in EXPORT_FORMAT_OGR:
+        raise ValidationError(_("Format '%s' is not supported.") % (format,))
+    if "srs" in params and SRS.filter_by(id=int(params["srs"])).first() is None:
+        raise ValidationError(_("Spatial reference system (ID=%s) not found.") % (params["srs"], ))
 
-    extent = int(request.GET.get('extent', 4096))
-    simplification = float(request.GET.get("simplification", extent / 512))
 
-    resids = map(
-        int,
-        filter(None, request.GET["resource"].split(",")),
-    )
+@export_job_handler(IFeatureLayer, validate=_export_job_validate)
+def export_job(resource, params, path, progress):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        filename, zipped, content_type = export_dataset(
+            resource, params, tmp_dir, progress=progress)
+
+        if zipped:
+            with zipfile.ZipFile(
+                path, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True
+            ) as zf:
+                for root, dirs, files in os.walk(tmp_dir):
+                    for file in files:
+                        zf.write(os.path.join(root, file), arcname=file)
+            return "%s.zip" % filename, "application/zip"
+        else:
+            shutil.move(os.path.join(tmp_dir, filename), path)
+            return filename, content_type
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+@on_data_change.connect
+def _outdate_export_jobs(resource, geom):
+    ResourceExportJob.outdate(resource.id)
+
+
+def mvt_layer(obj, tile, extent, simplification, padding):
+    """ Encode features of a resource as MVT tile layer
+
+    Returns layer bytes, which is empty if there are no features in the tile,
+    or None if MVT GDAL driver is required but doesn't exist. """
+
+    z, x, y = tile
 
     # web mercator
     merc = SRS.filter_by(id=3857).one()
-    minx, miny, maxx, maxy = merc.tile_extent((z, x, y))
-
-    # 5% padding by default
-    padding = float(request.GET.get("padding", 0.05))
+    tile_extent = merc.tile_extent(tile)
+    minx, miny, maxx, maxy = tile_extent
 
     bbox = (
         minx - (maxx - minx) * padding,
@@ -203,6 +334,29 @@ def mvt(request):
     )
     bbox = Geometry.from_shape(box(*bbox), srid=merc.id)
 
+    name = "ngw:%d" % obj.id
+
+    query = obj.feature_query()
+    query.intersects(bbox)
+
+    if IFeatureQuerySimplify.providedBy(query):
+        tolerance = ((obj.srs.maxx - obj.srs.minx) / (1 << z)) / extent
+        query.simplify(tolerance * simplification)
+
+    if IFeatureQueryMVT.providedBy(query):
+        query.srs(merc)
+        data = query.mvt(name, tile_extent, extent, int(round(extent * padding)))
+        if data is not None:
+            return data
+
+    if not MVT_DRIVER_EXIST:
+        return None
+
+    query.geom()
+
+    if IFeatureQueryClipByBox.providedBy(query):
+        query.clip_by_box(bbox)
+
     options = [
         "FORMAT=DIRECTORY",
         "TILE_EXTENSION=pbf",
@@ -216,27 +370,7 @@ def mvt(request):
 
     vsibuf = ds.GetName()
 
-    for resid in resids:
-        try:
-            obj = Resource.filter_by(id=resid).one()
-        except NoResultFound:
-            raise ResourceNotFound(resid)
-
-        request.resource_permission(PERM_READ, obj)
-
-        query = obj.feature_query()
-        query.intersects(bbox)
-        query.geom()
-
-        if IFeatureQueryClipByBox.providedBy(query):
-            query.clip_by_box(bbox)
-
-        if IFeatureQuerySimplify.providedBy(query):
-            tolerance = ((obj.srs.maxx - obj.srs.minx) / (1 << z)) / extent
-            query.simplify(tolerance * simplification)
-
-        _ogr_layer_from_features(
-            obj, query(), name="ngw:%d" % obj.id, ds=ds)
+    _ogr_layer_from_features(obj, query(), name=name, ds=ds)
 
     # flush changes
     ds = None
@@ -258,17 +392,68 @@ def mvt(request):
             content = gdal.VSIFReadL(1, size, f)
             gdal.VSIFCloseL(f)
 
-            return Response(
-                content,
-                content_type="application/vnd.mapbox-vector-tile",
-            )
+            return content
         else:
-            return HTTPNoContent()
+            return b''
 
     finally:
         gdal.Unlink(vsibuf)
 
 
+def mvt(request):
+    z = int(request.GET["z"])
+    x = int(request.GET["x"])
+    y = int(request.GET["y"])
+    tile = (z, x, y)
+
+    extent = int(request.GET.get('extent', 4096))
+    simplification = float(request.GET.get("simplification", extent / 512))
+
+    # 5% padding by default
+    padding = float(request.GET.get("padding", 0.05))
+
+    resids = map(
+        int,
+        filter(None, request.GET["resource"].split(",")),
+    )
+
+    mvt_cache = request.env.feature_layer.mvt_cache
+    params = (extent, simplification, padding)
+
+    # MVT tile is a sequence of layers, so it's assembled from layers
+    # encoded and cached for each resource separately.
+    content = b''
+
+    for resid in resids:
+        try:
+            obj = Resource.filter_by(id=resid).one()
+        except NoResultFound:
+            raise ResourceNotFound(resid)
+
+        request.resource_permission(PERM_READ, obj)
+
+        cacheable = mvt_cache is not None and mvt_cache.cacheable(obj)
+        data = mvt_cache.get(obj.id, tile, params) if cacheable else None
+
+        if data is None:
+            data = mvt_layer(obj, tile, extent, simplification, padding)
+            if data is None:
+                return HTTPNotFound(explanation='MVT GDAL driver not found')
+
+            if cacheable:
+                mvt_cache.put(obj.id, tile, params, data)
+
+        content += data
+
+    if len(content) == 0:
+        return HTTPNoContent()
+
+    return Response(
+        content,
+        content_type="application/vnd.mapbox-vector-tile",
+    )
+
+
 def deserialize(feat, data, geom_format='wkt', dt_format='obj', transformer=None):
     if 'geom' in data:
         try:
@@ -406,6 +591,46 @@ def serialize(feat, keys=None, geom_format='wkt', dt_format='obj', label=False,
     return result
 
 
+def json_stream(resource, features, serializer, chunk_size=STREAM_CHUNK_SIZE):
+    """ Generate JSON array of serialized features by chunks, the output is
+    the same as json.dumps of the whole list gives
+
+    The response body is consumed after the request transaction is finished,
+    so features are fetched in a separate transaction with the resource
+    attached to its session. Response status is already sent when an error
+    occurs, so the error is logged and raised again to make the server
+    abort the response instead of finishing it truncated. """
+
+    resource_id = resource.id
+    count = 0
+
+    try:
+        with transaction.manager:
+            if object_session(resource) is None:
+                DBSession.add(resource)
+
+            chunk = [b'[']
+            for feature in features:
+                if count > 0:
+                    chunk.append(b', ')
+                chunk.append(json.dumps(
+                    serializer(feature), cls=geojson.Encoder
+                ).encode('utf-8'))
+
+                count += 1
+                if count % chunk_size == 0:
+                    yield b''.join(chunk)
+                    chunk = []
+
+            chunk.append(b']')
+            yield b''.join(chunk)
+    except Exception:
+        _logger.exception(
+            "Feature stream of resource %d aborted after %d features",
+            resource_id, count)
+        raise
+
+
 def query_feature_or_not_found(query, resource_id, feature_id):
     """ Query one feature by id or return FeatureNotFound exception. """
 
@@ -521,7 +746,19 @@ def cget(resource, request):
     # Paging
     limit = request.GET.get('limit')
     offset = request.GET.get('offset', 0)
-    if limit is not None:
+    cursor = request.GET.get('cursor')
+
+    if cursor is not None:
+        # Keyset paging: features following the last feature of the previous
+        # page, the next page cursor is returned in X-Feature-Cursor header.
+        if limit is None:
+            raise ValidationError(_("Parameter 'limit' is required for cursor paging."))
+        if not IFeatureQueryKeyset.providedBy(query):
+            raise ValidationError(_("Cursor paging is not supported by the layer."))
+        if cursor != '':
+            query.after(cursor)
+        query.limit(int(limit))
+    elif limit is not None:
         query.limit(int(limit), int(offset))
 
     # Filtering by attributes
@@ -597,13 +834,34 @@ def cget(resource, request):
             query.srs(SRS.filter_by(id=int(srs)).one())
         query.geom()
 
-    result = [
-        serialize(feature, **srlz_params)
-        for feature in query()
-    ]
+    # Check serialization parameters before streaming begins
+    if srlz_params['geom_format'] not in ('wkt', 'geojson'):
+        raise ValidationError(_("Geometry format '%s' is not supported.")
+                              % srlz_params['geom_format'])
+    if srlz_params['dt_format'] not in ('obj', 'iso'):
+        raise ValidationError(_("Date format '%s' is not supported.")
+                              % srlz_params['dt_format'])
+
+    if cursor is not None:
+        # Page size is bounded by the limit, so it's serialized at once to
+        # get the continuation token before the response is started.
+        features = query()
+        result = [serialize(feature, **srlz_params) for feature in features]
+
+        response = Response(
+            json.dumps(result, cls=geojson.Encoder),
+            content_type='application/json', charset='utf-8')
+        if features.next_token is not None:
+            response.headers['X-Feature-Cursor'] = features.next_token
+        return response
+
+    if limit is None and IFeatureQueryStream.providedBy(query):
+        query.stream()
 
     return Response(
-        json.dumps(result, cls=geojson.Encoder),
+        app_iter=json_stream(
+            resource, query(),
+            lambda feature: serialize(feature, **srlz_params)),
         content_type='application/json', charset='utf-8')
 
 
@@ -632,7 +890,6 @@ def cpost(resource, request):
 
 def cpatch(resource, request):
     request.resource_permission(PERM_WRITE)
-    result = list()
 
     dsrlz_params = dict(
         geom_format=request.GET.get('geom_format', 'wkt').lower(),
@@ -645,28 +902,18 @@ def cpatch(resource, request):
         srs_from = SRS.filter_by(id=int(srs)).one()
         dsrlz_params['transformer'] = Transformer(srs_from.wkt, resource.srs.wkt)
 
+    features = list()
     for fdata in request.json_body:
-        if 'id' not in fdata:
-            # Create new feature
-            feature = Feature(layer=resource)
-            deserialize(feature, fdata, **dsrlz_params)
-            fid = resource.feature_create(feature)
-        else:
-            # Update existing feature
-            fid = fdata['id']
-            query = resource.feature_query()
-            query.geom()
-            query.filter_by(id=fid)
-            query.limit(1)
+        # New feature if ID isn't set, otherwise only given fields and
+        # geometry of existing feature are updated.
+        feature = Feature(layer=resource, id=fdata.get('id'))
+        deserialize(feature, fdata, **dsrlz_params)
+        features.append(feature)
 
-            feature = None
-            for f in query():
-                feature = f
+    resource.feature_update_many([f for f in features if f.id is not None])
+    fids = iter(resource.feature_create_many([f for f in features if f.id is None]))
 
-            deserialize(feature, fdata, **dsrlz_params)
-            resource.feature_put(feature)
-
-        result.append(dict(id=fid))
+    result = [dict(id=f.id if f.id is not None else next(fids)) for f in features]
 
     return Response(json.dumps(result), content_type='application/json', charset='utf-8')
 
@@ -675,12 +922,8 @@ def cdelete(resource, request):
     request.resource_permission(PERM_WRITE)
 
     if len(request.body) > 0:
-        result = []
-        for fdata in request.json_body:
-            if 'id' in fdata:
-                fid = fdata['id']
-                resource.feature_delete(fid)
-                result.append(fid)
+        result = [fdata['id'] for fdata in request.json_body if 'id' in fdata]
+        resource.feature_delete_many(result)
     else:
         resource.feature_delete_all()
         result = True
@@ -692,13 +935,24 @@ def count(resource, request):
     request.resource_permission(PERM_READ)
 
     query = resource.feature_query()
-    total_count = query().total_count
+    features = query()
+
+    estimate = request.GET.get('estimate', 'no') == 'yes'
+    total_count = _total_count(query, features, estimate)
 
     return Response(
         json.dumps(dict(total_count=total_count)),
         content_type='application/json', charset='utf-8')
 
 
+def _total_count(query, features, estimate):
+    # Planner estimate is much cheaper than exact count on large tables,
+    # but it's inaccurate, so it's used only on request.
+    if estimate and IFeatureQueryKeyset.providedBy(query):
+        return features.total_count_estimate
+    return features.total_count
+
+
 def store_collection(layer, request):
     request.resource_permission(PERM_READ)
 
@@ -735,27 +989,31 @@ def store_collection(layer, request):
         sort_colname = sort.group(2)
         query.order_by((sort_order, sort_colname), )
 
+    if not http_range and IFeatureQueryStream.providedBy(query):
+        query.stream()
+
     features = query()
 
-    result = []
-    for fobj in features:
+    def serializer(fobj):
         fdata = dict(
             [(pref(k), v) for k, v in fobj.fields.items()],
             id=fobj.id, label=fobj.label)
         if box:
             fdata['box'] = fobj.box.bounds
-
-        result.append(fdata)
+        return fdata
 
     headers = dict()
     headers['Content-Type'] = 'application/json'
 
     if http_range:
-        total = features.total_count
+        total = _total_count(
+            query, features, request.GET.get('estimate', 'no') == 'yes')
         last = min(total - 1, last)
         headers['Content-Range'] = 'items %d-%s/%d' % (first, last, total)
 
-    return Response(json.dumps(result, cls=geojson.Encoder), headers=headers)
+    return Response(
+        app_iter=json_stream(layer, features, serializer),
+        headers=headers)
 
 
 def setup_pyramid(comp, config):
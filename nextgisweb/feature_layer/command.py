@@ -0,0 +1,92 @@
+import logging
+from itertools import product
+
+from pyproj import Transformer
+
+from ..command import Command
+from ..layer import IBboxLayer
+from ..resource import Resource
+
+from .api import mvt_layer
+from .interface import IFeatureLayer
+from .mvt_cache import MERC_MAX, tile_range
+
+
+_logger = logging.getLogger(__name__)
+
+
+@Command.registry.register
+class MVTCacheSeedCommand():
+    identity = 'feature_layer.mvt_cache_seed'
+
+    @classmethod
+    def argparser_setup(cls, parser, env):
+        parser.add_argument(
+            'resource', type=int, nargs='+',
+            help="Feature layer resource ID")
+        parser.add_argument(
+            '--zoom-min', dest='zmin', type=int, default=0,
+            help="Minimum zoom level")
+        parser.add_argument(
+            '--zoom-max', dest='zmax', type=int, default=14,
+            help="Maximum zoom level")
+        parser.add_argument(
+            '--extent', type=int, default=4096,
+            help="Tile extent, same as in MVT API request")
+        parser.add_argument(
+            '--simplification', type=float, default=None,
+            help="Simplification, same as in MVT API request")
+        parser.add_argument(
+            '--padding', type=float, default=0.05,
+            help="Padding, same as in MVT API request")
+
+    @classmethod
+    def execute(cls, args, env):
+        mvt_cache = env.feature_layer.mvt_cache
+        if mvt_cache is None:
+            raise RuntimeError("Vector tile cache is disabled.")
+
+        simplification = args.simplification if args.simplification is not None \
+            else args.extent / 512
+        params = (args.extent, simplification, args.padding)
+
+        srs_tr = Transformer.from_crs(4326, 3857, always_xy=True)
+
+        for resid in args.resource:
+            obj = Resource.filter_by(id=resid).one()
+            if not IFeatureLayer.providedBy(obj) or not IBboxLayer.providedBy(obj):
+                raise ValueError("Resource (ID=%d) is not a feature layer." % resid)
+            if not mvt_cache.cacheable(obj):
+                raise ValueError(
+                    "Resource (ID=%d) can be cached only with TTL set." % resid)
+
+            extent = obj.extent
+            if extent['minLon'] is None:
+                _logger.info("Resource (ID=%d) has no features, skipping", resid)
+                continue
+
+            bounds = srs_tr.transform(extent['minLon'], extent['minLat']) \
+                + srs_tr.transform(extent['maxLon'], extent['maxLat'])
+            bounds = tuple(max(min(c, MERC_MAX), -MERC_MAX) for c in bounds)
+
+            count = 0
+            for z in range(args.zmin, args.zmax + 1):
+                tmax = 2 ** z - 1
+                xmin, xmax, ymin, ymax = [
+                    max(min(c, tmax), 0) for c in tile_range(bounds, z)]
+
+                for x, y in product(range(xmin, xmax + 1), range(ymin, ymax + 1)):
+                    tile = (z, x, y)
+                    if mvt_cache.get(resid, tile, params) is not None:
+                        continue
+
+                    data = mvt_layer(obj, tile, *params)
+                    if data is None:
+                        raise RuntimeError("MVT GDAL driver not found.")
+
+                    mvt_cache.put(resid, tile, params, data)
+                    count += 1
+
+                _logger.debug("Resource (ID=%d) z=%d seeded", resid, z)
+
+            _logger.info("Resource (ID=%d): %d tiles seeded", resid, count)
@@ -124,6 +124,25 @@ class IWritableFeatureLayer(IFeatureLayer):
     def feature_put(self, feature):
         """ Save feature in a layer """
 
+    def feature_create_many(self, features):
+        """ Create new features in bulk
+
+        :param features: list of feature descriptions
+        :type features:  list
+
+        :return:         list of IDs of new features in the same order
+        """
+
+    def feature_update_many(self, features):
+        """ Save features in a layer in bulk """
+
+    def feature_delete_many(self, feature_ids):
+        """ Remove features with ids in bulk
+
+        :param feature_ids: list of feature ids
+        :type feature_ids:  list
+        """
+
 
 class IFeatureQuery(Interface):
 
@@ -189,3 +208,28 @@ class IFeatureQuerySimplify(IFeatureQuery):
 
     def simplify(self, tolerance):
         """ Simplify geometry by the given tolerance """
+
+
+class IFeatureQueryMVT(IFeatureQuery):
+
+    def mvt(self, name, bounds, extent, buffer):
+        """ Encode features as a Mapbox vector tile layer on the database
+        side. Tile bounds are given in query CRS. Returns layer bytes or
+        None if it's not supported by the backend. """
+
+
+class IFeatureQueryKeyset(IFeatureQuery):
+
+    def after(self, token):
+        """ Continue with features following the continuation token. After
+        iteration over a limited feature set its next_token attribute holds
+        the token for the next page or None if it's the last one. Feature
+        set also has total_count_estimate attribute with the planner
+        estimate of total count. """
+
+
+class IFeatureQueryStream(IFeatureQuery):
+
+    def stream(self):
+        """ Fetch features with a server-side cursor, intended for large
+        unbounded result sets which are iterated over once """
@@ -9,6 +9,7 @@ from .. import db
 from ..models import declarative_base
 from ..resource import (
     Resource,
+    ResourceExportJob,
     DataStructureScope,
     Serializer,
     SerializedProperty as SP)
@@ -19,6 +20,7 @@ from .interface import (
     FIELD_TYPE,
     FIELD_TYPE_OGR)
 
+from .mvt_cache import invalidate_fields
 from .util import _
 
 Base = declarative_base(dependencies=('resource', 'lookup_table'))
@@ -202,6 +204,10 @@ class _fields_attr(SP):
         obj.fields = fields
         obj.fields.reorder()
 
+        # Cached tiles and exports contain field names and values
+        invalidate_fields(obj)
+        ResourceExportJob.outdate(obj.id)
+
 
 P_DSS_READ = DataStructureScope.read
 P_DSS_WRITE = DataStructureScope.write
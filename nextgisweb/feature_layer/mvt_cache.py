@@ -0,0 +1,215 @@
+import os
+import os.path
+import sqlite3
+from pathlib import Path
+from threading import Lock
+from time import time
+from weakref import WeakKeyDictionary
+
+import transaction
+from cachetools import LRUCache
+from shapely.geometry import box
+
+from ..env import env
+from ..lib.geometry import Geometry, Transformer
+from ..spatial_ref_sys import SRS
+
+from .event import on_data_change
+
+# Maximum number of open SQLite databases
+SQLITE_CON_CACHE = 32
+
+# Half size of EPSG:3857 tile matrix
+MERC_MAX = 20037508.342789244
+
+
+def tile_range(bounds, z):
+    """ Range of EPSG:3857 tiles covering given bounds as inclusive
+    (xmin, xmax, ymin, ymax) tuple """
+
+    step = 2 * MERC_MAX / 2 ** z
+    return (
+        int((bounds[0] + MERC_MAX) // step),
+        int((bounds[2] + MERC_MAX) // step),
+        int((MERC_MAX - bounds[3]) // step),
+        int((MERC_MAX - bounds[1]) // step),
+    )
+
+
+class MVTCache(object):
+    """ Persistent cache of vector tile layers
+
+    Each resource has its own SQLite database with encoded MVT layers keyed
+    by tile and encoding parameters. Tiles of a resource set are assembled
+    from layers of each resource, so a resource can be invalidated
+    independently from others. """
+
+    def __init__(self, path, ttl=None):
+        self.path = path
+        self.ttl = ttl
+
+        self._lock = Lock()
+        # Evicted connections are closed when the last reference is gone,
+        # so the number of open SQLite files is bounded.
+        self._db = LRUCache(maxsize=SQLITE_CON_CACHE)
+        self._pending = WeakKeyDictionary()
+
+    def _db_path(self, resource_id):
+        return os.path.join(self.path, '%d.sqlite' % resource_id)
+
+    def get_db(self, resource_id):
+        with self._lock:
+            result = self._db.get(resource_id)
+            if result is not None:
+                return result
+
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+
+            conn = sqlite3.connect(
+                self._db_path(resource_id), isolation_level=None,
+                timeout=30, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS tile (
+                    z INTEGER, x INTEGER, y INTEGER,
+                    extent INTEGER, simplification REAL, padding REAL,
+                    tstamp INTEGER NOT NULL, data BLOB NOT NULL,
+                    PRIMARY KEY (z, x, y, extent, simplification, padding)
+                )
+            ''')
+
+            result = (conn, Lock())
+            self._db[resource_id] = result
+            return result
+
+    def cacheable(self, resource):
+        """ Check if tiles of the resource can be cached. Data of layers
+        which don't fire data change events (like PostGIS tables changed by
+        other applications) are cached only with TTL set. """
+        return self.ttl is not None or getattr(resource, 'fires_data_change', False)
+
+    def get(self, resource_id, tile, params):
+        """ Get cached layer data or None if it isn't cached """
+        conn, lock = self.get_db(resource_id)
+
+        query = '''
+            SELECT data FROM tile WHERE z = ? AND x = ? AND y = ?
+                AND extent = ? AND simplification = ? AND padding = ?
+        '''
+        args = tuple(tile) + tuple(params)
+        if self.ttl is not None:
+            query += ' AND tstamp >= ?'
+            args += (int(time()) - self.ttl, )
+
+        with lock:
+            row = conn.execute(query, args).fetchone()
+
+        return bytes(row[0]) if row is not None else None
+
+    def put(self, resource_id, tile, params, data):
+        conn, lock = self.get_db(resource_id)
+        with lock:
+            conn.execute(
+                'INSERT OR REPLACE INTO tile VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                tuple(tile) + tuple(params) + (int(time()), data))
+
+    def clear(self, resource_id):
+        conn, lock = self.get_db(resource_id)
+        with lock:
+            conn.execute('DELETE FROM tile')
+
+    def invalidate(self, resource_id, bounds):
+        """ Remove cached tiles intersecting given bounds in EPSG:3857 with
+        one tile margin for padding and geometries crossing tile edges """
+
+        conn, lock = self.get_db(resource_id)
+
+        with lock:
+            zlist = [r[0] for r in conn.execute(
+                'SELECT DISTINCT z FROM tile').fetchall()]
+
+            params = set()
+            for z in zlist:
+                for b in bounds:
+                    xmin, xmax, ymin, ymax = tile_range(b, z)
+                    params.add((z, xmin - 1, xmax + 1, ymin - 1, ymax + 1))
+
+            conn.executemany(
+                'DELETE FROM tile WHERE z = ? AND x BETWEEN ? AND ? '
+                'AND y BETWEEN ? AND ?', params)
+
+    def invalidate_deferred(self, resource, geom):
+        """ Invalidate tiles covering the geometry after commit of the
+        current transaction, geometry is given in resource CRS """
+
+        txn = transaction.get()
+        pending = self._pending.get(txn)
+        if pending is None:
+            pending = self._pending[txn] = dict()
+            txn.addAfterCommitHook(self._invalidate_hook, args=(pending, ))
+
+        if resource.id in pending and pending[resource.id] is None:
+            return
+
+        if geom is None:
+            # Only attributes have changed, but the geometry is unknown
+            pending[resource.id] = None
+            return
+
+        if not isinstance(geom, Geometry):
+            geom = Geometry.from_shape(geom)
+
+        srs = resource.srs
+        if srs.id != 3857:
+            transformer = Transformer(srs.wkt, SRS.filter_by(id=3857).one().wkt)
+            geom = transformer.transform(Geometry.from_shape(box(*geom.bounds)))
+
+        pending.setdefault(resource.id, list()).append(geom.bounds)
+
+    def _invalidate_hook(self, success, pending):
+        if not success:
+            return
+
+        for resource_id, bounds in pending.items():
+            if not os.path.isfile(self._db_path(resource_id)):
+                continue
+            if bounds is None:
+                self.clear(resource_id)
+            else:
+                self.invalidate(resource_id, bounds)
+
+    def cleanup(self, resource_ids):
+        """ Remove databases of resources which don't exist anymore """
+        deleted = 0
+        for fn in Path(self.path).glob('*.sqlite'):
+            if int(fn.stem) in resource_ids:
+                continue
+
+            with self._lock:
+                item = self._db.pop(int(fn.stem), None)
+                if item is not None:
+                    item[0].close()
+
+            for suffix in ('', '-wal', '-shm'):
+                p = fn.with_name(fn.name + suffix)
+                if p.exists():
+                    p.unlink()
+            deleted += 1
+
+        return deleted
+
+
+@on_data_change.connect
+def on_data_change_handler(resource, geom):
+    mvt_cache = env.feature_layer.mvt_cache
+    if mvt_cache is not None:
+        mvt_cache.invalidate_deferred(resource, geom)
+
+
+def invalidate_fields(resource):
+    """ Drop cached tiles of the resource after its fields are changed,
+    which doesn't fire data change events """
+    mvt_cache = env.feature_layer.mvt_cache
+    if mvt_cache is not None:
+        mvt_cache.invalidate_deferred(resource, None)
@@ -0,0 +1,69 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import date, time
+
+from .. import db
+from ..core.exception import ValidationError
+
+from .util import _
+
+
+def encode_token(values):
+    """ Encode values of ordering columns of the last feature into an opaque
+    continuation token """
+
+    values = [v.isoformat() if isinstance(v, (date, time)) else v for v in values]
+    data = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def decode_token(token, count):
+    """ Decode continuation token into a list of column values """
+
+    try:
+        data = urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        values = json.loads(data.decode('utf-8'))
+    except ValueError:
+        values = None
+
+    if not isinstance(values, list) or len(values) != count:
+        raise ValidationError(_("Invalid continuation token."))
+
+    return values
+
+
+def keyset_where(columns, values):
+    """ Condition selecting rows following the given values in order of
+    columns, which is a list of (column, order) pairs. In PostgreSQL NULLs go
+    last in ascending and first in descending order. """
+
+    alternatives = list()
+    equal = list()
+    for (column, order), value in zip(columns, values):
+        if value is None:
+            after = None if order == 'asc' else column.isnot(None)
+        elif order == 'asc':
+            after = db.or_(column > value, column.is_(None))
+        else:
+            after = column < value
+
+        if after is not None:
+            alternatives.append(db.and_(*(equal + [after])))
+
+        equal.append(column.is_(None) if value is None else column == value)
+
+    return db.or_(*alternatives) if len(alternatives) > 0 else db.false()
+
+
+def explain_rows(conn, query):
+    """ Planner estimate of query rows count based on table statistics """
+
+    compiled = query.compile(dialect=conn.dialect)
+    plan = conn.execute(
+        'EXPLAIN (FORMAT JSON) ' + str(compiled),
+        compiled.params).scalar()
+
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+
+    return int(plan[0]['Plan']['Plan Rows'])
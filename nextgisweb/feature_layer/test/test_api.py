@@ -1,17 +1,22 @@
 import importlib
 import json
+from datetime import datetime, timedelta
 from itertools import product
 
 import pytest
 import transaction
 
 from uuid import uuid4
-from osgeo import ogr
+from osgeo import gdal, ogr
 
+from nextgisweb import geojson
 from nextgisweb.auth import User
+from nextgisweb.feature_layer.api import json_stream
+from nextgisweb.feature_layer.mvt_cache import MVTCache, SQLITE_CON_CACHE
 from nextgisweb.feature_layer.ogrdriver import EXPORT_FORMAT_OGR
 from nextgisweb.lib.geometry import Geometry
 from nextgisweb.models import DBSession
+from nextgisweb.resource.export_job import ResourceExportJob, run_export_job
 from nextgisweb.spatial_ref_sys.models import SRS
 from nextgisweb.vector_layer import VectorLayer
 
@@ -240,6 +245,69 @@ def test_export(fmt, zipped, srs, ngw_webtest_app, vector_layer_id, ngw_auth_adm
                         dict(format=fmt, zipped=zipped, srs=srs), status=200)
 
 
+def test_export_job(ngw_webtest_app, vector_layer_id, ngw_auth_administrator):
+    url = '/api/resource/%d/export_job/' % vector_layer_id
+    params = dict(format='GeoJSON', zipped='false', srs=4326)
+
+    job = ngw_webtest_app.post_json(url, params, status=200).json
+    assert job['status'] == 'pending'
+
+    # Same parameters reuse the same job
+    assert ngw_webtest_app.post_json(url, params, status=200).json['id'] == job['id']
+
+    with transaction.manager:
+        assert ResourceExportJob.claim() == job['id']
+    assert run_export_job(job['id'])
+
+    resp = ngw_webtest_app.get(url + str(job['id']), status=200)
+    assert resp.json['status'] == 'done'
+    assert resp.json['filename'] == '%d.geojson' % vector_layer_id
+
+    resp = ngw_webtest_app.get(url + '%d/download' % job['id'], status=200)
+    assert len(json.loads(resp.body)['features']) == 2
+
+    # Data change makes completed job outdated
+    ngw_webtest_app.put_json('/api/resource/%d/feature/1' % vector_layer_id, dict(
+        fields=dict(name='feature1')), status=200)
+    assert ngw_webtest_app.post_json(url, params, status=200).json['id'] != job['id']
+
+    # So does change of fields
+    job = ngw_webtest_app.post_json(url, params, status=200).json
+    with transaction.manager:
+        assert ResourceExportJob.claim() == job['id']
+    assert run_export_job(job['id'])
+
+    res_url = '/api/resource/%d' % vector_layer_id
+    fields = ngw_webtest_app.get(res_url, status=200).json['feature_layer']['fields']
+    ngw_webtest_app.put_json(res_url, dict(feature_layer=dict(fields=[
+        dict(id=f['id'], display_name=f['display_name']) for f in fields])), status=200)
+    assert ngw_webtest_app.post_json(url, params, status=200).json['id'] != job['id']
+
+    ngw_webtest_app.post_json(url, dict(format='INVALID'), status=422)
+
+
+def test_export_job_stale(ngw_webtest_app, vector_layer_id, ngw_auth_administrator):
+    url = '/api/resource/%d/export_job/' % vector_layer_id
+    params = dict(format='CSV', zipped='false', srs=4326)
+
+    job = ngw_webtest_app.post_json(url, params, status=200).json
+    with transaction.manager:
+        assert ResourceExportJob.claim() == job['id']
+
+    # Worker died without updating heartbeat
+    with transaction.manager:
+        ResourceExportJob.filter_by(id=job['id']).one().heartbeat = \
+            datetime.utcnow() - timedelta(days=1)
+
+    stale = ngw_webtest_app.post_json(url, params, status=200).json
+    assert stale['id'] != job['id']
+
+    with transaction.manager:
+        ResourceExportJob.fail_stale()
+    resp = ngw_webtest_app.get(url + str(job['id']), status=200)
+    assert resp.json['status'] == 'failed'
+
+
 @pytest.mark.parametrize('extent, simplification, padding', (
     (4096, 6.5, 0.1),
     (2048, 4.1, 0.01),
@@ -250,11 +318,79 @@ def test_mvt(extent, simplification, padding, ngw_webtest_app, vector_layer_id,
     ngw_webtest_app.get('/api/component/feature_layer/mvt', params, status=200)
 
 
+def test_mvt_content(ngw_webtest_app, vector_layer_id, ngw_auth_administrator):
+    params = dict(z=0, x=0, y=0, resource=vector_layer_id)
+    resp = ngw_webtest_app.get('/api/component/feature_layer/mvt', params, status=200)
+
+    fn = '/vsimem/%s.pbf' % uuid4()
+    gdal.FileFromMemBuffer(fn, resp.body)
+    try:
+        ds = ogr.Open('MVT:' + fn)
+        layer = ds.GetLayerByName('ngw:%d' % vector_layer_id)
+        assert layer is not None
+        assert set(f.GetField('name') for f in layer) == {'feature1', 'feature2'}
+        ds = None
+    finally:
+        gdal.Unlink(fn)
+
+
+@pytest.fixture
+def mvt_cache(ngw_env, tmp_path):
+    value = ngw_env.feature_layer.mvt_cache
+    ngw_env.feature_layer.mvt_cache = MVTCache(str(tmp_path))
+    yield ngw_env.feature_layer.mvt_cache
+    ngw_env.feature_layer.mvt_cache = value
+
+
+def test_mvt_cache(mvt_cache, ngw_webtest_app, vector_layer_id, ngw_auth_administrator):
+    tile = (0, 0, 0)
+    key = (4096, 8.0, 0.05)
+    params = dict(zip('zxy', tile), resource=vector_layer_id)
+
+    resp = ngw_webtest_app.get('/api/component/feature_layer/mvt', params, status=200)
+    assert mvt_cache.get(vector_layer_id, tile, key) == resp.body
+
+    resp_cached = ngw_webtest_app.get('/api/component/feature_layer/mvt', params, status=200)
+    assert resp_cached.body == resp.body
+
+    ngw_webtest_app.put_json('/api/resource/%d/feature/1' % vector_layer_id, dict(
+        geom='POINT (0 0)'), status=200)
+    assert mvt_cache.get(vector_layer_id, tile, key) is None
+
+    # Changes of fields aren't data changes, but invalidate tiles too
+    ngw_webtest_app.get('/api/component/feature_layer/mvt', params, status=200)
+    assert mvt_cache.get(vector_layer_id, tile, key) is not None
+
+    res_url = '/api/resource/%d' % vector_layer_id
+    fields = ngw_webtest_app.get(res_url, status=200).json['feature_layer']['fields']
+    ngw_webtest_app.put_json(res_url, dict(feature_layer=dict(fields=[
+        dict(id=f['id'], display_name=f['display_name']) for f in fields])), status=200)
+    assert mvt_cache.get(vector_layer_id, tile, key) is None
+
+
+def test_mvt_cache_connections(tmp_path):
+    mvt_cache = MVTCache(str(tmp_path))
+    tile, params = (0, 0, 0), (4096, 8.0, 0.05)
+
+    for resource_id in range(SQLITE_CON_CACHE + 8):
+        mvt_cache.put(resource_id, tile, params, b'data')
+
+    # Least recently used databases are closed, but data remains
+    assert len(mvt_cache._db) == SQLITE_CON_CACHE
+    assert mvt_cache.get(0, tile, params) == b'data'
+
+
 @pytest.mark.parametrize('mvt_driver_exist, status_expected', (
     (True, 200),
     (False, 404),
 ))
 def test_mvt_should_return_not_found_if_mvt_driver_not_available(mvt_driver_exist, status_expected, ngw_webtest_app, vector_layer_id, ngw_auth_administrator):
+    from nextgisweb.vector_layer.model import _asmvt_feature_id_supported
+    with transaction.manager:
+        if _asmvt_feature_id_supported():
+            # Vector layer tiles are encoded by PostGIS without GDAL
+            status_expected = 200
+
     import nextgisweb.feature_layer.ogrdriver as ogrdriver
     old_MVT_DRIVER_EXIST = ogrdriver.MVT_DRIVER_EXIST
     ogrdriver.MVT_DRIVER_EXIST = mvt_driver_exist
@@ -270,6 +406,109 @@ def test_mvt_should_return_not_found_if_mvt_driver_not_available(mvt_driver_exis
     importlib.reload(api)
 
 
+def _stream_source(vector_layer_id):
+    # Feature query is prepared in the request transaction and it is
+    # finished before the response body is consumed
+    with transaction.manager:
+        obj = VectorLayer.filter_by(id=vector_layer_id).one()
+        features = obj.feature_query()()
+    return obj, features
+
+
+def _stream_serializer(feature):
+    return dict(id=feature.id, fields=feature.fields, geom=feature.geom.wkt)
+
+
+@pytest.mark.parametrize('chunk_size', (1, 2, 1000))
+def test_json_stream(chunk_size, ngw_env, vector_layer_id):
+    obj, features = _stream_source(vector_layer_id)
+    body = b''.join(json_stream(
+        obj, features, _stream_serializer, chunk_size=chunk_size))
+
+    # Same as serialization of the whole list at once
+    with transaction.manager:
+        obj = VectorLayer.filter_by(id=vector_layer_id).one()
+        expected = json.dumps([
+            _stream_serializer(f) for f in obj.feature_query()()
+        ], cls=geojson.Encoder).encode('utf-8')
+
+    assert body == expected
+
+
+def test_json_stream_error(ngw_env, vector_layer_id):
+    obj, features = _stream_source(vector_layer_id)
+
+    def serializer(feature):
+        if serializer.count > 0:
+            raise RuntimeError("Serialization failed")
+        serializer.count += 1
+        return _stream_serializer(feature)
+
+    serializer.count = 0
+
+    stream = json_stream(obj, features, serializer, chunk_size=1)
+    assert next(stream).startswith(b'[')
+
+    # Error isn't hidden by finishing the JSON array
+    with pytest.raises(RuntimeError):
+        next(stream)
+
+
+def test_cget_cursor(ngw_webtest_app, vector_layer_id, ngw_auth_administrator):
+    url = '/api/resource/%d/feature/' % vector_layer_id
+
+    for order_by in ('id', '-id', 'name,-id'):
+        expected = [f['id'] for f in ngw_webtest_app.get(
+            url, dict(order_by=order_by)).json]
+
+        fids = []
+        cursor = ''
+        while cursor is not None:
+            resp = ngw_webtest_app.get(url, dict(
+                order_by=order_by, limit=1, cursor=cursor))
+            # Limit is a divisor of any total, so there are no empty pages
+            assert len(resp.json) == 1
+            fids.extend(f['id'] for f in resp.json)
+            cursor = resp.headers.get('X-Feature-Cursor')
+        assert fids == expected
+
+    ngw_webtest_app.get(url, dict(cursor=''), status=422)
+    ngw_webtest_app.get(url, dict(limit=1, cursor='invalid'), status=422)
+
+    resp = ngw_webtest_app.get(
+        '/api/resource/%d/feature_count' % vector_layer_id, dict(estimate='yes'))
+    assert resp.json['total_count'] >= 0
+
+    # Feature store returns exact count unless estimate is requested
+    total_count = ngw_webtest_app.get(
+        '/api/resource/%d/feature_count' % vector_layer_id).json['total_count']
+    resp = ngw_webtest_app.get(
+        '/api/resource/%d/store/' % vector_layer_id, headers=dict(Range='items=0-0'))
+    assert resp.headers['Content-Range'] == 'items 0-0/%d' % total_count
+
+
+def test_cpatch(ngw_webtest_app, vector_layer_id, ngw_auth_administrator):
+    url = '/api/resource/%d/feature/' % vector_layer_id
+
+    resp = ngw_webtest_app.patch_json(url, [
+        dict(geom='POINT (1 1)', fields=dict(name='new1')),
+        dict(id=2, fields=dict(name='updated2')),
+        dict(geom='POINT (2 2)', fields=dict(name='new2')),
+    ], status=200)
+
+    fids = [item['id'] for item in resp.json]
+    assert fids[1] == 2
+    assert len(set(fids)) == 3
+
+    names = dict((f['id'], f['fields']['name']) for f in ngw_webtest_app.get(url).json)
+    assert [names[fid] for fid in fids] == ['new1', 'updated2', 'new2']
+
+    ngw_webtest_app.patch_json(url, [dict(id=-1, fields=dict(name='missing'))], status=404)
+
+    resp = ngw_webtest_app.delete_json(url, [dict(id=fids[0]), dict(id=fids[2])])
+    assert resp.json == [fids[0], fids[2]]
+
+
 def test_cdelete(ngw_webtest_app, vector_layer_id, ngw_auth_administrator):
     url = '/api/resource/%d/feature/' % vector_layer_id
 
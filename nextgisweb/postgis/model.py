@@ -39,7 +39,11 @@ from ..feature_layer import (
     IFeatureQueryFilterBy,
     IFeatureQueryLike,
     IFeatureQueryIntersects,
-    IFeatureQueryOrderBy)
+    IFeatureQueryOrderBy,
+    IFeatureQueryMVT,
+    IFeatureQueryKeyset,
+    IFeatureQueryStream)
+from ..feature_layer.paging import decode_token, encode_token, explain_rows, keyset_where
 
 from .util import _
 
@@ -53,6 +57,9 @@ PC_READ = ConnectionScope.read
 PC_WRITE = ConnectionScope.write
 PC_CONNECT = ConnectionScope.connect
 
+# Number of rows in a single statement of bulk feature writes
+WRITE_BATCH_SIZE = 1000
+
 
 class PostgisConnection(Base, Resource):
     identity = 'postgis_connection'
@@ -424,6 +431,73 @@ class PostgisLayer(Base, Resource, SpatialLayerMixin, LayerFieldsMixin):
         finally:
             conn.close()
 
+    def feature_create_many(self, features):
+        """Insert new objects with multi-row INSERT statements, consecutive
+        features with the same set of fields share a statement
+
+        :param features: list of object descriptions
+        :type features:  list
+
+        :return:    list of inserted object IDs in the same order
+        """
+        idcol = db.sql.column(self.column_id)
+        tab = self._sa_table(True)
+
+        groups = list()
+        for feature in features:
+            values = self._makevals(feature)
+            if (
+                len(groups) > 0 and groups[-1][0] == values.keys()
+                and len(groups[-1][1]) < WRITE_BATCH_SIZE  # NOQA: W503
+            ):
+                groups[-1][1].append(values)
+            else:
+                groups.append((values.keys(), [values, ]))
+
+        conn = self.connection.get_connection()
+        try:
+            result = list()
+            for keys, rows in groups:
+                stmt = db.insert(tab).values(rows).returning(idcol)
+                result.extend(row[0] for row in conn.execute(stmt))
+            return result
+        finally:
+            conn.close()
+
+    def feature_update_many(self, features):
+        """Update existing objects using a single connection
+
+        :param features: list of object descriptions
+        :type features:  list
+        """
+        idcol = db.sql.column(self.column_id)
+        tab = self._sa_table(True)
+
+        conn = self.connection.get_connection()
+        try:
+            for feature in features:
+                conn.execute(db.update(tab).values(
+                    self._makevals(feature)).where(idcol == feature.id))
+        finally:
+            conn.close()
+
+    def feature_delete_many(self, feature_ids):
+        """Remove records with ids
+
+        :param feature_ids: record ids
+        :type feature_ids:  list
+        """
+        idcol = db.sql.column(self.column_id)
+        tab = self._sa_table()
+
+        conn = self.connection.get_connection()
+        try:
+            for i in range(0, len(feature_ids), WRITE_BATCH_SIZE):
+                conn.execute(db.delete(tab).where(
+                    idcol.in_(feature_ids[i:i + WRITE_BATCH_SIZE])))
+        finally:
+            conn.close()
+
     def feature_delete_all(self):
         """Remove all records from a layer"""
         conn = self.connection.get_connection()
@@ -522,6 +596,24 @@ class PostgisLayerSerializer(Serializer):
     fields = _fields_action(write=DataStructureScope.write)
 
 
+# PostGIS capabilities by connection resource ID: (params, supported)
+_asmvt_fid_cache = dict()
+
+
+def _asmvt_feature_id_supported(connection, conn):
+    # Feature ID argument of ST_AsMVT is available since PostGIS 3.0. The
+    # result is checked again if connection parameters are changed.
+    params = (connection.hostname, connection.port, connection.database)
+    cached = _asmvt_fid_cache.get(connection.id)
+    if cached is not None and cached[0] == params:
+        return cached[1]
+
+    version = conn.execute("SELECT postgis_lib_version()").scalar()
+    supported = int(version.split('.')[0]) >= 3
+    _asmvt_fid_cache[connection.id] = (params, supported)
+    return supported
+
+
 @implementer(
     IFeatureQuery,
     IFeatureQueryFilter,
@@ -529,6 +621,9 @@ class PostgisLayerSerializer(Serializer):
     IFeatureQueryLike,
     IFeatureQueryIntersects,
     IFeatureQueryOrderBy,
+    IFeatureQueryMVT,
+    IFeatureQueryKeyset,
+    IFeatureQueryStream,
 )
 class FeatureQueryBase(object):
 
@@ -541,6 +636,8 @@ class FeatureQueryBase(object):
         self._fields = None
         self._limit = None
         self._offset = None
+        self._after = None
+        self._stream = None
 
         self._filter = None
         self._filter_by = None
@@ -568,6 +665,12 @@ class FeatureQueryBase(object):
         self._limit = limit
         self._offset = offset
 
+    def after(self, token):
+        self._after = token
+
+    def stream(self):
+        self._stream = True
+
     def filter(self, *args):
         self._filter = args
 
@@ -583,47 +686,15 @@ class FeatureQueryBase(object):
     def intersects(self, geom):
         self._intersects = geom
 
-    def __call__(self):
-        tab = db.sql.table(self.layer.table)
-        tab.schema = self.layer.schema
-
-        tab.quote = True
-        tab.quote_schema = True
-
-        select = db.select([], tab)
-
-        def addcol(col):
-            select.append_column(col)
-
-        idcol = db.sql.column(self.layer.column_id)
-        addcol(idcol.label('id'))
-
-        srsid = self.layer.srs_id if self._srs is None else self._srs.id
-
-        geomcol = db.sql.column(self.layer.column_geom)
-        geomexpr = db.func.st_transform(geomcol, srsid)
-
-        if self._geom:
-            if self._geom_format == 'WKB':
-                geomexpr = db.func.st_asbinary(geomexpr, 'NDR')
-            else:
-                geomexpr = db.func.st_astext(geomexpr)
-
-            addcol(geomexpr.label('geom'))
-
-        fieldmap = []
-        for idx, fld in enumerate(self.layer.fields, start=1):
-            if not self._fields or fld.keyname in self._fields:
-                clabel = 'f%d' % idx
-                addcol(db.sql.column(fld.column_name).label(clabel))
-                fieldmap.append((fld.keyname, clabel))
+    def _where(self, idcol):
+        where = []
 
         if self._filter_by:
             for k, v in self._filter_by.items():
                 if k == 'id':
-                    select.append_whereclause(idcol == v)
+                    where.append(idcol == v)
                 else:
-                    select.append_whereclause(db.sql.column(k) == v)
+                    where.append(db.sql.column(k) == v)
 
         if self._filter:
             clauses = []
@@ -646,7 +717,7 @@ class FeatureQueryBase(object):
                 else:
                     clauses.append(op(db.sql.column(k), v))
 
-            select.append_whereclause(db.and_(*clauses))
+            where.append(db.and_(*clauses))
 
         if self._like:
             clauses = []
@@ -656,30 +727,122 @@ class FeatureQueryBase(object):
                     db.Unicode).ilike(
                     '%' + self._like + '%'))
 
-            select.append_whereclause(db.or_(*clauses))
+            where.append(db.or_(*clauses))
 
         if self._intersects:
             intgeom = db.func.st_setsrid(db.func.st_geomfromtext(
                 self._intersects.wkt), self._intersects.srid)
-            select.append_whereclause(db.func.st_intersects(
-                geomcol, db.func.st_transform(
+            where.append(db.func.st_intersects(
+                db.sql.column(self.layer.column_geom), db.func.st_transform(
                     intgeom, self.layer.geometry_srid)))
 
+        gt = self.layer.geometry_type
+        where.append(db.func.geometrytype(db.sql.column(
+            self.layer.column_geom)).in_((gt, )))
+
+        return where
+
+    def mvt(self, name, bounds, extent, buffer):
+        tab = db.sql.table(self.layer.table)
+        tab.schema = self.layer.schema
+
+        tab.quote = True
+        tab.quote_schema = True
+
+        srsid = self.layer.srs_id if self._srs is None else self._srs.id
+
+        idcol = db.sql.column(self.layer.column_id)
+        geomexpr = db.func.st_asmvtgeom(
+            db.func.st_transform(db.sql.column(self.layer.column_geom), srsid),
+            db.func.st_makeenvelope(*bounds, srsid), extent, buffer, True)
+
+        columns = [idcol.label('__fid'), geomexpr.label('__geom')]
+        for fld in self.layer.fields:
+            if not self._fields or fld.keyname in self._fields:
+                columns.append(db.sql.column(fld.column_name).label(fld.keyname))
+
+        features = db.select(
+            columns, whereclause=db.and_(*self._where(idcol)),
+            from_obj=tab, order_by=idcol,
+        ).alias('features')
+
+        query = db.select([db.func.st_asmvt(
+            db.sql.literal_column(features.name), name, extent,
+            '__geom', '__fid')]).select_from(features)
+
+        conn = self.layer.connection.get_connection()
+
+        try:
+            if not _asmvt_feature_id_supported(self.layer.connection, conn):
+                return None
+
+            result = conn.execute(query).scalar()
+            return bytes(result) if result is not None else b''
+        finally:
+            conn.close()
+
+    def __call__(self):
+        tab = db.sql.table(self.layer.table)
+        tab.schema = self.layer.schema
+
+        tab.quote = True
+        tab.quote_schema = True
+
+        select = db.select([], tab)
+
+        def addcol(col):
+            select.append_column(col)
+
+        idcol = db.sql.column(self.layer.column_id)
+        addcol(idcol.label('id'))
+
+        srsid = self.layer.srs_id if self._srs is None else self._srs.id
+
+        geomcol = db.sql.column(self.layer.column_geom)
+        geomexpr = db.func.st_transform(geomcol, srsid)
+
+        if self._geom:
+            if self._geom_format == 'WKB':
+                geomexpr = db.func.st_asbinary(geomexpr, 'NDR')
+            else:
+                geomexpr = db.func.st_astext(geomexpr)
+
+            addcol(geomexpr.label('geom'))
+
+        fieldmap = []
+        for idx, fld in enumerate(self.layer.fields, start=1):
+            if not self._fields or fld.keyname in self._fields:
+                clabel = 'f%d' % idx
+                addcol(db.sql.column(fld.column_name).label(clabel))
+                fieldmap.append((fld.keyname, clabel))
+
+        for clause in self._where(idcol):
+            select.append_whereclause(clause)
+
         if self._box:
             addcol(db.func.st_xmin(geomexpr).label('box_left'))
             addcol(db.func.st_ymin(geomexpr).label('box_bottom'))
             addcol(db.func.st_xmax(geomexpr).label('box_right'))
             addcol(db.func.st_ymax(geomexpr).label('box_top'))
 
-        gt = self.layer.geometry_type
-        select.append_whereclause(db.func.geometrytype(db.sql.column(
-            self.layer.column_geom)).in_((gt, )))
-
+        order_columns = []
         if self._order_by:
             for order, colname in self._order_by:
-                select.append_order_by(dict(asc=db.asc, desc=db.desc)[order](
-                    db.sql.column(colname)))
-        select.append_order_by(idcol)
+                order_columns.append((db.sql.column(colname), order))
+        order_columns.append((idcol, 'asc'))
+
+        for column, order in order_columns:
+            select.append_order_by(dict(asc=db.asc, desc=db.desc)[order](column))
+
+        # Values of ordering columns are selected for continuation token
+        keys = ['__k%d' % idx for idx in range(len(order_columns))]
+        for key, (column, order) in zip(keys, order_columns):
+            addcol(column.label(key))
+
+        page_select = select
+        if self._after is not None:
+            page_select = select.where(keyset_where(
+                order_columns, decode_token(self._after, len(keys))))
 
         class QueryFeatureSet(FeatureSet):
             layer = self.layer
@@ -690,17 +853,35 @@ class FeatureQueryBase(object):
             _fields = self._fields
             _limit = self._limit
             _offset = self._offset
+            _stream = self._stream
+
+            # Continuation token available after iteration over a limited
+            # set, it's None if there are no more features
+            next_token = None
 
             def __iter__(self):
                 if self._limit:
-                    query = select.limit(self._limit).offset(self._offset)
+                    # One extra row tells if there is a next page
+                    query = page_select.limit(self._limit + 1) \
+                        .offset(self._offset)
                 else:
-                    query = select
+                    query = page_select
 
                 conn = self.layer.connection.get_connection()
 
+                self.next_token = None
+                count = 0
+                last = None
                 try:
-                    for row in conn.execute(query):
+                    rows = (conn.execution_options(stream_results=True)
+                            if self._stream else conn).execute(query)
+                    for row in rows:
+                        count += 1
+                        if self._limit and count > self._limit:
+                            self.next_token = encode_token([last[k] for k in keys])
+                            break
+                        last = row
+
                         fdict = dict((k, row[l]) for k, l in fieldmap)
 
                         if self._geom:
@@ -737,4 +918,13 @@ class FeatureQueryBase(object):
                 finally:
                     conn.close()
 
+            @property
+            def total_count_estimate(self):
+                conn = self.layer.connection.get_connection()
+
+                try:
+                    return explain_rows(conn, select)
+                finally:
+                    conn.close()
+
         return QueryFeatureSet()
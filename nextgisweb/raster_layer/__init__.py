@@ -1,6 +1,11 @@
+from osgeo import gdal
+
 from ..component import Component
+from ..lib.config import Option
 
-from . import command  # NOQA
+from . import command, export  # NOQA
+from .cog import cog_creation_options
+from .dataset_cache import DatasetCache
 from .gdaldriver import GDAL_DRIVER_NAME_2_EXPORT_FORMATS
 from .kind_of_data import RasterLayerData
 from .model import Base, RasterLayer, estimate_raster_layer_data
@@ -16,6 +21,18 @@ class RasterLayerComponent(Component):
         self.env.core.mksdir(self)
         self.wdir = self.env.core.gtsdir(self)
 
+        self.dataset_cache = DatasetCache(self.options['dataset_cache.size'])
+
+        gdal_cachemax = self.options['gdal_cachemax']
+        if gdal_cachemax is not None:
+            gdal.SetCacheMax(gdal_cachemax * 2**20)
+
+        opt_cog = self.options.with_prefix('cog')
+        self.cog = opt_cog['enabled']
+        self.cog_creation_options = cog_creation_options(
+            compression=opt_cog['compression'], blocksize=opt_cog['blocksize'],
+            predictor=opt_cog['predictor'], quality=opt_cog['quality'])
+
     def setup_pyramid(self, config):
         from . import view, api # NOQA
         view.setup_pyramid(self, config)
@@ -42,3 +59,20 @@ class RasterLayerComponent(Component):
         for resource in RasterLayer.query():
             size = estimate_raster_layer_data(resource)
             yield RasterLayerData, resource.id, size
+
+    option_annotations = (
+        Option('dataset_cache.size', int, default=64,
+               doc="Maximum number of open raster datasets kept for reuse by a process."),
+        Option('gdal_cachemax', int, default=None,
+               doc="Size of GDAL raster block cache in megabytes (GDAL_CACHEMAX)."),
+        Option('cog.enabled', bool, default=False,
+               doc="Store uploaded rasters as Cloud Optimized GeoTIFF with internal overviews."),
+        Option('cog.compression', str, default='DEFLATE',
+               doc="COG compression: DEFLATE, ZSTD, LZW, WEBP or JPEG."),
+        Option('cog.blocksize', int, default=512,
+               doc="COG tile size in pixels."),
+        Option('cog.predictor', bool, default=True,
+               doc="Use predictor with lossless COG compression."),
+        Option('cog.quality', int, default=None,
+               doc="Quality of lossy COG compression (1-100)."),
+    )
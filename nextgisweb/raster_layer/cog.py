@@ -0,0 +1,59 @@
+from osgeo import gdal
+
+__all__ = [
+    'COG_COMPRESSION',
+    'cog_creation_options',
+    'is_cog',
+    'translate_cog',
+]
+
+COG_COMPRESSION = ('DEFLATE', 'ZSTD', 'LZW', 'WEBP', 'JPEG')
+
+# Lossless compression methods which benefit from the predictor
+COG_PREDICTOR_COMPRESSION = ('DEFLATE', 'ZSTD', 'LZW')
+
+
+def cog_creation_options(compression, blocksize, predictor=True, quality=None):
+    """ Creation options of GDAL COG driver for raster ingestion """
+
+    compression = compression.upper()
+    if compression not in COG_COMPRESSION:
+        raise ValueError("Unsupported COG compression: {}".format(compression))
+
+    result = [
+        'COMPRESS=' + compression,
+        'BLOCKSIZE=%d' % blocksize,
+        'BIGTIFF=IF_SAFER',
+        'NUM_THREADS=ALL_CPUS',
+        'RESAMPLING=GAUSS',
+    ]
+
+    if predictor and compression in COG_PREDICTOR_COMPRESSION:
+        result.append('PREDICTOR=YES')
+
+    if quality is not None:
+        result.append('QUALITY=%d' % quality)
+
+    return result
+
+
+def is_cog(ds):
+    """ Check if the dataset was written as COG with internal overviews """
+    return ds.GetMetadataItem('LAYOUT', 'IMAGE_STRUCTURE') == 'COG'
+
+
+def translate_cog(src, dst_file, creation_options, dst_srs=None, dst_alpha=False):
+    """ Write raster into a single Cloud Optimized GeoTIFF file with internal
+    overviews in-process, reprojecting it into dst_srs if given """
+
+    if dst_srs is not None:
+        # Warping is done on the fly while COG driver reads the VRT
+        src = gdal.Warp('', src, options=gdal.WarpOptions(
+            format='VRT', dstSRS=dst_srs, dstAlpha=dst_alpha,
+            multithread=True, warpOptions=['NUM_THREADS=ALL_CPUS']))
+
+    ds = gdal.Translate(dst_file, src, options=gdal.TranslateOptions(
+        format='COG', creationOptions=creation_options))
+    if ds is None:
+        raise RuntimeError("Failed to write COG file: {}".format(gdal.GetLastErrorMsg()))
+    ds = None
@@ -0,0 +1,84 @@
+import os
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Lock
+
+from osgeo import gdal, gdalconst
+
+
+__all__ = ['DatasetCache']
+
+
+def _file_signature(filename):
+    # Modification time of the file and its overviews, overviews may be
+    # rebuilt by another process for the same file object.
+    result = []
+    for fn in (filename, filename + '.ovr'):
+        try:
+            stat = os.stat(fn)
+            result.append((stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            result.append(None)
+    return tuple(result)
+
+
+class DatasetCache(object):
+    """ Thread-safe LRU of open read-only GDAL datasets
+
+    GDAL datasets can't be used from multiple threads at the same time, so
+    a dataset is checked out for exclusive use and then returned back to the
+    cache. Several datasets may be open for the same file under concurrent
+    load. Datasets are reopened when the file or its overviews are
+    changed. """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+
+        self._idle = OrderedDict()
+        self._count = 0
+        self._lock = Lock()
+
+    @contextmanager
+    def dataset(self, key, filename):
+        signature = _file_signature(filename)
+
+        ds = None
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle is not None:
+                while len(idle) > 0 and ds is None:
+                    isignature, ids = idle.pop()
+                    self._count -= 1
+                    if isignature == signature:
+                        ds = ids
+                if len(idle) == 0:
+                    del self._idle[key]
+
+        if ds is None:
+            ds = gdal.Open(filename, gdalconst.GA_ReadOnly)
+
+        try:
+            yield ds
+        finally:
+            if ds is not None:
+                self._release(key, signature, ds)
+
+    def _release(self, key, signature, ds):
+        with self._lock:
+            self._idle.setdefault(key, []).append((signature, ds))
+            self._idle.move_to_end(key)
+            self._count += 1
+
+            while self._count > self.maxsize:
+                # Evicted dataset is closed when the last reference is gone
+                okey, oidle = next(iter(self._idle.items()))
+                oidle.pop(0)
+                self._count -= 1
+                if len(oidle) == 0:
+                    del self._idle[okey]
+
+    def invalidate(self, key):
+        with self._lock:
+            idle = self._idle.pop(key, None)
+            if idle is not None:
+                self._count -= len(idle)
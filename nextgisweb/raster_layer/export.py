@@ -0,0 +1,72 @@
+import tempfile
+
+from osgeo import gdal
+
+from ..env import env
+from ..resource import ValidationError, export_job_handler
+from ..spatial_ref_sys import SRS
+
+from .gdaldriver import EXPORT_FORMAT_GDAL
+from .model import RasterLayer
+from .util import _
+
+
+def export_driver(format):
+    if format is None:
+        raise ValidationError(_("Output format is not provided."))
+
+    if format not in EXPORT_FORMAT_GDAL:
+        raise ValidationError(_("Format '%s' is not supported.") % (format,))
+
+    return EXPORT_FORMAT_GDAL[format]
+
+
+def export_raster(resource, srs, driver, bands, path, progress=None):
+    """ Warp raster layer bands into a file of given format and SRS """
+
+    def _callback(complete, message, data):
+        progress(complete)
+        return 1
+
+    def _warp(source_filename):
+        try:
+            gdal.UseExceptions()
+            gdal.Warp(
+                path, source_filename,
+                options=gdal.WarpOptions(
+                    format=driver.name, dstSRS=srs.wkt,
+                    creationOptions=driver.options,
+                    callback=_callback if progress is not None else None,
+                ),
+            )
+        except RuntimeError as e:
+            raise ValidationError(str(e))
+        finally:
+            gdal.DontUseExceptions()
+
+    source_filename = env.raster_layer.workdir_filename(resource.fileobj)
+    if len(bands) != resource.band_count:
+        with tempfile.NamedTemporaryFile(suffix=".tif") as tmp_file:
+            gdal.Translate(tmp_file.name, source_filename, bandList=bands)
+            _warp(tmp_file.name)
+    else:
+        _warp(source_filename)
+
+
+def _export_job_validate(resource, params):
+    export_driver(params.get("format", "GTiff"))
+    if "srs" in params and SRS.filter_by(id=int(params["srs"])).first() is None:
+        raise ValidationError(
+            _("Spatial reference system (ID=%s) not found.") % (params["srs"], ))
+
+
+@export_job_handler(RasterLayer, validate=_export_job_validate)
+def export_job(resource, params, path, progress):
+    srs = SRS.filter_by(id=int(params.get("srs", resource.srs.id))).one()
+    driver = export_driver(params.get("format", "GTiff"))
+    bands = [int(b) for b in params.get("bands", [])]
+
+    export_raster(resource, srs, driver, bands, path, progress=progress)
+
+    filename = "%d.%s" % (resource.id, driver.extension)
+    return filename, driver.mime or "application/octet-stream"
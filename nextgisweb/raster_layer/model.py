@@ -17,12 +17,14 @@ from ..resource import (
     Serializer,
     SerializedProperty as SP,
     SerializedRelationship as SR,
-    ResourceGroup)
+    ResourceGroup,
+    ResourceExportJob)
 from ..resource.exception import ValidationError
 from ..env import env
 from ..layer import SpatialLayerMixin, IBboxLayer
 from ..file_storage import FileObj
 
+from .cog import is_cog, translate_cog
 from .kind_of_data import RasterLayerData
 from .util import _, calc_overviews_levels, COMP_ID
 
@@ -68,6 +70,9 @@ class RasterLayer(Base, Resource, SpatialLayerMixin):
 
     fileobj = orm.relationship(FileObj, cascade='all')
 
+    # Data is changed only by load_file, which outdates export jobs
+    fires_data_change = True
+
     @classmethod
     def check_parent(cls, parent):
         return isinstance(parent, ResourceGroup)
@@ -118,19 +123,28 @@ class RasterLayer(Base, Resource, SpatialLayerMixin):
         fobj = FileObj(component='raster_layer')
 
         dst_file = env.raster_layer.workdir_filename(fobj, makedirs=True)
+        if self.fileobj is not None:
+            env.raster_layer.dataset_cache.invalidate(self.fileobj.uuid)
         self.fileobj = fobj
 
-        if reproject:
-            cmd = ['gdalwarp', '-of', 'GTiff', '-t_srs', 'EPSG:%d' % self.srs.id]
-            if not has_nodata and alpha_band is None:
-                cmd.append('-dstalpha')
+        if env.raster_layer.cog:
+            # Single file with internal overviews written in-process
+            translate_cog(
+                ds, dst_file, env.raster_layer.cog_creation_options,
+                dst_srs='EPSG:%d' % self.srs.id if reproject else None,
+                dst_alpha=not has_nodata and alpha_band is None)
         else:
-            cmd = ['gdal_translate', '-of', 'GTiff']
+            if reproject:
+                cmd = ['gdalwarp', '-of', 'GTiff', '-t_srs', 'EPSG:%d' % self.srs.id]
+                if not has_nodata and alpha_band is None:
+                    cmd.append('-dstalpha')
+            else:
+                cmd = ['gdal_translate', '-of', 'GTiff']
 
-        cmd.extend(('-co', 'COMPRESS=DEFLATE',
-                    '-co', 'TILED=YES',
-                    '-co', 'BIGTIFF=YES', filename, dst_file))
-        subprocess.check_call(cmd)
+            cmd.extend(('-co', 'COMPRESS=DEFLATE',
+                        '-co', 'TILED=YES',
+                        '-co', 'BIGTIFF=YES', filename, dst_file))
+            subprocess.check_call(cmd)
 
         ds = gdal.Open(dst_file, gdalconst.GA_ReadOnly)
 
@@ -139,18 +153,33 @@ class RasterLayer(Base, Resource, SpatialLayerMixin):
         self.ysize = ds.RasterYSize
         self.band_count = ds.RasterCount
 
-        self.build_overview()
+        if not is_cog(ds):
+            self.build_overview()
+        ds = None
+
+        if self.id is not None:
+            ResourceExportJob.outdate(self.id)
 
     def gdal_dataset(self):
         fn = env.raster_layer.workdir_filename(self.fileobj)
         return gdal.Open(fn, gdalconst.GA_ReadOnly)
 
+    def gdal_dataset_cached(self):
+        """ Context manager giving a read-only dataset for exclusive use from
+        the per-process cache of open datasets """
+
+        return env.raster_layer.dataset_cache.dataset(
+            self.fileobj.uuid, env.raster_layer.workdir_filename(self.fileobj))
+
     def build_overview(self, missing_only=False):
         fn = env.raster_layer.workdir_filename(self.fileobj)
         if missing_only and os.path.isfile(fn + '.ovr'):
             return
 
         ds = gdal.Open(fn, gdalconst.GA_ReadOnly)
+        if is_cog(ds):
+            # COG has internal overviews built on creation
+            return
         levels = list(map(str, calc_overviews_levels(ds)))
         ds = None
 
@@ -170,6 +199,8 @@ class RasterLayer(Base, Resource, SpatialLayerMixin):
         env.raster_layer.logger.debug('Building raster overview with command: ' + ' '.join(cmd))
         subprocess.check_call(cmd)
 
+        env.raster_layer.dataset_cache.invalidate(self.fileobj.uuid)
+
     def get_info(self):
         s = super()
         return (s.get_info() if hasattr(s, 'get_info') else ()) + (
@@ -193,16 +224,17 @@ class RasterLayer(Base, Resource, SpatialLayerMixin):
 
         coordTrans = osr.CoordinateTransformation(src_osr, dst_osr)
 
-        ds = self.gdal_dataset()
-        geoTransform = ds.GetGeoTransform()
+        with self.gdal_dataset_cached() as ds:
+            geoTransform = ds.GetGeoTransform()
+            xsize, ysize = ds.RasterXSize, ds.RasterYSize
 
         # ul | ur: upper left | upper right
         # ll | lr: lower left | lower right
         x_ul = geoTransform[0]
         y_ul = geoTransform[3]
 
-        x_lr = x_ul + ds.RasterXSize * geoTransform[1] + ds.RasterYSize * geoTransform[2]
-        y_lr = y_ul + ds.RasterXSize * geoTransform[4] + ds.RasterYSize * geoTransform[5]
+        x_lr = x_ul + xsize * geoTransform[1] + ysize * geoTransform[2]
+        y_lr = y_ul + xsize * geoTransform[4] + ysize * geoTransform[5]
 
         ll = ogr.Geometry(ogr.wkbPoint)
         ll.AddPoint(x_ul, y_lr)
@@ -230,8 +262,10 @@ def estimate_raster_layer_data(resource):
 
     fn = env.raster_layer.workdir_filename(resource.fileobj)
 
-    # Size of source file with overviews
-    size = file_size(fn) + file_size(fn + '.ovr')
+    # Size of source file with overviews, COG has internal overviews
+    size = file_size(fn)
+    if os.path.isfile(fn + '.ovr'):
+        size += file_size(fn + '.ovr')
     return size
 
 
@@ -250,11 +284,11 @@ class _source_attr(SP):
 class _color_interpretation(SP):
 
     def getter(self, srlzr):
-        ds = gdal.OpenEx(env.raster_layer.workdir_filename(srlzr.obj.fileobj))
-        return [
-            COLOR_INTERPRETATION[ds.GetRasterBand(bidx).GetRasterColorInterpretation()]
-            for bidx in range(1, srlzr.obj.band_count + 1)
-        ]
+        with srlzr.obj.gdal_dataset_cached() as ds:
+            return [
+                COLOR_INTERPRETATION[ds.GetRasterBand(bidx).GetRasterColorInterpretation()]
+                for bidx in range(1, srlzr.obj.band_count + 1)
+            ]
 
 
 P_DSS_READ = DataStructureScope.read
@@ -2,9 +2,12 @@ import os.path
 
 import pytest
 
+from osgeo import gdal
+
 from nextgisweb.auth import User
 from nextgisweb.spatial_ref_sys import SRS
 
+from nextgisweb.raster_layer.cog import is_cog
 from nextgisweb.raster_layer.model import RasterLayer
 
 
@@ -34,3 +37,62 @@ def test_load_file(source, band_count, srs_id, ngw_env, ngw_txn, ngw_resource_gr
 
     # Check for raster overviews
     assert os.path.isfile(fn_work + '.ovr')
+
+
+def test_dataset_cache(ngw_env, ngw_txn, ngw_resource_group):
+    res = RasterLayer(
+        parent_id=ngw_resource_group, display_name='test-dataset-cache',
+        owner_user=User.by_keyname('administrator'),
+        srs=SRS.filter_by(id=3857).one(),
+    ).persist()
+
+    res.load_file(os.path.join(
+        os.path.split(__file__)[0], 'data', 'sochi-aster-colorized.tif'), ngw_env)
+
+    with res.gdal_dataset_cached() as ds1:
+        # Dataset in use isn't shared
+        with res.gdal_dataset_cached() as ds2:
+            assert ds2 is not ds1
+        assert ds1.RasterCount == res.band_count
+
+    with res.gdal_dataset_cached() as ds:
+        assert ds is ds1 or ds is ds2
+
+    # Overviews are rebuilt, so the dataset is reopened
+    res.build_overview()
+    with res.gdal_dataset_cached() as ds:
+        assert ds is not ds1 and ds is not ds2
+
+
+@pytest.fixture
+def cog_enabled(ngw_env):
+    value = ngw_env.raster_layer.cog
+    ngw_env.raster_layer.cog = True
+    yield
+    ngw_env.raster_layer.cog = value
+
+
+@pytest.mark.parametrize('source, band_count, srs_id', [
+    ('sochi-aster-colorized.tif', 4, 3857),
+    ('sochi-aster-colorized.tif', 3, 4326),
+])
+def test_load_file_cog(
+    source, band_count, srs_id, cog_enabled, ngw_env, ngw_txn, ngw_resource_group
+):
+    res = RasterLayer(
+        parent_id=ngw_resource_group, display_name='test-cog:{}'.format(source),
+        owner_user=User.by_keyname('administrator'),
+        srs=SRS.filter_by(id=srs_id).one(),
+    ).persist()
+
+    res.load_file(os.path.join(os.path.split(__file__)[0], 'data', source), ngw_env)
+    assert res.band_count == band_count
+
+    fn_work = ngw_env.raster_layer.workdir_filename(res.fileobj)
+    ds = gdal.Open(fn_work)
+    assert is_cog(ds)
+    assert ds.GetRasterBand(1).GetOverviewCount() > 0
+
+    # Internal overviews are used instead of external ones
+    res.build_overview(missing_only=True)
+    assert not os.path.isfile(fn_work + '.ovr')
@@ -1,4 +1,6 @@
-from .model import Base
+import transaction
+
+from .model import Base, RasterMosaic
 from ..component import Component
 
 
@@ -12,3 +14,12 @@ class RasterMosaicComponent(Component):
 
     def workdir_filename(self, fobj, makedirs=False):
         return self.env.file_storage.workdir_filename(self, fobj, makedirs)
+
+    def maintenance(self):
+        super().maintenance()
+
+        self.logger.info("Building missing raster mosaic VRT files")
+        with transaction.manager:
+            for resource in RasterMosaic.filter_by(fileobj_id=None):
+                if len(resource.items) > 0:
+                    resource.build_vrt()
@@ -0,0 +1,10 @@
+/*** {
+    "revision": "5646ea52", "parents": ["2ea56ce5"],
+    "date": "2026-10-18T11:00:00",
+    "message": "Add VRT fileobj column"
+} ***/
+
+ALTER TABLE raster_mosaic ADD COLUMN fileobj_id integer;
+
+ALTER TABLE raster_mosaic ADD CONSTRAINT raster_mosaic_fileobj_id_fkey
+    FOREIGN KEY (fileobj_id) REFERENCES fileobj (id);
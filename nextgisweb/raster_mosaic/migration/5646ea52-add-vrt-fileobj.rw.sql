@@ -0,0 +1,3 @@
+/*** { "revision": "5646ea52" } ***/
+
+ALTER TABLE raster_mosaic DROP COLUMN fileobj_id;
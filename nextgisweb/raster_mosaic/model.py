@@ -1,5 +1,12 @@
 import os.path
+from contextlib import nullcontext
+from threading import Lock
+from xml.etree import ElementTree
+
 import geoalchemy2 as ga
+from cachetools import LRUCache
+from shapely.geometry import box
+from shapely.strtree import STRtree
 from sqlalchemy import func
 from sqlalchemy.ext.orderinglist import ordering_list
 from osgeo import gdal, osr
@@ -19,6 +26,7 @@ from ..resource import (
     Serializer,
     SerializedRelationship as SR,
     SerializedProperty as SP)
+from ..raster_layer.cog import is_cog, translate_cog
 from ..raster_layer.util import calc_overviews_levels
 from ..file_storage import FileObj
 from ..layer import SpatialLayerMixin, IBboxLayer
@@ -28,6 +36,41 @@ Base = declarative_base()
 
 SUPPORTED_DRIVERS = ('GTiff', )
 
+MOSAIC_INDEX_CACHE_SIZE = 256
+
+# Footprint indexes of mosaic VRT files by VRT file object ID, VRT file is
+# replaced on items change, so there is no need to invalidate them.
+_index_cache = LRUCache(maxsize=MOSAIC_INDEX_CACHE_SIZE)
+_index_cache_lock = Lock()
+
+
+class MosaicIndex(object):
+    """ In-memory spatial index of mosaic items footprints in mosaic CRS
+    built from the VRT file """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+        ds = gdal.Open(filename, gdal.GA_ReadOnly)
+        gt = ds.GetGeoTransform()
+        ds = None
+
+        # Every band refers the same sources, so rectangles are deduplicated
+        rects = set()
+        for rect in ElementTree.parse(filename).iter('DstRect'):
+            rects.add(tuple(float(rect.get(a)) for a in (
+                'xOff', 'yOff', 'xSize', 'ySize')))
+
+        self.footprints = [box(
+            gt[0] + x * gt[1], gt[3] + (y + h) * gt[5],
+            gt[0] + (x + w) * gt[1], gt[3] + y * gt[5],
+        ) for x, y, w, h in rects]
+        self.tree = STRtree(self.footprints)
+
+    def intersects(self, extent):
+        # Footprints are rectangles, so bounding box test is exact
+        return len(self.tree.query(box(*extent))) > 0
+
 
 @implementer(IBboxLayer)
 class RasterMosaic(Base, Resource, SpatialLayerMixin):
@@ -36,11 +79,74 @@ class RasterMosaic(Base, Resource, SpatialLayerMixin):
 
     __scope__ = (DataStructureScope, DataScope)
 
+    fileobj_id = db.Column(db.ForeignKey(FileObj.id), nullable=True)
+
+    fileobj = db.relationship(FileObj, cascade='all')
+
     @classmethod
     def check_parent(cls, parent):
         return isinstance(parent, ResourceGroup)
 
+    def build_vrt(self):
+        """ Build VRT file of all mosaic items, it should be rebuilt when
+        mosaic items are changed """
+
+        fnames = [
+            env.raster_mosaic.workdir_filename(item.fileobj)
+            for item in self.items]
+
+        if len(fnames) == 0:
+            self.fileobj = None
+            return
+
+        self.fileobj = env.file_storage.fileobj(component='raster_mosaic')
+        dst_file = env.raster_mosaic.workdir_filename(self.fileobj, makedirs=True)
+
+        # Later items are drawn over earlier ones like in item order
+        ds = gdal.BuildVRT(
+            dst_file, fnames,
+            options=gdal.BuildVRTOptions(resolution='highest'))
+        if ds is None:
+            raise ValidationError(_("Unable to build mosaic of the items."))
+        ds = None
+
+    def mosaic_index(self):
+        """ Footprint index of the mosaic VRT file or None if it isn't built """
+
+        if self.fileobj_id is None:
+            return None
+
+        with _index_cache_lock:
+            index = _index_cache.get(self.fileobj_id)
+
+        if index is None:
+            index = MosaicIndex(env.raster_mosaic.workdir_filename(self.fileobj))
+            with _index_cache_lock:
+                _index_cache[self.fileobj_id] = index
+
+        return index
+
+    def gdal_dataset_cached(self, extent, size):
+        """ Context manager giving a read-only dataset for exclusive use
+        from the per-process cache or None if there is no data in extent """
+
+        index = self.mosaic_index()
+        if index is None:
+            # VRT isn't built yet, see RasterMosaicComponent.maintenance
+            return nullcontext(self.gdal_dataset(extent=extent, size=size))
+
+        if not index.intersects(extent):
+            return nullcontext(None)
+
+        return env.raster_layer.dataset_cache.dataset(index.filename, index.filename)
+
     def gdal_dataset(self, extent=None, size=None):
+        index = self.mosaic_index()
+        if index is not None:
+            if extent is None or index.intersects(extent):
+                return gdal.Open(index.filename, gdal.GA_ReadOnly)
+            return None
+
         if extent is not None and size is not None:
             xmin, ymin, xmax, ymax = extent
             width, height = size
@@ -170,6 +276,15 @@ class RasterMosaicItem(Base):
         self.fileobj = env.file_storage.fileobj(component='raster_mosaic')
 
         dst_file = env.raster_mosaic.workdir_filename(self.fileobj, makedirs=True)
+
+        if env.raster_layer.cog:
+            # Single file with internal overviews
+            translate_cog(
+                ds, dst_file, env.raster_layer.cog_creation_options,
+                dst_srs='EPSG:%d' % self.resource.srs.id if reproject else None,
+                dst_alpha=not has_nodata and alpha_band is None)
+            return
+
         co = ['COMPRESS=DEFLATE', 'TILED=YES', 'BIGTIFF=YES']
         if reproject:
             gdal.Warp(
@@ -199,6 +314,12 @@ class RasterMosaicItem(Base):
         if missing_only and os.path.isfile(fn + '.ovr'):
             return
 
+        ds = gdal.Open(fn, gdal.GA_ReadOnly)
+        if is_cog(ds):
+            # COG has internal overviews built on creation
+            return
+        ds = None
+
         # cleaning overviews
         ds = gdal.Open(fn, gdal.GA_Update)
         ds.BuildOverviews(overviewlist=[])
@@ -244,6 +365,8 @@ class _items_attr(SP):
                     mitem.display_name = item['display_name']
             srlzr.obj.items.append(mitem)
 
+        srlzr.obj.build_vrt()
+
 
 P_DSS_READ = DataStructureScope.read
 P_DSS_WRITE = DataStructureScope.write
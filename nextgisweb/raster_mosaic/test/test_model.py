@@ -0,0 +1,110 @@
+from pathlib import Path
+from xml.etree import ElementTree
+
+import pytest
+from osgeo import gdal
+
+from nextgisweb.auth import User
+from nextgisweb.models import DBSession
+from nextgisweb.spatial_ref_sys import SRS
+
+from nextgisweb.raster_mosaic.model import RasterMosaic, RasterMosaicItem
+
+import nextgisweb.raster_layer.test
+DATA = Path(nextgisweb.raster_layer.test.__file__).parent / 'data'
+
+
+@pytest.fixture
+def mosaic(ngw_env, ngw_txn, ngw_resource_group):
+    return RasterMosaic(
+        parent_id=ngw_resource_group, display_name='test-raster-mosaic',
+        owner_user=User.by_keyname('administrator'),
+        srs=SRS.filter_by(id=3857).one(),
+    ).persist()
+
+
+def _add_item(mosaic, env, display_name):
+    item = RasterMosaicItem(resource=mosaic, display_name=display_name)
+    item.load_file(str(DATA / 'sochi-aster-colorized.tif'), env)
+    return item
+
+
+def _vrt_sources(env, mosaic):
+    vrt = ElementTree.parse(env.raster_mosaic.workdir_filename(mosaic.fileobj))
+    return set(e.text for e in vrt.iter('SourceFilename'))
+
+
+def _data_extent(env, item):
+    ds = gdal.Open(env.raster_mosaic.workdir_filename(item.fileobj))
+    gt = ds.GetGeoTransform()
+    return (
+        gt[0], gt[3] + ds.RasterYSize * gt[5],
+        gt[0] + ds.RasterXSize * gt[1], gt[3])
+
+
+def test_build_vrt(mosaic, ngw_env):
+    item1 = _add_item(mosaic, ngw_env, 'item1')
+    mosaic.build_vrt()
+    DBSession.flush()
+
+    fileobj_id = mosaic.fileobj_id
+    assert fileobj_id is not None
+    assert len(_vrt_sources(ngw_env, mosaic)) == 1
+
+    # New VRT file is written on items change
+    _add_item(mosaic, ngw_env, 'item2')
+    mosaic.build_vrt()
+    DBSession.flush()
+
+    assert mosaic.fileobj_id != fileobj_id
+    assert len(_vrt_sources(ngw_env, mosaic)) == 2
+
+    extent = _data_extent(ngw_env, item1)
+    assert mosaic.mosaic_index().intersects(extent)
+
+    mosaic.items = []
+    mosaic.build_vrt()
+    DBSession.flush()
+
+    assert mosaic.fileobj_id is None
+    assert mosaic.mosaic_index() is None
+
+
+def test_empty_extent(mosaic, ngw_env):
+    item = _add_item(mosaic, ngw_env, 'item')
+    mosaic.build_vrt()
+    DBSession.flush()
+
+    index = mosaic.mosaic_index()
+    extent = _data_extent(ngw_env, item)
+
+    with mosaic.gdal_dataset_cached(extent, (256, 256)) as ds:
+        assert ds is not None
+
+    # Extent next to the data doesn't reach the dataset
+    width = extent[2] - extent[0]
+    outside = (extent[2] + width, extent[1], extent[2] + 2 * width, extent[3])
+    assert not index.intersects(outside)
+
+    with mosaic.gdal_dataset_cached(outside, (256, 256)) as ds:
+        assert ds is None
+
+
+def test_fallback(mosaic, ngw_env):
+    item = _add_item(mosaic, ngw_env, 'item')
+    DBSession.flush()
+
+    # Mosaics created before VRT index have no VRT until maintenance
+    assert mosaic.fileobj_id is None
+    assert mosaic.mosaic_index() is None
+
+    extent = _data_extent(ngw_env, item)
+    with mosaic.gdal_dataset_cached(extent, (256, 256)) as ds:
+        assert ds is not None
+        assert ds.RasterCount >= 3
+
+    mosaic.build_vrt()
+    DBSession.flush()
+
+    with mosaic.gdal_dataset_cached(extent, (256, 256)) as ds:
+        assert ds.GetDescription() == mosaic.mosaic_index().filename
@@ -0,0 +1,99 @@
+import re
+
+import numpy
+
+__all__ = [
+    'parse_color',
+    'default_ramp',
+    'stretch',
+    'color_ramp',
+    'hillshade',
+]
+
+COLOR_RE = re.compile(r'^#([0-9a-f]{6}|[0-9a-f]{8})$', re.IGNORECASE)
+
+# Colors of default ramp from minimum to maximum value
+DEFAULT_RAMP_COLORS = (
+    '#2b83ba', '#abdda4', '#ffffbf', '#fdae61', '#d7191c')
+
+
+def parse_color(value):
+    """ Parse #RRGGBB or #RRGGBBAA color into (r, g, b, a) tuple """
+
+    if not isinstance(value, str) or not COLOR_RE.match(value):
+        raise ValueError("Invalid color: {}".format(value))
+
+    hexstr = value[1:] + ('ff' if len(value) == 7 else '')
+    return tuple(int(hexstr[i:i + 2], 16) for i in range(0, 8, 2))
+
+
+def default_ramp(vmin, vmax):
+    """ Color ramp stops evenly distributed between minimum and maximum """
+
+    count = len(DEFAULT_RAMP_COLORS)
+    return [
+        dict(value=vmin + (vmax - vmin) * i / (count - 1), color=color)
+        for i, color in enumerate(DEFAULT_RAMP_COLORS)]
+
+
+def _rgba(shape):
+    return numpy.zeros(shape + (4, ), numpy.uint8)
+
+
+def stretch(values, valid, vmin, vmax):
+    """ Grayscale image of values linearly stretched from vmin to vmax """
+
+    scale = 255 / (vmax - vmin) if vmax > vmin else 0
+    gray = numpy.clip((numpy.where(valid, values, vmin) - vmin) * scale, 0, 255)
+
+    result = _rgba(values.shape)
+    result[:, :, :3] = gray[:, :, numpy.newaxis]
+    result[:, :, 3] = numpy.where(valid, 255, 0)
+    return result
+
+
+def color_ramp(values, valid, stops):
+    """ Image of values colored by linear interpolation between ramp stops,
+    values outside the ramp get colors of its ends. Stops with the same
+    value give a step, so they can be used for classified color maps. """
+
+    stops = sorted(stops, key=lambda s: s['value'])
+    xp = [s['value'] for s in stops]
+    colors = numpy.array([parse_color(s['color']) for s in stops], numpy.float64)
+
+    data = numpy.where(valid, values, xp[0])
+
+    result = _rgba(values.shape)
+    for c in range(4):
+        result[:, :, c] = numpy.interp(data, xp, colors[:, c])
+    result[:, :, 3] *= valid
+    return result
+
+
+def hillshade(values, valid, xres, yres, azimuth=315, altitude=45, z_factor=1):
+    """ Grayscale hillshade of elevation values. Pixel size is given in
+    units of elevation divided by z_factor. """
+
+    data = numpy.where(valid, values, numpy.nan) * z_factor
+
+    # Rows go from north to south
+    dzdy, dzdx = numpy.gradient(data, yres, xres)
+
+    slope = numpy.arctan(numpy.hypot(dzdx, dzdy))
+    aspect = numpy.arctan2(dzdy, -dzdx)
+
+    zenith = numpy.radians(90 - altitude)
+    azimuth = numpy.radians((450 - azimuth) % 360)
+
+    shade = (
+        numpy.cos(zenith) * numpy.cos(slope)
+        + numpy.sin(zenith) * numpy.sin(slope) * numpy.cos(azimuth - aspect))
+
+    # Gradient is undefined next to missing values
+    defined = numpy.isfinite(shade)
+    gray = numpy.clip(numpy.where(defined, shade, 0) * 255, 0, 255)
+
+    result = _rgba(values.shape)
+    result[:, :, :3] = gray[:, :, numpy.newaxis]
+    result[:, :, 3] = numpy.where(valid & defined, 255, 0)
+    return result
@@ -0,0 +1,11 @@
+/*** {
+    "revision": "56472100", "parents": ["00000000"],
+    "date": "2026-10-18T12:00:00",
+    "message": "Add render mode columns"
+} ***/
+
+ALTER TABLE raster_style ADD COLUMN render_mode character varying;
+ALTER TABLE raster_style ADD COLUMN band integer;
+ALTER TABLE raster_style ADD COLUMN min_value double precision;
+ALTER TABLE raster_style ADD COLUMN max_value double precision;
+ALTER TABLE raster_style ADD COLUMN color_ramp character varying;
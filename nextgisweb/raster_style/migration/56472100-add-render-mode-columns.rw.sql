@@ -0,0 +1,7 @@
+/*** { "revision": "56472100" } ***/
+
+ALTER TABLE raster_style DROP COLUMN color_ramp;
+ALTER TABLE raster_style DROP COLUMN max_value;
+ALTER TABLE raster_style DROP COLUMN min_value;
+ALTER TABLE raster_style DROP COLUMN band;
+ALTER TABLE raster_style DROP COLUMN render_mode;
@@ -1,23 +1,205 @@
 from io import BytesIO
+from threading import Lock
 
 import numpy
 import PIL
+from cachetools import LRUCache
 from osgeo import gdal, gdalconst, gdal_array
 from pkg_resources import resource_filename
 from zope.interface import implementer
 
+from .. import db
 from ..models import declarative_base
-from ..resource import Resource, DataScope
+from ..resource import (
+    Resource,
+    DataScope,
+    Serializer,
+    SerializedProperty as SP,
+    ValidationError)
 from ..render import (
     IRenderableStyle,
     ILegendableStyle,
     IExtentRenderRequest,
     ITileRenderRequest)
 
+from .colorize import color_ramp, default_ramp, hillshade, parse_color, stretch
 from .util import _
 
 Base = declarative_base(dependencies=('resource', ))
 
+# Maximum shift in output pixels caused by rounding of the source window to
+# whole pixels, requests with larger shift are warped
+WINDOW_ROUNDING_TOLERANCE = 0.5
+
+RENDER_MODE = ('rgb', 'stretch', 'hillshade', 'color_ramp')
+
+# Approximate value ranges of raster bands by (filename, band)
+_band_min_max_cache = LRUCache(maxsize=1024)
+_band_min_max_lock = Lock()
+
+# Length of a degree for hillshade of rasters in geographic CRS
+METERS_PER_DEGREE = 111320
+
+
+def _direct_window(ds, extent, size):
+    """ Source window of extent given in dataset CRS and its position in the
+    output image as ((xoff, yoff, xsize, ysize), (dx, dy, dw, dh)) tuple.
+    Returns None if the request should be warped and an empty tuple if the
+    extent doesn't intersect the raster. """
+
+    gt = ds.GetGeoTransform()
+    if gt[2] != 0 or gt[4] != 0:
+        return None
+
+    width, height = size
+
+    # Requested extent in source pixels
+    px0 = (extent[0] - gt[0]) / gt[1]
+    px1 = (extent[2] - gt[0]) / gt[1]
+    py0 = (extent[3] - gt[3]) / gt[5]
+    py1 = (extent[1] - gt[3]) / gt[5]
+
+    # Output pixels per source pixel
+    sx = width / (px1 - px0)
+    sy = height / (py1 - py0)
+
+    # Source window clipped by raster bounds and rounded to whole pixels
+    cx0, cx1 = (min(max(v, 0), ds.RasterXSize) for v in (px0, px1))
+    cy0, cy1 = (min(max(v, 0), ds.RasterYSize) for v in (py0, py1))
+    wx0, wx1, wy0, wy1 = (int(round(v)) for v in (cx0, cx1, cy0, cy1))
+
+    error = max(
+        abs(wx0 - cx0) * sx, abs(wx1 - cx1) * sx,
+        abs(wy0 - cy0) * sy, abs(wy1 - cy1) * sy)
+    if error > WINDOW_ROUNDING_TOLERANCE:
+        return None
+
+    # Position of the window in the output image
+    dx0, dx1 = (int(round((v - px0) * sx)) for v in (wx0, wx1))
+    dy0, dy1 = (int(round((v - py0) * sy)) for v in (wy0, wy1))
+    dx0, dx1 = max(dx0, 0), min(dx1, width)
+    dy0, dy1 = max(dy0, 0), min(dy1, height)
+
+    if wx1 <= wx0 or wy1 <= wy0 or dx1 <= dx0 or dy1 <= dy0:
+        return ()
+
+    return (
+        (wx0, wy0, wx1 - wx0, wy1 - wy0),
+        (dx0, dy0, dx1 - dx0, dy1 - dy0))
+
+
+def _read_direct(ds, extent, size):
+    """ Read RGBA image of extent given in dataset CRS directly from dataset
+    or its overviews with a single read of color bands. GDAL selects the
+    overview level matching output resolution itself. Returns None if the
+    request can't be served without warping. """
+
+    color_bands = []
+    for bidx in range(1, ds.RasterCount + 1):
+        band = ds.GetRasterBand(bidx)
+        if band.DataType != gdalconst.GDT_Byte:
+            return None
+        if band.GetRasterColorInterpretation() != gdalconst.GCI_AlphaBand:
+            color_bands.append(band)
+
+    if len(color_bands) != 3:
+        return None
+
+    placement = _direct_window(ds, extent, size)
+    if placement is None:
+        return None
+
+    width, height = size
+    result = numpy.zeros((height, width, 4), numpy.uint8)
+    if len(placement) == 0:
+        return result
+
+    window, (dx0, dy0, dw, dh) = placement
+    dx1, dy1 = dx0 + dw, dy0 + dh
+
+    # Pixel interleaved buffer matches the layout of the output array
+    data = ds.ReadRaster(
+        *window, buf_xsize=dw, buf_ysize=dh,
+        band_list=[band.GetBand() for band in color_bands],
+        buf_pixel_space=3, buf_line_space=3 * dw, buf_band_space=1)
+    rgb = numpy.frombuffer(data, numpy.uint8).reshape(dh, dw, 3)
+
+    # Transparency is derived from alpha band, dataset mask or nodata values
+    # same way as warping with UNIFIED_SRC_NODATA does
+    mask_flags = color_bands[0].GetMaskFlags()
+    if mask_flags & gdalconst.GMF_PER_DATASET and not mask_flags & gdalconst.GMF_ALL_VALID:
+        alpha = color_bands[0].GetMaskBand().ReadAsArray(
+            *window, buf_xsize=dw, buf_ysize=dh)
+    elif all(band.GetNoDataValue() is not None for band in color_bands):
+        nodata = numpy.ones((dh, dw), bool)
+        for i, band in enumerate(color_bands):
+            nodata &= rgb[:, :, i] == band.GetNoDataValue()
+        alpha = numpy.where(nodata, 0, 255)
+    else:
+        alpha = 255
+
+    result[dy0:dy1, dx0:dx1, :3] = rgb
+    result[dy0:dy1, dx0:dx1, 3] = alpha
+
+    return result
+
+
+def _read_band(ds, bidx, extent, size):
+    """ Read values of a single band in extent given in dataset CRS as float
+    array with a mask of valid values, it's read directly if possible """
+
+    width, height = size
+    values = numpy.zeros((height, width), numpy.float64)
+    valid = numpy.zeros((height, width), bool)
+
+    placement = _direct_window(ds, extent, size)
+    if placement is not None:
+        if len(placement) == 0:
+            return values, valid
+
+        window, (dx0, dy0, dw, dh) = placement
+        band = ds.GetRasterBand(bidx)
+        values[dy0:dy0 + dh, dx0:dx0 + dw] = band.ReadAsArray(
+            *window, buf_xsize=dw, buf_ysize=dh)
+
+        # Mask covers nodata value, alpha band and internal masks
+        if band.GetMaskFlags() & gdalconst.GMF_ALL_VALID:
+            valid[dy0:dy0 + dh, dx0:dx0 + dw] = True
+        else:
+            valid[dy0:dy0 + dh, dx0:dx0 + dw] = band.GetMaskBand().ReadAsArray(
+                *window, buf_xsize=dw, buf_ysize=dh) > 0
+    else:
+        src = gdal.Translate('', ds, options=gdal.TranslateOptions(
+            format='VRT', bandList=[bidx]))
+        wds = gdal.Warp('', src, options=gdal.WarpOptions(
+            width=width, height=height, outputBounds=extent, format='MEM',
+            dstAlpha=True))
+        values[:] = wds.GetRasterBand(1).ReadAsArray()
+        valid[:] = wds.GetRasterBand(2).ReadAsArray() > 0
+
+    valid &= numpy.isfinite(values)
+    return values, valid
+
+
+def _band_min_max(ds, bidx):
+    """ Approximate minimum and maximum of band values computed on overviews
+
+    Values are cached by file name, files of raster layers and mosaic VRTs
+    are replaced on data change. Statistics aren't stored in GDAL PAM as it
+    would write .aux.xml files into file storage. """
+
+    key = (ds.GetDescription(), bidx)
+    with _band_min_max_lock:
+        result = _band_min_max_cache.get(key) if key[0] != '' else None
+
+    if result is None:
+        result = tuple(ds.GetRasterBand(bidx).ComputeRasterMinMax(True))
+        if key[0] != '':
+            with _band_min_max_lock:
+                _band_min_max_cache[key] = result
+
+    return result
+
 
 @implementer(IExtentRenderRequest, ITileRenderRequest)
 class RenderRequest(object):
@@ -42,15 +224,31 @@ class RasterStyle(Base, Resource):
 
     __scope__ = DataScope
 
-    # Only RGB, RGBA rasters are supported.
+    render_mode = db.Column(db.Unicode, nullable=True)
+    band = db.Column(db.Integer, nullable=True)
+    min_value = db.Column(db.Float, nullable=True)
+    max_value = db.Column(db.Float, nullable=True)
+    color_ramp = db.Column(db.JSONText, nullable=True)
+
     @classmethod
     def check_parent(cls, parent):
+        return parent.cls in ("raster_layer", "raster_mosaic")
+
+    @classmethod
+    def rgb_supported(cls, parent):
+        # Only RGB, RGBA rasters can be rendered as is
         return (
             parent.cls == "raster_layer"
             and parent.band_count in (3, 4)
             and parent.dtype in (gdal.GetDataTypeName(gdalconst.GDT_Byte),)
         ) or parent.cls == "raster_mosaic"
 
+    @property
+    def effective_render_mode(self):
+        if self.render_mode is not None:
+            return self.render_mode
+        return 'rgb' if self.rgb_supported(self.parent) else 'stretch'
+
     @property
     def srs(self):
         return self.parent.srs
@@ -61,21 +259,35 @@ class RasterStyle(Base, Resource):
     def render_image(self, extent, size):
         result = PIL.Image.new("RGBA", size, (0, 0, 0, 0))
 
+        # Open datasets are reused between requests to keep GDAL block cache
         if self.parent.cls == "raster_layer":
-            parent_ds = self.parent.gdal_dataset()
+            parent_dataset = self.parent.gdal_dataset_cached()
         elif self.parent.cls == "raster_mosaic":
-            parent_ds = self.parent.gdal_dataset(extent=extent, size=size)
+            parent_dataset = self.parent.gdal_dataset_cached(extent=extent, size=size)
 
-        if parent_ds is None:
-            return result
+        with parent_dataset as parent_ds:
+            if parent_ds is None:
+                return result
 
-        ds = gdal.Warp(
-            "", parent_ds,
-            options=gdal.WarpOptions(
-                width=size[0], height=size[1], outputBounds=extent, format="MEM",
-                warpOptions=['UNIFIED_SRC_NODATA=ON'], dstAlpha=True,
-            ),
-        )
+            render_mode = self.effective_render_mode
+            if render_mode != 'rgb':
+                array = self._render_band(parent_ds, render_mode, extent, size)
+                return PIL.Image.fromarray(array, 'RGBA')
+
+            # Rendering extent is in the layer CRS same as the data, so it's
+            # read directly unless the raster grid is rotated or the extent
+            # isn't aligned to source pixels well enough.
+            array = _read_direct(parent_ds, extent, size)
+            if array is not None:
+                return PIL.Image.fromarray(array, 'RGBA')
+
+            ds = gdal.Warp(
+                "", parent_ds,
+                options=gdal.WarpOptions(
+                    width=size[0], height=size[1], outputBounds=extent, format="MEM",
+                    warpOptions=['UNIFIED_SRC_NODATA=ON'], dstAlpha=True,
+                ),
+            )
 
         band_count = ds.RasterCount
         array = numpy.zeros((size[1], size[0], band_count), numpy.uint8)
@@ -84,12 +296,44 @@ class RasterStyle(Base, Resource):
             array[:, :, i] = gdal_array.BandReadAsArray(ds.GetRasterBand(i + 1),)
 
         ds = None
-        parent_ds = None
         wnd = PIL.Image.fromarray(array)
         result.paste(wnd)
 
         return result
 
+    def _render_band(self, ds, render_mode, extent, size):
+        bidx = self.band if self.band is not None else 1
+        if bidx > ds.RasterCount:
+            return numpy.zeros((size[1], size[0], 4), numpy.uint8)
+
+        if render_mode == 'hillshade':
+            # Gradient at the edges needs neighbour pixels, so the window is
+            # read with one pixel buffer to avoid seams between tiles.
+            xres = (extent[2] - extent[0]) / size[0]
+            yres = (extent[3] - extent[1]) / size[1]
+            values, valid = _read_band(ds, bidx, (
+                extent[0] - xres, extent[1] - yres,
+                extent[2] + xres, extent[3] + yres,
+            ), (size[0] + 2, size[1] + 2))
+
+            z_factor = 1 / METERS_PER_DEGREE if self.srs.is_geographic else 1
+            result = hillshade(values, valid, xres, yres, z_factor=z_factor)
+            return numpy.ascontiguousarray(result[1:-1, 1:-1])
+
+        values, valid = _read_band(ds, bidx, extent, size)
+
+        vmin, vmax = self.min_value, self.max_value
+        if vmin is None or vmax is None:
+            smin, smax = _band_min_max(ds, bidx)
+            vmin = smin if vmin is None else vmin
+            vmax = smax if vmax is None else vmax
+
+        if render_mode == 'stretch':
+            return stretch(values, valid, vmin, vmax)
+
+        stops = self.color_ramp if self.color_ramp else default_ramp(vmin, vmax)
+        return color_ramp(values, valid, stops)
+
     def render_legend(self):
         # Don't use real preview of raster layer as icon
         # because it may be slow
@@ -101,3 +345,61 @@ class RasterStyle(Base, Resource):
         buf.seek(0)
 
         return buf
+
+
+class _render_mode_attr(SP):
+
+    def setter(self, srlzr, value):
+        if value is not None:
+            if value not in RENDER_MODE:
+                raise ValidationError(_("Invalid render mode."))
+            if value == 'rgb' and not RasterStyle.rgb_supported(srlzr.obj.parent):
+                raise ValidationError(_("Only RGB and RGBA rasters can be rendered in RGB mode."))
+
+        super().setter(srlzr, value)
+
+
+class _band_attr(SP):
+
+    def setter(self, srlzr, value):
+        if value is not None:
+            parent = srlzr.obj.parent
+
+            # Mosaic items are RGB or RGBA rasters, so mosaic has at least
+            # three bands and the alpha band isn't rendered
+            band_count = parent.band_count if parent.cls == "raster_layer" else 3
+            if not isinstance(value, int) or value < 1 or value > band_count:
+                raise ValidationError(_("Invalid band number."))
+
+        super().setter(srlzr, value)
+
+
+class _color_ramp_attr(SP):
+
+    def setter(self, srlzr, value):
+        if value is not None:
+            try:
+                if not isinstance(value, list) or len(value) == 0:
+                    raise ValueError
+                stops = []
+                for stop in value:
+                    parse_color(stop['color'])
+                    stops.append(dict(value=float(stop['value']), color=stop['color']))
+                value = stops
+            except (ValueError, TypeError, KeyError):
+                raise ValidationError(_("Invalid color ramp."))
+
+        super().setter(srlzr, value)
+
+
+class RasterStyleSerializer(Serializer):
+    identity = RasterStyle.identity
+    resclass = RasterStyle
+
+    _defaults = dict(read=DataScope.read, write=DataScope.write)
+
+    render_mode = _render_mode_attr(**_defaults)
+    band = _band_attr(**_defaults)
+    min_value = SP(**_defaults)
+    max_value = SP(**_defaults)
+    color_ramp = _color_ramp_attr(**_defaults)
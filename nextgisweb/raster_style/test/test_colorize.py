@@ -0,0 +1,56 @@
+import numpy
+import pytest
+
+from nextgisweb.raster_style.colorize import (
+    color_ramp, default_ramp, hillshade, parse_color, stretch)
+
+
+def test_parse_color():
+    assert parse_color('#ff0080') == (255, 0, 128, 255)
+    assert parse_color('#FF008040') == (255, 0, 128, 64)
+    with pytest.raises(ValueError):
+        parse_color('red')
+
+
+def test_stretch():
+    values = numpy.array([[0, 5, 10, 20]], numpy.float64)
+    valid = numpy.array([[True, True, True, False]])
+
+    result = stretch(values, valid, 0, 10)
+    assert result[0, :3, 0].tolist() == [0, 127, 255]
+    assert result[0, :, 3].tolist() == [255, 255, 255, 0]
+
+
+def test_color_ramp():
+    values = numpy.array([[-1, 0, 5, 10, 11]], numpy.float64)
+    valid = numpy.ones(values.shape, bool)
+    stops = [
+        dict(value=10, color='#ff0000'),
+        dict(value=0, color='#0000ff'),
+    ]
+
+    result = color_ramp(values, valid, stops)
+    assert result[0, 0].tolist() == [0, 0, 255, 255]
+    assert result[0, 2].tolist() == [127, 0, 127, 255]
+    assert result[0, 4].tolist() == [255, 0, 0, 255]
+
+    ramp = default_ramp(0, 100)
+    assert ramp[0]['value'] == 0 and ramp[-1]['value'] == 100
+
+
+def test_hillshade():
+    # With light from north-west, slopes facing east are darker than flat
+    # surface and slopes facing west are lighter
+    y, x = numpy.mgrid[0:8, 0:8]
+    valid = numpy.ones((8, 8), bool)
+
+    flat = hillshade(numpy.zeros((8, 8)), valid, 1, 1)
+    east = hillshade(-x.astype(float), valid, 1, 1)
+    west = hillshade(x.astype(float), valid, 1, 1)
+    assert (east[:, :, 0] < flat[:, :, 0]).all()
+    assert (west[:, :, 0] > flat[:, :, 0]).all()
+
+    # Values next to invalid ones are transparent
+    valid[4, 4] = False
+    result = hillshade(x.astype(float), valid, 1, 1)
+    assert result[4, 4, 3] == 0 and result[4, 3, 3] == 0 and result[0, 0, 3] == 255
@@ -0,0 +1,143 @@
+from pathlib import Path
+
+import numpy
+import pytest
+from osgeo import gdal
+
+from nextgisweb.auth import User
+from nextgisweb.raster_layer import RasterLayer
+from nextgisweb.raster_style import RasterStyle
+from nextgisweb.raster_style.models import _read_direct
+from nextgisweb.spatial_ref_sys import SRS
+
+
+@pytest.fixture
+def rstyle(ngw_env, ngw_txn, ngw_resource_group):
+    layer = RasterLayer(
+        parent_id=ngw_resource_group, display_name='test-render-rlayer',
+        owner_user=User.by_keyname('administrator'),
+        srs=SRS.filter_by(id=3857).one(),
+    ).persist()
+
+    import nextgisweb.raster_layer.test
+    path = Path(nextgisweb.raster_layer.test.__file__).parent / 'data/sochi-aster-colorized.tif'
+    layer.load_file(str(path), ngw_env)
+
+    return RasterStyle(
+        parent=layer, display_name='test-render-rstyle',
+        owner_user=User.by_keyname('administrator'),
+    ).persist()
+
+
+def _warp(ds, extent, size):
+    wds = gdal.Warp('', ds, options=gdal.WarpOptions(
+        width=size[0], height=size[1], outputBounds=extent, format='MEM',
+        warpOptions=['UNIFIED_SRC_NODATA=ON'], dstAlpha=True))
+    return numpy.dstack([
+        wds.GetRasterBand(i + 1).ReadAsArray()
+        for i in range(wds.RasterCount)])
+
+
+@pytest.mark.parametrize('scale, shift', (
+    (1, (0, 0)),
+    (4, (0, 0)),
+    (2, (-0.25, 0.5)),
+))
+def test_read_direct(scale, shift, rstyle):
+    with rstyle.parent.gdal_dataset_cached() as ds:
+        gt = ds.GetGeoTransform()
+        xsize, ysize = ds.RasterXSize, ds.RasterYSize
+
+        # Extent aligned to source pixels, partially outside of the raster
+        width, height = xsize // scale, ysize // scale
+        minx = gt[0] + shift[0] * xsize * gt[1]
+        maxy = gt[3] + shift[1] * ysize * gt[5]
+        extent = (
+            minx, maxy + height * scale * gt[5],
+            minx + width * scale * gt[1], maxy)
+
+        direct = _read_direct(ds, extent, (width, height))
+        assert direct is not None
+
+        warped = _warp(ds, extent, (width, height))
+
+    assert direct.shape == warped.shape
+    assert (direct[:, :, 3] != warped[:, :, 3]).mean() < 0.01
+
+    # Overview levels used by warping and direct reads may differ
+    diff = numpy.abs(direct.astype(float) - warped.astype(float))
+    assert diff.mean() < 8
+
+    image = rstyle.render_image(extent, (width, height))
+    assert image.size == (width, height)
+
+
+@pytest.fixture
+def dem_layer(ngw_env, ngw_txn, ngw_resource_group):
+    layer = RasterLayer(
+        parent_id=ngw_resource_group, display_name='test-render-dem',
+        owner_user=User.by_keyname('administrator'),
+        srs=SRS.filter_by(id=3857).one(),
+    ).persist()
+
+    import nextgisweb.raster_layer.test
+    path = Path(nextgisweb.raster_layer.test.__file__).parent / 'data/sochi-aster-dem.tif'
+    layer.load_file(str(path), ngw_env)
+    return layer
+
+
+@pytest.mark.parametrize('render_mode, color_ramp', (
+    (None, None),
+    ('stretch', None),
+    ('hillshade', None),
+    ('color_ramp', None),
+    ('color_ramp', [dict(value=0, color='#0000ff'), dict(value=500, color='#ff0000')]),
+))
+def test_render_band(render_mode, color_ramp, dem_layer):
+    style = RasterStyle(
+        parent=dem_layer, display_name='test-render-dem-style',
+        owner_user=User.by_keyname('administrator'),
+        render_mode=render_mode, color_ramp=color_ramp,
+    ).persist()
+    assert style.effective_render_mode == (render_mode or 'stretch')
+
+    with dem_layer.gdal_dataset_cached() as ds:
+        gt = ds.GetGeoTransform()
+        xsize, ysize = ds.RasterXSize, ds.RasterYSize
+
+    extent = (gt[0], gt[3] + ysize * gt[5], gt[0] + xsize * gt[1], gt[3])
+    size = (xsize // 2, ysize // 2)
+
+    array = numpy.asarray(style.render_image(extent, size))
+    assert array.shape == (size[1], size[0], 4)
+
+    assert (array[:, :, 3] == 255).any()
+    assert array[:, :, :3].std() > 0
+
+
+def test_hillshade_seams(dem_layer):
+    style = RasterStyle(
+        parent=dem_layer, display_name='test-render-dem-hillshade',
+        owner_user=User.by_keyname('administrator'),
+        render_mode='hillshade',
+    ).persist()
+
+    with dem_layer.gdal_dataset_cached() as ds:
+        gt = ds.GetGeoTransform()
+        xsize, ysize = ds.RasterXSize, ds.RasterYSize
+
+    # Two halves of the extent inside the raster rendered separately
+    # should be the same as the whole one
+    width, height = xsize // 2, ysize // 2
+    minx, maxy = gt[0] + width // 2 * gt[1], gt[3] + height // 2 * gt[5]
+    midx, miny = minx + width // 2 * gt[1], maxy + height * gt[5]
+    maxx = midx + width // 2 * gt[1]
+
+    whole = numpy.asarray(style.render_image(
+        (minx, miny, maxx, maxy), (width // 2 * 2, height)))
+    left = numpy.asarray(style.render_image(
+        (minx, miny, midx, maxy), (width // 2, height)))
+    right = numpy.asarray(style.render_image(
+        (midx, miny, maxx, maxy), (width // 2, height)))
+
+    assert (numpy.hstack((left, right)) == whole).all()
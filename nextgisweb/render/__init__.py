@@ -1,7 +1,9 @@
 import os
 import os.path
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
+from threading import BoundedSemaphore
 
 import sqlalchemy as sa
 import transaction
@@ -20,7 +22,15 @@ from .interface import (
     ITileRenderRequest,
     ILegendableStyle,
 )
-from .model import Base, ResourceTileCache as RTC, TIMESTAMP_EPOCH
+from .model import (
+    Base,
+    ResourceTileCache as RTC,
+    TileMemoryCache,
+    TIMESTAMP_EPOCH,
+    TILE_CACHE_STORAGE,
+    BATCH_MAX_TILES,
+    BATCH_DEADLINE,
+)
 from .event import (
     on_style_change,
     on_data_change,
@@ -55,6 +65,28 @@ class RenderComponent(Component):
         self.tile_cache_enabled = opt_tcache['enabled']
         self.tile_cache_track_changes = opt_tcache['track_changes']
         self.tile_cache_seed = opt_tcache['seed']
+        self.tile_cache_storage = opt_tcache['storage']
+        self.tile_cache_refresh_enabled = opt_tcache['refresh.enabled']
+        self.tile_cache_refresh_max_z = opt_tcache['refresh.max_z']
+        self.tile_cache_write_batch_max_tiles = opt_tcache['write_batch.max_tiles']
+        self.tile_cache_write_batch_deadline = opt_tcache['write_batch.deadline']
+        if self.tile_cache_storage not in TILE_CACHE_STORAGE:
+            raise ValueError("Invalid tile cache storage: {}".format(
+                self.tile_cache_storage))
+
+        memory_cache_size = opt_tcache['memory_cache']
+        self.tile_cache_memory = TileMemoryCache(memory_cache_size) \
+            if memory_cache_size > 0 else None
+
+        # Request thread renders layers too, so the number of additional
+        # threads and their database connections is one less.
+        render_threads = self.options['render_threads'] - 1
+        if render_threads > 0:
+            self.render_pool = ThreadPoolExecutor(
+                max_workers=render_threads, thread_name_prefix='render')
+            self.render_slots = BoundedSemaphore(render_threads)
+        else:
+            self.render_pool = self.render_slots = None
 
         self.tile_cache_path = os.path.join(self.env.core.gtsdir(self), 'tile_cache')
         if not os.path.isdir(self.tile_cache_path):
@@ -80,7 +112,7 @@ class RenderComponent(Component):
         self.logger.info("Cleaning up tile cache tables...")
 
         root = Path(self.tile_cache_path)
-        deleted_tiles = deleted_files = deleted_tables = 0
+        deleted_tiles = deleted_blobs = deleted_files = deleted_tables = 0
 
         with transaction.manager:
             for row in DBSession.execute('''
@@ -106,37 +138,49 @@ class RenderComponent(Component):
         with transaction.manager:
             conn_pg = DBSession.connection()
 
-            for tc in RTC.filter(
-                sa.or_(RTC.ttl.isnot(None), RTC.max_z.isnot(None))
-            ).all():
+            for tc in RTC.query().all():
+                conn_sqlite, lock = tc.get_tilestor()
+
                 cond = []
                 if tc.max_z is not None:
                     cond.append(sa.column('z') > tc.max_z)
                 if tc.ttl is not None:
                     cond.append(sa.column('tstamp') < now_unix - tc.ttl)
 
-                where = sa.or_(*cond)
-
-                def statement(dialect, table, schema=None):
-                    table = sa.sql.table(table)
-                    table.quote = True
-                    if schema is not None:
-                        table.schema = schema
-                        table.quote_schema = True
-                    stmt = table.delete().where(where)
-                    return stmt.compile(dialect=dialect, compile_kwargs=dict(literal_binds=True))
+                if len(cond) > 0:
+                    where = sa.or_(*cond)
+
+                    def statement(dialect, table, schema=None):
+                        table = sa.sql.table(table)
+                        table.quote = True
+                        if schema is not None:
+                            table.schema = schema
+                            table.quote_schema = True
+                        stmt = table.delete().where(where)
+                        return stmt.compile(
+                            dialect=dialect, compile_kwargs=dict(literal_binds=True))
+
+                    stmt = statement(postgresql.dialect(), tc.uuid.hex, 'tile_cache')
+                    result = conn_pg.execute(stmt)
+                    deleted_tiles += result.rowcount
 
-                stmt = statement(postgresql.dialect(), tc.uuid.hex, 'tile_cache')
-                result = conn_pg.execute(stmt)
-                deleted_tiles += result.rowcount
+                    stmt2 = statement(sqlite.dialect(), 'tile')
+                    stmt3 = statement(sqlite.dialect(), 'tile_meta')
 
-                stmt2 = statement(sqlite.dialect(), 'tile')
-                conn_sqlite, lock = tc.get_tilestor()
+                    with lock:
+                        result = conn_sqlite.execute(str(stmt2))
+                        deleted_tiles += result.rowcount
+                        result = conn_sqlite.execute(str(stmt3))
+                        deleted_tiles += result.rowcount
+                        conn_sqlite.commit()
 
                 with lock:
-                    result = conn_sqlite.execute(str(stmt2))
+                    # Tile images which are not referenced by any tile
+                    result = conn_sqlite.execute(
+                        'DELETE FROM tile_blob WHERE NOT EXISTS ('
+                        '    SELECT 1 FROM tile WHERE tile.hash = tile_blob.hash)')
+                    deleted_blobs += result.rowcount
                     conn_sqlite.commit()
-                    deleted_tiles += result.rowcount
 
                     freelist_count, page_count = conn_sqlite.execute(
                         'SELECT fc.freelist_count, pc.page_count '
@@ -148,8 +192,8 @@ class RenderComponent(Component):
 
             mark_changed(DBSession())
 
-        self.logger.info("Deleted: %d tile records, %d files, %d tables.",
-                         deleted_tiles, deleted_files, deleted_tables)
+        self.logger.info("Deleted: %d tile records, %d images, %d files, %d tables.",
+                         deleted_tiles, deleted_blobs, deleted_files, deleted_tables)
 
     def backup_configure(self, config):
         super().backup_configure(config)
@@ -158,17 +202,40 @@ class RenderComponent(Component):
     def estimate_storage(self):
         for tc in RTC.filter_by(enabled=True).all():
             tilestor, lock = tc.get_tilestor()
-            query_tile = 'SELECT coalesce(sum(length(data) + 16), 0) FROM tile'  # with 4x int columns
+            query_tile = (
+                'SELECT coalesce(sum(length(data) + coalesce(length(hash), 0) + 16), 0) '
+                'FROM tile')  # with 4x int columns
             size_img = tilestor.execute(query_tile).fetchone()[0]
 
+            query_blob = 'SELECT coalesce(sum(length(data) + length(hash)), 0) FROM tile_blob'
+            size_img += tilestor.execute(query_blob).fetchone()[0]
+
             query = 'SELECT count(1) FROM tile_cache."{}"'.format(tc.uuid.hex)
             count = DBSession.execute(query).scalar()
+            count += tilestor.execute('SELECT count(1) FROM tile_meta').fetchone()[0]
             size_color = count * 20  # 5x int columns
 
             yield TileCacheData, tc.resource_id, size_img + size_color
 
     option_annotations = (
+        Option('render_threads', int, default=4,
+               doc="Number of threads to render layers of a request concurrently "
+               "including the request thread (1 to disable). Additional threads "
+               "are shared by all requests and use own database connections."),
         Option('tile_cache.enabled', bool, default=True),
         Option('tile_cache.track_changes', bool, default=False),
         Option('tile_cache.seed', bool, default=False),
+        Option('tile_cache.storage', str, default='postgres',
+               doc="Tile metadata storage: 'postgres' or 'sqlite'. Use "
+               "render.tile_cache_storage_migrate command after changing it."),
+        Option('tile_cache.refresh.enabled', bool, default=False,
+               doc="Queue invalidated tiles for rendering by render.tile_cache_refresh."),
+        Option('tile_cache.refresh.max_z', int, default=10,
+               doc="Maximum zoom level of tiles queued for rendering."),
+        Option('tile_cache.write_batch.max_tiles', int, default=BATCH_MAX_TILES,
+               doc="Maximum number of tiles written to tile cache at once."),
+        Option('tile_cache.write_batch.deadline', float, default=BATCH_DEADLINE,
+               doc="Maximum time in seconds to collect tiles for a write batch."),
+        Option('tile_cache.memory_cache', int, default=64 * 2**20,
+               doc="Size of in-process cache of hot tiles in bytes (0 to disable)."),
     )
@@ -1,15 +1,23 @@
+from collections import deque
+from concurrent.futures import wait
+from datetime import timedelta
+from hashlib import md5
 from io import BytesIO
 from math import log, ceil, floor
 from itertools import product
 from pathlib import Path
 
+import transaction
 from PIL import Image, ImageDraw, ImageFont
 from pyramid.response import Response
-from pyramid.httpexceptions import HTTPBadRequest
+from pyramid.httpexceptions import HTTPBadRequest, HTTPNotModified
 
+from .. import db
+from ..models import DBSession
 from ..resource import Resource, ResourceNotFound, DataScope, resource_factory, ValidationError
 
 from .interface import ILegendableStyle, IRenderableStyle
+from .model import TIMESTAMP_EPOCH
 from .util import af_transform
 
 
@@ -57,47 +65,123 @@ def image_response(img, empty_code, size):
     return Response(body_file=buf, content_type='image/png')
 
 
-def tile(request):
-    z = int(request.GET['z'])
-    x = int(request.GET['x'])
-    y = int(request.GET['y'])
+def load_resources(request, p_resource):
+    """ Load resources for rendering and check permissions
 
-    p_resource = map(int, filter(None, request.GET['resource'].split(',')))
-    p_cache = request.GET.get('cache', 'true').lower() in ('true', 'yes', '1') \
-        and request.env.render.tile_cache_enabled
-    p_empty_code = request.GET.get('nd', '200')
+    Requested resources are loaded in a single query together with all their
+    parents, ACL rules and tile caches, so permission checks don't query the
+    database for each resource. """
 
-    aimg = None
+    if len(p_resource) == 0:
+        return list()
+
+    chain = db.select([Resource.id, Resource.parent_id]) \
+        .where(Resource.id.in_(set(p_resource))) \
+        .cte('chain', recursive=True)
+    chain = chain.union(
+        db.select([Resource.id, Resource.parent_id])
+        .where(Resource.id == chain.c.parent_id))
+
+    # Outer join of all resource tables would be too heavy, so columns of
+    # subclasses are loaded with a query for each class found.
+    subclasses = [cls for cls in Resource.registry if cls is not Resource]
+
+    query = Resource.query() \
+        .filter(Resource.id.in_(db.select([chain.c.id]))) \
+        .options(
+            db.selectin_polymorphic(Resource, subclasses),
+            db.subqueryload(Resource.acl),
+            db.subqueryload(Resource.tile_cache))
+
+    loaded = {obj.id: obj for obj in query}
+
+    result = list()
+    checked = set()
     for resid in p_resource:
-        obj = Resource.filter_by(id=resid).one_or_none()
+        obj = loaded.get(resid)
 
         if obj is None:
             raise ResourceNotFound(resid)
 
-        if not IRenderableStyle.providedBy(obj):
-            raise ValidationError("Resource (ID=%d) cannot be rendered." % (resid,))
+        if resid not in checked:
+            if not IRenderableStyle.providedBy(obj):
+                raise ValidationError("Resource (ID=%d) cannot be rendered." % (resid,))
 
-        request.resource_permission(PD_READ, obj)
+            request.resource_permission(PD_READ, obj)
+            checked.add(resid)
 
-        rimg = None  # Resulting resource image
+        result.append(obj)
 
-        tcache = obj.tile_cache
+    return result
 
-        # Is requested tile may be cached?
-        cache_enabled = p_cache and tcache is not None and tcache.enabled \
-            and (tcache.max_z is None or z <= tcache.max_z)
 
-        cache_exists = False
-        if cache_enabled:
-            cache_exists, rimg = tcache.get_tile((z, x, y))
+def _render_worker(queue, results):
+    # Resources and their state belong to the request session which can't
+    # be shared between threads, so the worker loads resources by ID in its
+    # own session. A single session is used for all jobs taken by a worker.
+    try:
+        with transaction.manager:
+            _render_queue(queue, results, load=True)
+    finally:
+        DBSession.remove()
 
-        if not cache_exists:
-            req = obj.render_request(obj.srs)
-            rimg = req.render_tile((z, x, y), 256)
 
-            if cache_enabled:
-                tcache.put_tile((z, x, y), rimg)
+def _render_queue(queue, results, load=False):
+    while True:
+        try:
+            idx, obj, resource_id, method, args = queue.popleft()
+        except IndexError:
+            return
+
+        if load:
+            obj = Resource.filter_by(id=resource_id).one()
+        results[idx] = getattr(obj.render_request(obj.srs), method)(*args)
+
+
+def render_layers(env, jobs):
+    """ Render jobs given as (resource, method, args) tuples and return
+    resulting images in the same order
+
+    Jobs are executed concurrently by the request thread and free render
+    threads, if there are any. Each render thread uses its own database
+    connection, so the number of threads is limited for all requests at
+    once and requests never wait for them. """
 
+    comp = env.render
+    results = [None] * len(jobs)
+    queue = deque(
+        (idx, obj, obj.id, method, args)
+        for idx, (obj, method, args) in enumerate(jobs))
+
+    slots = 0
+    if comp.render_pool is not None:
+        while slots < len(jobs) - 1 and comp.render_slots.acquire(blocking=False):
+            slots += 1
+
+    futures = list()
+    try:
+        for i in range(slots):
+            futures.append(comp.render_pool.submit(_render_worker, queue, results))
+        _render_queue(queue, results)
+    except Exception:
+        queue.clear()
+        raise
+    finally:
+        # Slots are released only after workers stop using connections
+        wait(futures)
+        for i in range(slots):
+            comp.render_slots.release()
+
+    for f in futures:
+        f.result()
+
+    return results
+
+
+def compose_images(layers, images):
+    """ Alpha composite resource images in the order of resources """
+    aimg = None
+    for obj, rimg in zip(layers, images):
         if rimg is None:
             continue
 
@@ -111,13 +195,158 @@ def tile(request):
                     "Image (ID=%d) must have mode %s, but it is %s mode." %
                     (obj.id, aimg.mode, rimg.mode))
 
-    return image_response(aimg, p_empty_code, (256, 256))
+    return aimg
+
+
+def tile_cache_etag(items):
+    """ ETag for a set of cached tiles given as (tile cache, tstamp) pairs """
+    value = ','.join('{}-{:x}'.format(tcache.uuid.hex, tstamp) for tcache, tstamp in items)
+    if len(items) > 1:
+        value = md5(value.encode('utf-8')).hexdigest()
+    return value
+
+
+def set_validators(resp, etag, tstamp):
+    resp.etag = etag
+    resp.last_modified = TIMESTAMP_EPOCH + timedelta(seconds=tstamp)
+
+    # Cached tiles may be invalidated at any time, so clients have to
+    # revalidate them on each request.
+    resp.cache_control.no_cache = True
+
+    return resp
+
+
+def not_modified(request, etag, tstamp):
+    """ Response 304 if client already have given version """
+    if etag in request.if_none_match:
+        return set_validators(HTTPNotModified(), etag, tstamp)
+    return None
+
+
+def tile(request):
+    z = int(request.GET['z'])
+    x = int(request.GET['x'])
+    y = int(request.GET['y'])
+    zxy = (z, x, y)
+
+    p_resource = list(map(int, filter(None, request.GET['resource'].split(','))))
+    p_cache = request.GET.get('cache', 'true').lower() in ('true', 'yes', '1') \
+        and request.env.render.tile_cache_enabled
+    p_empty_code = request.GET.get('nd', '200')
+
+    resources = load_resources(request, p_resource)
+
+    # Tile cache metadata for each resource, None if tile isn't cached
+    layers = list()
+    for obj in resources:
+        tcache = obj.tile_cache
+
+        # Is requested tile may be cached?
+        cache_enabled = p_cache and tcache is not None and tcache.enabled \
+            and (tcache.max_z is None or z <= tcache.max_z)
+
+        meta = tcache.get_tile_meta(zxy) if cache_enabled else None
+        layers.append((obj, cache_enabled, meta))
+
+    etag = tstamp = None
+    if len(layers) > 0 and all(meta is not None for obj, ce, meta in layers):
+        etag = tile_cache_etag([(obj.tile_cache, meta[1]) for obj, ce, meta in layers])
+        tstamp = max(meta[1] for obj, ce, meta in layers)
+
+        resp = not_modified(request, etag, tstamp)
+        if resp is not None:
+            return resp
+
+        if len(layers) == 1:
+            # Single resource tile can be served from the cache as is
+            # without decoding and encoding it again.
+            obj, cache_enabled, meta = layers[0]
+            cache_exists, tstamp, data = obj.tile_cache.get_tile_raw(zxy, meta=meta)
+            if cache_exists:
+                if data is None:
+                    resp = image_response(None, p_empty_code, (256, 256))
+                else:
+                    resp = Response(data, content_type='image/png')
+                return set_validators(resp, etag, tstamp)
+
+    # Resulting image of each resource, missing in the tile cache
+    # are rendered all together afterwards.
+    images = list()
+    render = list()
+    for idx, (obj, cache_enabled, meta) in enumerate(layers):
+        cache_exists = False
+        rimg = None
+        if meta is not None:
+            cache_exists, rimg = obj.tile_cache.get_tile(zxy, meta=meta)
+
+        if not cache_exists:
+            render.append(idx)
+        images.append(rimg)
+
+    if len(render) > 0:
+        etag = None
+
+        rendered = render_layers(request.env, [
+            (layers[idx][0], 'render_tile', (zxy, 256))
+            for idx in render])
+
+        for idx, rimg in zip(render, rendered):
+            obj, cache_enabled, meta = layers[idx]
+            if cache_enabled:
+                obj.tile_cache.put_tile(zxy, rimg)
+            images[idx] = rimg
+
+    aimg = compose_images([obj for obj, ce, meta in layers], images)
+
+    resp = image_response(aimg, p_empty_code, (256, 256))
+    if etag is not None:
+        set_validators(resp, etag, tstamp)
+    return resp
+
+
+def compose_tiles(srs, ztile, p_extent, p_size):
+    """ Tiles covering requested image extent and transforms between tile
+    and image coordinates """
+
+    # Affine transform from layer to tile
+    at_l2t = af_transform(
+        (srs.minx, srs.miny, srs.maxx, srs.maxy),
+        (0, 0, 2 ** ztile, 2 ** ztile))
+    at_t2l = ~at_l2t
+
+    # Affine transform from layer to image
+    at_l2i = af_transform(p_extent, (0, 0) + tuple(p_size))
+
+    # Affine transform from tile to image
+    at_t2i = at_l2i * ~at_l2t
+
+    # Tile coordinates of render extent
+    t_lb = tuple(at_l2t * p_extent[0:2])
+    t_rt = tuple(at_l2t * p_extent[2:4])
+
+    tb = (
+        int(floor(t_lb[0]) if t_lb[0] == min(t_lb[0], t_rt[0]) else ceil(t_lb[0])),
+        int(floor(t_lb[1]) if t_lb[1] == min(t_lb[1], t_rt[1]) else ceil(t_lb[1])),
+        int(floor(t_rt[0]) if t_rt[0] == min(t_lb[0], t_rt[0]) else ceil(t_rt[0])),
+        int(floor(t_rt[1]) if t_rt[1] == min(t_lb[1], t_rt[1]) else ceil(t_rt[1])),
+    )
+
+    ext_extent = at_t2l * tb[0:2] + at_t2l * tb[2:4]
+    ext_im = rtoint(at_t2i * tb[0:2] + at_t2i * tb[2:4])
+    ext_size = (ext_im[2] - ext_im[0], ext_im[1] - ext_im[3])
+    ext_offset = (-ext_im[0], -ext_im[3])
+
+    tx_range = (min(tb[0], tb[2]), max(tb[0], tb[2]))
+    ty_range = (min(tb[1], tb[3]), max(tb[1], tb[3]))
+
+    return at_t2l, at_t2i, ext_extent, ext_size, ext_offset, tx_range, ty_range
 
 
 def image(request):
     p_extent = tuple(map(float, request.GET['extent'].split(',')))
     p_size = tuple(map(int, request.GET['size'].split(',')))
-    p_resource = map(int, filter(None, request.GET['resource'].split(',')))
+    p_resource = list(map(int, filter(None, request.GET['resource'].split(','))))
     p_cache = request.GET.get('cache', 'true').lower() in ('true', 'yes', '1') \
         and request.env.render.tile_cache_enabled
     p_empty_code = request.GET.get('nd', '200')
@@ -130,30 +359,22 @@ def image(request):
         (p_extent[3] - p_extent[1]) / p_size[1],
     )
 
-    aimg = None
-    zexact = None
-    for resid in p_resource:
-        obj = Resource.filter_by(id=resid).one_or_none()
-
-        if obj is None:
-            raise ResourceNotFound(resid)
-
-        if not IRenderableStyle.providedBy(obj):
-            raise ValidationError("Resource (ID=%d) cannot be rendered." % (resid,))
-
-        request.resource_permission(PD_READ, obj)
-
-        rimg = None
+    resources = load_resources(request, p_resource)
 
-        if p_cache and zexact is None:
-            if abs(resolution[0] - resolution[1]) < 1e-9:
-                ztile = log((obj.srs.maxx - obj.srs.minx) / (256 * resolution[0]), 2)
-                zexact = abs(round(ztile) - ztile) < 1e-9
-                if zexact:
-                    ztile = int(round(ztile))
-            else:
-                zexact = False
+    zexact = None
+    if p_cache and len(resources) > 0:
+        srs = resources[0].srs
+        if abs(resolution[0] - resolution[1]) < 1e-9:
+            ztile = log((srs.maxx - srs.minx) / (256 * resolution[0]), 2)
+            zexact = abs(round(ztile) - ztile) < 1e-9
+            if zexact:
+                ztile = int(round(ztile))
+        else:
+            zexact = False
 
+    # Tiles composition and their tile cache metadata for each resource
+    layers = list()
+    for obj in resources:
         tcache = obj.tile_cache
 
         # Is requested image may be cached via tiles?
@@ -162,48 +383,52 @@ def image(request):
             and tcache.enabled and tcache.image_compose  # NOQA: W503
             and (tcache.max_z is None or ztile <= tcache.max_z))  # NOQA: W503
 
-        ext_extent = p_extent
-        ext_size = p_size
-        ext_offset = (0, 0)
-
         if cache_enabled:
-            # Affine transform from layer to tile
-            at_l2t = af_transform(
-                (obj.srs.minx, obj.srs.miny, obj.srs.maxx, obj.srs.maxy),
-                (0, 0, 2 ** ztile, 2 ** ztile))
-            at_t2l = ~at_l2t
-
-            # Affine transform from layer to image
-            at_l2i = af_transform(p_extent, (0, 0) + tuple(p_size))
-
-            # Affine transform from tile to image
-            at_t2i = at_l2i * ~at_l2t
-
-            # Tile coordinates of render extent
-            t_lb = tuple(at_l2t * p_extent[0:2])
-            t_rt = tuple(at_l2t * p_extent[2:4])
-
-            tb = (
-                int(floor(t_lb[0]) if t_lb[0] == min(t_lb[0], t_rt[0]) else ceil(t_lb[0])),
-                int(floor(t_lb[1]) if t_lb[1] == min(t_lb[1], t_rt[1]) else ceil(t_lb[1])),
-                int(floor(t_rt[0]) if t_rt[0] == min(t_lb[0], t_rt[0]) else ceil(t_rt[0])),
-                int(floor(t_rt[1]) if t_rt[1] == min(t_lb[1], t_rt[1]) else ceil(t_rt[1])),
-            )
-
-            ext_extent = at_t2l * tb[0:2] + at_t2l * tb[2:4]
-            ext_im = rtoint(at_t2i * tb[0:2] + at_t2i * tb[2:4])
-            ext_size = (ext_im[2] - ext_im[0], ext_im[1] - ext_im[3])
-            ext_offset = (-ext_im[0], -ext_im[3])
-
-            tx_range = tuple(range(min(tb[0], tb[2]), max(tb[0], tb[2])))
-            ty_range = tuple(range(min(tb[1], tb[3]), max(tb[1], tb[3])))
-
-            for tx, ty in product(tx_range, ty_range):
-                cache_exists, timg = tcache.get_tile((ztile, tx, ty))
-                if not cache_exists:
+            compose = compose_tiles(obj.srs, ztile, p_extent, p_size)
+            tx_range, ty_range = compose[5:7]
+            ctmeta = tcache.get_tiles_meta(ztile, tx_range, ty_range)
+        else:
+            compose = ctmeta = None
+
+        layers.append((obj, compose, ctmeta))
+
+    def _cached(compose, ctmeta):
+        if compose is None:
+            return False
+        tx_range, ty_range = compose[5:7]
+        count = (tx_range[1] - tx_range[0]) * (ty_range[1] - ty_range[0])
+        return count > 0 and len(ctmeta) == count
+
+    etag = tstamp = None
+    if len(layers) > 0 and all(_cached(compose, ctmeta) for obj, compose, ctmeta in layers):
+        ctstamps = [
+            (obj.tile_cache, max(m[1] for m in ctmeta.values()))
+            for obj, compose, ctmeta in layers]
+        etag = tile_cache_etag(ctstamps)
+        tstamp = max(t for tc, t in ctstamps)
+
+        resp = not_modified(request, etag, tstamp)
+        if resp is not None:
+            return resp
+
+    # Resulting image of each resource, missing in the tile cache
+    # are rendered all together afterwards.
+    images = list()
+    for obj, compose, ctmeta in layers:
+        rimg = None
+
+        if compose is not None:
+            at_t2l, at_t2i, ext_extent, ext_size, ext_offset, \
+                tx_range, ty_range = compose
+
+            ctiles = obj.tile_cache.get_tiles(ztile, tx_range, ty_range, meta=ctmeta)
+
+            for tx, ty in product(range(*tx_range), range(*ty_range)):
+                if (tx, ty) not in ctiles:
                     rimg = None
                     break
                 else:
+                    timg = ctiles[(tx, ty)]
                     if rimg is None:
                         rimg = Image.new('RGBA', p_size)
 
@@ -223,60 +448,81 @@ def image(request):
                     toffset = rtoint(at_t2i * (tx, ty))
                     rimg.paste(timg, toffset)
 
-        if rimg is None:
-            req = obj.render_request(obj.srs)
-            rimg = req.render_extent(ext_extent, ext_size)
+        images.append(rimg)
 
-            empty_image = rimg is None
+    render = [idx for idx, rimg in enumerate(images) if rimg is None]
+    if len(render) > 0:
+        etag = None
 
-            if cache_enabled:
-                tile_cache_failed = False
-                for tx, ty in product(tx_range, ty_range):
-                    t_offset = at_t2i * (tx, ty)
-                    t_offset = rtoint((t_offset[0] + ext_offset[0], t_offset[1] + ext_offset[1]))
-                    if empty_image:
-                        timg = None
-                    else:
-                        timg = rimg.crop(t_offset + (t_offset[0] + 256, t_offset[1] + 256))
+        jobs = list()
+        for idx in render:
+            obj, compose, ctmeta = layers[idx]
+            args = (compose[2], compose[3]) if compose is not None else (p_extent, p_size)
+            jobs.append((obj, 'render_extent', args))
 
-                    tile_cache_failed = tile_cache_failed or (
-                        not obj.tile_cache.put_tile((ztile, tx, ty), timg))
+        rendered = render_layers(request.env, jobs)
+    else:
+        rendered = list()
 
-                    if tdi:
-                        if rimg is None:
-                            rimg = Image.new('RGBA', ext_size)
-                        msg = 'NEW'
-                        if empty_image:
-                            msg += ' EMPTY'
-                        rimg = tile_debug_info(
-                            rimg, offset=t_offset, color='red', zxy=(ztile, tx, ty),
-                            extent=at_t2l * (tx, ty) + at_t2l * (tx + 1, ty + 1),
-                            msg=msg)
+    for idx, rimg in zip(render, rendered):
+        obj, compose, ctmeta = layers[idx]
+
+        cache_enabled = compose is not None
+
+        ext_size = p_size
+        ext_offset = (0, 0)
+
+        if cache_enabled:
+            at_t2l, at_t2i, ext_extent, ext_size, ext_offset, \
+                tx_range, ty_range = compose
+
+        empty_image = rimg is None
 
-                    elif tile_cache_failed:
-                        # Stop putting to the tile cache in case of its failure.
-                        break
+        if cache_enabled:
+            tile_cache_failed = False
+            for tx, ty in product(range(*tx_range), range(*ty_range)):
+                t_offset = at_t2i * (tx, ty)
+                t_offset = rtoint((t_offset[0] + ext_offset[0], t_offset[1] + ext_offset[1]))
+                if empty_image:
+                    timg = None
+                else:
+                    timg = rimg.crop(t_offset + (t_offset[0] + 256, t_offset[1] + 256))
 
-            if rimg is None:
-                continue
+                tile_cache_failed = tile_cache_failed or (
+                    not obj.tile_cache.put_tile((ztile, tx, ty), timg))
+
+                if tdi:
+                    if rimg is None:
+                        rimg = Image.new('RGBA', ext_size)
+                    msg = 'NEW'
+                    if empty_image:
+                        msg += ' EMPTY'
+                    rimg = tile_debug_info(
+                        rimg, offset=t_offset, color='red', zxy=(ztile, tx, ty),
+                        extent=at_t2l * (tx, ty) + at_t2l * (tx + 1, ty + 1),
+                        msg=msg)
+
+                elif tile_cache_failed:
+                    # Stop putting to the tile cache in case of its failure.
+                    break
 
+        if rimg is not None:
             rimg = rimg.crop((
                 ext_offset[0], ext_offset[1],
                 ext_offset[0] + p_size[0],
                 ext_offset[1] + p_size[1]
             ))
 
-        if aimg is None:
-            aimg = rimg
-        else:
-            try:
-                aimg = Image.alpha_composite(aimg, rimg)
-            except ValueError:
-                raise HTTPBadRequest(
-                    "Image (ID=%d) must have mode %s, but it is %s mode." %
-                    (obj.id, aimg.mode, rimg.mode))
+        images[idx] = rimg
+
+    aimg = compose_images([obj for obj, compose, ctmeta in layers], images)
 
-    return image_response(aimg, p_empty_code, p_size)
+    resp = image_response(aimg, p_empty_code, p_size)
+    if etag is not None:
+        set_validators(resp, etag, tstamp)
+    else:
+        resp.cache_expires(0)
+    return resp
 
 
 def tile_cache_seed_status(request):
@@ -306,7 +552,7 @@ def setup_pyramid(comp, config):
 
     config.add_route(
         'render.image', r'/api/component/render/image'
-    ).add_view(image, http_cache=0)
+    ).add_view(image)
 
     config.add_route(
         'render.tile_cache.seed_status', r'/api/resource/{id:\d+}/tile_cache/seed_status',
@@ -1,27 +1,120 @@
 import logging
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from math import ceil, floor
 from itertools import product
 from datetime import datetime
+from time import sleep
 
 from pyproj import Transformer
 import transaction
+from zope.sqlalchemy import mark_changed
 
+from .. import db
 from ..command import Command
 from ..models import DBSession
+from ..resource import Resource
 
-from .model import ResourceTileCache, TilestorWriter
+from .model import ResourceTileCache, ResourceTileCacheRefresh, TilestorWriter
 from .util import affine_bounds_to_tile
 
 
 _logger = logging.getLogger(__name__)
 
 
-SEED_STEP = 16
 SEED_INTERVAL = 30
 
 TILE_QUEUE_TIMEOUT = 60
 SHUTDOWN_TIMEOUT = 10 * TILE_QUEUE_TIMEOUT
 
+METATILE_SIZES = (1, 2, 4, 8, 16)
+
+# Number of metatiles being rendered at once per worker process
+JOB_QUEUE_FACTOR = 4
+
+MIGRATE_BATCH = 10000
+
+REFRESH_BATCH = 16
+REFRESH_INTERVAL = 10
+
+
+def img_empty(img):
+    """ Check if image is fully transparent """
+    if img is None:
+        return True
+    if img.mode != 'RGBA':
+        return False
+    return img.getchannel('A').getbbox() is None
+
+
+def render_metatile(rend_res, srs, z, xrange, yrange):
+    """ Render metatile covering given tile ranges and slice it into tiles.
+    Returns empty list if the whole metatile is transparent. """
+
+    tiles = list(product(range(*xrange), range(*yrange)))
+
+    if len(tiles) == 1:
+        req = rend_res.render_request(srs)
+        img = req.render_tile((z, ) + tiles[0], 256)
+        return [] if img_empty(img) else [((z, ) + tiles[0], img)]
+
+    emin = srs.tile_extent((z, xrange[0], yrange[1] - 1))
+    emax = srs.tile_extent((z, xrange[1] - 1, yrange[0]))
+    extent = emin[0:2] + emax[2:4]
+    size = (
+        256 * (xrange[1] - xrange[0]),
+        256 * (yrange[1] - yrange[0]))
+
+    req = rend_res.render_request(srs)
+    img = req.render_extent(extent, size)
+
+    if img_empty(img):
+        return []
+
+    result = list()
+    for x, y in tiles:
+        ox = 256 * (x - xrange[0])
+        oy = 256 * (y - yrange[0])
+        result.append(((z, x, y), img.crop((ox, oy, ox + 256, oy + 256))))
+
+    return result
+
+
+def metatile_ranges(rx, ry, msize):
+    """ Split tile ranges into ranges of metatiles aligned to metatile size """
+    for mx, my in product(
+        range(rx[0] // msize, (rx[1] - 1) // msize + 1),
+        range(ry[0] // msize, (ry[1] - 1) // msize + 1),
+    ):
+        mxrange = (max(mx * msize, rx[0]), min((mx + 1) * msize, rx[1]))
+        myrange = (max(my * msize, ry[0]), min((my + 1) * msize, ry[1]))
+        yield (mx, my), mxrange, myrange
+
+
+def _render_metatile_job(resource_id, z, xrange, yrange):
+    with transaction.manager:
+        rend_res = Resource.filter_by(id=resource_id).one()
+        return render_metatile(rend_res, rend_res.srs, z, xrange, yrange)
+
+
+def seed_executor(env, jobs):
+    """ Process pool for rendering metatiles with all workers started
+
+    Pool with fork context forks all workers on the first submit, so it's
+    done here before the parent process opens database connections again,
+    otherwise workers would share them. """
+
+    transaction.commit()
+    DBSession.remove()
+    env.core.engine.dispose()
+
+    executor = ProcessPoolExecutor(
+        max_workers=jobs, mp_context=multiprocessing.get_context('fork'))
+    executor.submit(os.getpid).result()
+    return executor
+
 
 @Command.registry.register
 class TileCacheSeedCommand():
@@ -29,10 +122,22 @@ class TileCacheSeedCommand():
 
     @classmethod
     def argparser_setup(cls, parser, env):
-        pass
+        parser.add_argument(
+            '--metatile', type=int, default=1, choices=METATILE_SIZES,
+            help="Metatile size in tiles, NxN tiles are rendered at once")
+        parser.add_argument(
+            '--jobs', type=int, default=1,
+            help="Number of rendering processes")
+        parser.add_argument(
+            '--skip-empty', action='store_true', default=False,
+            help="Don't render areas covered by empty metatiles on lower zoom "
+            "levels, styles with scale ranges may be rendered incompletely")
 
     @classmethod
     def execute(cls, args, env):
+        if args.jobs < 1:
+            raise ValueError("Number of jobs should be positive.")
+
         tc_ids = DBSession.query(ResourceTileCache.resource_id).filter(
             ResourceTileCache.enabled,
             ResourceTileCache.seed_z != None  # NOQA: E711
@@ -41,90 +146,351 @@ class TileCacheSeedCommand():
         # TODO: Add arbitrary SRS support
         srs_tr = Transformer.from_crs(4326, 3857, always_xy=True)
 
-        for tc_id in tc_ids:
-            tc = ResourceTileCache.filter_by(resource_id=tc_id).one()
+        executor = seed_executor(env, args.jobs) if args.jobs > 1 else None
 
-            rend_res = tc.resource
-            data_res = rend_res.parent
-            srs = data_res.srs
+        try:
+            for tc_id in tc_ids:
+                cls.seed(tc_id, args, executor, srs_tr)
+        finally:
+            if executor is not None:
+                executor.shutdown()
 
-            # TODO: Add arbitrary SRS support
-            extent_4326 = data_res.extent
-            extent = srs_tr.transform(extent_4326['minLon'], extent_4326['minLat']) + \
-                srs_tr.transform(extent_4326['maxLon'], extent_4326['maxLat'])
+        TilestorWriter.getInstance().wait_for_shutdown(
+            timeout=SHUTDOWN_TIMEOUT)
 
-            rlevel = list()
-            rcount = 0
+    @classmethod
+    def seed(cls, tc_id, args, executor, srs_tr):
+        tc = ResourceTileCache.filter_by(resource_id=tc_id).one()
 
-            for z in range(1, tc.seed_z + 1):
-                atf = affine_bounds_to_tile((srs.minx, srs.miny, srs.maxx, srs.maxy), z)
+        rend_res = tc.resource
+        data_res = rend_res.parent
+        srs = data_res.srs
 
-                t_lb = tuple(atf * extent[0:2])
-                t_rt = tuple(atf * extent[2:4])
+        # TODO: Add arbitrary SRS support
+        extent_4326 = data_res.extent
+        extent = srs_tr.transform(extent_4326['minLon'], extent_4326['minLat']) + \
+            srs_tr.transform(extent_4326['maxLon'], extent_4326['maxLat'])
+
+        rlevel = list()
+        rcount = 0
+
+        for z in range(1, tc.seed_z + 1):
+            atf = affine_bounds_to_tile((srs.minx, srs.miny, srs.maxx, srs.maxy), z)
+
+            t_lb = tuple(atf * extent[0:2])
+            t_rt = tuple(atf * extent[2:4])
+
+            tb = (
+                int(floor(t_lb[0]) if t_lb[0] == min(t_lb[0], t_rt[0]) else ceil(t_lb[0])),
+                int(floor(t_lb[1]) if t_lb[1] == min(t_lb[1], t_rt[1]) else ceil(t_lb[1])),
+                int(floor(t_rt[0]) if t_rt[0] == min(t_lb[0], t_rt[0]) else ceil(t_rt[0])),
+                int(floor(t_rt[1]) if t_rt[1] == min(t_lb[1], t_rt[1]) else ceil(t_rt[1])),
+            )
+
+            rx = (min(tb[0], tb[2]), max(tb[0], tb[2]))
+            ry = (min(tb[1], tb[3]), max(tb[1], tb[3]))
+
+            count = (rx[1] - rx[0]) * (ry[1] - ry[0])
+            rcount += count
+            rlevel.append((z, rx, ry, count))
+
+        tc.update_seed_status('started')
+
+        # Reload expired session objects
+        transaction.commit()
+        tc = ResourceTileCache.filter_by(resource_id=tc.resource_id).one()
+        rend_res = tc.resource
+        srs = rend_res.srs
+        resource_id = rend_res.id
+
+        _logger.info(
+            "Seeding tile cache for resource %d with %d tiles (metatile = %d, jobs = %d)",
+            resource_id, rcount, args.metatile, args.jobs)
+
+        progress = 0
+        rendered = 0
+
+        b_start = datetime.utcnow()
+
+        # Metatiles of the previous zoom level which were fully transparent
+        empty_prev = None
+        msize_prev = None
+
+        for z, rx, ry, count in rlevel:
+            if count == 0:
+                empty_prev = None
+                continue
+
+            msize = min(args.metatile, 2 ** z)
+            empty = set()
+
+            def metatiles():
+                nonlocal progress
+
+                for (mx, my), mxrange, myrange in metatile_ranges(rx, ry, msize):
+                    mcount = (mxrange[1] - mxrange[0]) * (myrange[1] - myrange[0])
+
+                    # Nothing can appear under an empty parent metatile, so
+                    # skip it. These tiles are rendered on demand later.
+                    if args.skip_empty and empty_prev is not None:
+                        pkey = (
+                            (mx * msize // 2) // msize_prev,
+                            (my * msize // 2) // msize_prev)
+                        if pkey in empty_prev:
+                            empty.add((mx, my))
+                            progress += mcount
+                            continue
+
+                    ctiles = tc.get_tiles(z, mxrange, myrange)
+                    if len(ctiles) == mcount:
+                        if all(img is None for img in ctiles.values()):
+                            empty.add((mx, my))
+                        progress += mcount
+                        continue
+
+                    yield (mx, my), mxrange, myrange
+
+            def rendered_metatiles():
+                if executor is None:
+                    for key, mxrange, myrange in metatiles():
+                        yield key, mxrange, myrange, render_metatile(
+                            rend_res, srs, z, mxrange, myrange)
+                    return
+
+                pending = deque()
+                for key, mxrange, myrange in metatiles():
+                    pending.append((key, mxrange, myrange, executor.submit(
+                        _render_metatile_job, resource_id, z, mxrange, myrange)))
+
+                    if len(pending) >= args.jobs * JOB_QUEUE_FACTOR:
+                        key, mxrange, myrange, future = pending.popleft()
+                        yield key, mxrange, myrange, future.result()
+
+                while len(pending) > 0:
+                    key, mxrange, myrange, future = pending.popleft()
+                    yield key, mxrange, myrange, future.result()
 
-                tb = (
-                    int(floor(t_lb[0]) if t_lb[0] == min(t_lb[0], t_rt[0]) else ceil(t_lb[0])),
-                    int(floor(t_lb[1]) if t_lb[1] == min(t_lb[1], t_rt[1]) else ceil(t_lb[1])),
-                    int(floor(t_rt[0]) if t_rt[0] == min(t_lb[0], t_rt[0]) else ceil(t_rt[0])),
-                    int(floor(t_rt[1]) if t_rt[1] == min(t_lb[1], t_rt[1]) else ceil(t_rt[1])),
-                )
+            for key, mxrange, myrange, tiles in rendered_metatiles():
+                if len(tiles) == 0:
+                    empty.add(key)
+                    tiles = [
+                        ((z, x, y), None) for x, y
+                        in product(range(*mxrange), range(*myrange))]
+
+                for tile, img in tiles:
+                    tc.put_tile(tile, img, timeout=TILE_QUEUE_TIMEOUT)
+
+                rendered += len(tiles)
+                progress += len(tiles)
+
+                if (datetime.utcnow() - b_start).total_seconds() > SEED_INTERVAL:
+                    b_start = datetime.utcnow()
+                    tc.update_seed_status('progress', progress=progress, total=rcount)
 
-                rx = (min(tb[0], tb[2]), max(tb[0], tb[2]))
-                ry = (min(tb[1], tb[3]), max(tb[1], tb[3]))
+                    # Reload expired session objects
+                    transaction.commit()
+                    tc = ResourceTileCache.filter_by(resource_id=resource_id).one()
+                    rend_res = tc.resource
+                    srs = rend_res.srs
+
+                    _logger.debug(
+                        "%d tiles processed and %d rendered for resource %d (%.2f)",
+                        progress, rendered, resource_id, 100.0 * progress / rcount)
+
+            _logger.debug(
+                "Zoom level %d completed for resource %d (%d empty metatiles)",
+                z, resource_id, len(empty))
+
+            empty_prev = empty
+            msize_prev = msize
+
+        tc.update_seed_status('completed', total=rcount)
+        transaction.commit()
 
-                count = (rx[1] - rx[0]) * (ry[1] - ry[0])
-                rcount += count
-                rlevel.append((z, rx, ry, count))
+        _logger.info(
+            "Completed seeding cache for resource %d (%d tiles processed, %d rendered)",
+            resource_id, progress, rendered)
 
-            tc.update_seed_status('started')
 
-            # Reload expired session objects
-            transaction.commit()
-            tc = ResourceTileCache.filter_by(resource_id=tc.resource_id).one()
-            rend_res = tc.resource
-            srs = rend_res.srs
+@Command.registry.register
+class TileCacheRefreshCommand():
+    identity = 'render.tile_cache_refresh'
 
-            _logger.info("Seeding tile cache for resource %d with %d tiles", rend_res.id, rcount)
+    @classmethod
+    def argparser_setup(cls, parser, env):
+        parser.add_argument(
+            '--metatile', type=int, default=4, choices=METATILE_SIZES,
+            help="Metatile size in tiles, NxN tiles are rendered at once")
+        parser.add_argument(
+            '--watch', action='store_true', default=False,
+            help="Keep waiting for new invalidated tiles")
+        parser.add_argument(
+            '--interval', type=int, default=REFRESH_INTERVAL,
+            help="Queue polling interval in seconds for --watch mode")
+
+    @classmethod
+    def execute(cls, args, env):
+        while True:
+            # Queue items are removed in a short transaction, so row locks
+            # aren't held while rendering. Items of a crashed worker are
+            # lost, but their tiles will be rendered on demand anyway.
+            with transaction.manager:
+                items = ResourceTileCacheRefresh.filter() \
+                    .order_by(ResourceTileCacheRefresh.id) \
+                    .with_for_update(skip_locked=True) \
+                    .limit(REFRESH_BATCH).all()
+
+                for item in items:
+                    DBSession.delete(item)
+
+                items = [(
+                    item.resource_id, item.z,
+                    item.xmin, item.xmax, item.ymin, item.ymax,
+                ) for item in items]
 
-            progress = 0
             rendered = 0
+            for item in items:
+                with transaction.manager:
+                    rendered += cls.refresh(*item, msize=args.metatile)
+
+            if len(items) > 0:
+                _logger.debug(
+                    "%d queued tile ranges refreshed, %d tiles rendered",
+                    len(items), rendered)
+            elif args.watch:
+                sleep(args.interval)
+            else:
+                break
+
+        TilestorWriter.getInstance().wait_for_shutdown(
+            timeout=SHUTDOWN_TIMEOUT)
+
+    @classmethod
+    def refresh(cls, resource_id, z, xmin, xmax, ymin, ymax, msize):
+        tc = ResourceTileCache.filter_by(resource_id=resource_id).one_or_none()
+        if tc is None or not tc.enabled:
+            return 0
+
+        if tc.max_z is not None and z > tc.max_z:
+            return 0
+
+        # Ranges are inclusive and may go beyond tile matrix bounds
+        tmax = 2 ** z
+        rx = (max(xmin, 0), min(xmax + 1, tmax))
+        ry = (max(ymin, 0), min(ymax + 1, tmax))
+        if rx[0] >= rx[1] or ry[0] >= ry[1]:
+            return 0
+
+        rend_res = tc.resource
+        srs = rend_res.srs
+
+        rendered = 0
+        for key, mxrange, myrange in metatile_ranges(rx, ry, min(msize, tmax)):
+            mcount = (mxrange[1] - mxrange[0]) * (myrange[1] - myrange[0])
+
+            # Skip tiles rendered on demand since invalidation, only
+            # metadata is enough to check if they exist
+            if len(tc.get_tiles_meta(z, mxrange, myrange)) == mcount:
+                continue
+
+            tiles = render_metatile(rend_res, srs, z, mxrange, myrange)
+            if len(tiles) == 0:
+                tiles = [
+                    ((z, x, y), None) for x, y
+                    in product(range(*mxrange), range(*myrange))]
+
+            for tile, img in tiles:
+                tc.put_tile(tile, img, timeout=TILE_QUEUE_TIMEOUT)
 
-            b_start = datetime.utcnow()
+            rendered += len(tiles)
 
-            for z, rx, ry, count in rlevel:
-                # TODO: Add meta tile support
-                for x, y in product(range(*rx), range(*ry)):
-                    cache_exists, img = tc.get_tile((z, x, y))
-                    if not cache_exists:
-                        req = rend_res.render_request(srs)
-                        rimg = req.render_tile((z, x, y), 256)
-                        tc.put_tile((z, x, y), rimg, timeout=TILE_QUEUE_TIMEOUT)
-                        rendered += 1
+        return rendered
 
-                    progress += 1
 
-                    if (progress % SEED_STEP) == 0 and (
-                        (datetime.utcnow() - b_start).total_seconds() > SEED_INTERVAL
-                    ):
-                        b_start = datetime.utcnow()
-                        tc.update_seed_status('progress', progress=progress, total=rcount)
+@Command.registry.register
+class TileCacheStorageMigrateCommand():
+    identity = 'render.tile_cache_storage_migrate'
+
+    @classmethod
+    def argparser_setup(cls, parser, env):
+        pass
+
+    @classmethod
+    def execute(cls, args, env):
+        target = env.render.tile_cache_storage
 
-                        # Reload expired session objects
-                        transaction.commit()
-                        tc = ResourceTileCache.filter_by(resource_id=tc.resource_id).one()
-                        rend_res = tc.resource
-                        srs = rend_res.srs
+        with transaction.manager:
+            tc_ids = [row[0] for row in DBSession.query(
+                ResourceTileCache.resource_id).all()]
 
-                        _logger.debug(
-                            "%d tiles processed and %d rendered for resource %d (%.2f)",
-                            progress, rendered, rend_res.id, 100.0 * progress / rcount)
+        for tc_id in tc_ids:
+            with transaction.manager:
+                tc = ResourceTileCache.filter_by(resource_id=tc_id).one()
+                tc.initialize()
+
+                if target == 'sqlite':
+                    count = cls.to_sqlite(tc)
+                else:
+                    count = cls.to_postgres(tc)
 
-            tc.update_seed_status('completed', total=rcount)
-            transaction.commit()
+                mark_changed(DBSession())
+
+            if target == 'postgres':
+                # Delete migrated rows only after PostgreSQL commit
+                tilestor, lock = tc.get_tilestor()
+                with lock:
+                    tilestor.execute('DELETE FROM tile_meta')
+                    tilestor.commit()
 
             _logger.info(
-                "Completed seeding cache for resource %d (%d tiles processed, %d rendered)",
-                rend_res.id, progress, rendered)
+                "%d tile metadata records of resource %d moved to %s",
+                count, tc_id, target)
 
-        TilestorWriter.getInstance().wait_for_shutdown(
-            timeout=SHUTDOWN_TIMEOUT)
+    @classmethod
+    def to_sqlite(cls, tc):
+        conn = DBSession.connection()
+        tilestor, lock = tc.get_tilestor()
+
+        result = conn.execution_options(stream_results=True).execute(
+            'SELECT z, x, y, color, tstamp FROM tile_cache."{}"'.format(tc.uuid.hex))
+
+        count = 0
+        with lock:
+            while True:
+                rows = result.fetchmany(MIGRATE_BATCH)
+                if len(rows) == 0:
+                    break
+                tilestor.executemany(
+                    'INSERT OR REPLACE INTO tile_meta VALUES (?, ?, ?, ?, ?)',
+                    [tuple(row) for row in rows])
+                count += len(rows)
+            tilestor.commit()
+
+        conn.execute('TRUNCATE tile_cache."{}"'.format(tc.uuid.hex))
+        return count
+
+    @classmethod
+    def to_postgres(cls, tc):
+        conn = DBSession.connection()
+        tilestor, lock = tc.get_tilestor()
+
+        query = db.sql.text(
+            'INSERT INTO tile_cache."{}" (z, x, y, color, tstamp) '
+            'VALUES (:z, :x, :y, :color, :tstamp) '
+            'ON CONFLICT (z, x, y) DO UPDATE '
+            'SET color = EXCLUDED.color, tstamp = EXCLUDED.tstamp'
+            .format(tc.uuid.hex))
+
+        count = 0
+        with lock:
+            cursor = tilestor.execute('SELECT z, x, y, color, tstamp FROM tile_meta')
+            while True:
+                rows = cursor.fetchmany(MIGRATE_BATCH)
+                if len(rows) == 0:
+                    break
+                conn.execute(query, [
+                    dict(z=z, x=x, y=y, color=color, tstamp=tstamp)
+                    for z, x, y, color, tstamp in rows])
+                count += len(rows)
+
+        return count
@@ -0,0 +1,20 @@
+/*** {
+    "revision": "56467cf5", "parents": ["00000000"],
+    "date": "2026-10-18T09:00:00",
+    "message": "Add tile cache refresh table"
+} ***/
+
+CREATE TABLE resource_tile_cache_refresh
+(
+    id serial NOT NULL,
+    resource_id integer NOT NULL,
+    z smallint NOT NULL,
+    xmin integer NOT NULL,
+    xmax integer NOT NULL,
+    ymin integer NOT NULL,
+    ymax integer NOT NULL,
+    tstamp timestamp without time zone NOT NULL,
+    CONSTRAINT resource_tile_cache_refresh_pkey PRIMARY KEY (id),
+    CONSTRAINT resource_tile_cache_refresh_resource_id_fkey FOREIGN KEY (resource_id)
+        REFERENCES resource (id) ON DELETE CASCADE
+);
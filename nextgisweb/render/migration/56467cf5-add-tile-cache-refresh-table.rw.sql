@@ -0,0 +1,3 @@
+/*** { "revision": "56467cf5" } ***/
+
+DROP TABLE resource_tile_cache_refresh;
@@ -1,5 +1,6 @@
 from datetime import datetime, timedelta
 from functools import lru_cache
+from hashlib import sha256
 from uuid import uuid4
 from pathlib import Path
 from threading import Lock, Thread
@@ -9,9 +10,11 @@ import os.path
 import sqlite3
 from io import BytesIO
 import atexit
+from contextlib import nullcontext
 from queue import Queue, Empty, Full
 
 import transaction
+from cachetools import LRUCache
 from PIL import Image
 from sqlalchemy import MetaData, Table
 from zope.sqlalchemy import mark_changed
@@ -39,6 +42,8 @@ Base = declarative_base(dependencies=('resource', ))
 
 SEED_STATUS_ENUM = ('started', 'progress', 'completed', 'error')
 
+TILE_CACHE_STORAGE = ('postgres', 'sqlite')
+
 QUEUE_MAX_SIZE = 256
 QUEUE_STUCK_TIMEOUT = 5.0
 BATCH_MAX_TILES = 32
@@ -48,6 +53,33 @@ SHUTDOWN_TIMEOUT = 10
 SQLITE_CON_CACHE = 32
 SQLITE_TIMEOUT = min(QUEUE_STUCK_TIMEOUT * 2, 30)
 
+COLOR_TILE_CACHE = 256
+
+# Maximum number of host parameters in SQLite prior to 3.32.0
+SQLITE_MAX_VARIABLES = 999
+
+# INSERT ... ON CONFLICT DO UPDATE is available since SQLite 3.24.0
+SQLITE_UPSERT = sqlite3.sqlite_version_info >= (3, 24, 0)
+
+PG_UPSERT_ROWS = 1000
+
+# SELECT DISTINCT z with loose index scan on (z, x, y) primary key instead of
+# sequential scan of the whole table. Works both in PostgreSQL and SQLite.
+SQL_DISTINCT_Z = """
+    WITH RECURSIVE zlevel(z) AS (
+        SELECT min(z) FROM {0}
+        UNION ALL
+        SELECT (SELECT min(z) FROM {0} WHERE z > zlevel.z)
+        FROM zlevel WHERE zlevel.z IS NOT NULL
+    )
+    SELECT z FROM zlevel WHERE z IS NOT NULL
+"""
+
+# Tile image is taken from tile_blob by hash or from the tile table itself
+# for tiles written before deduplication.
+SQLITE_TILE_JOIN = 'tile t LEFT JOIN tile_blob b ON b.hash = t.hash'
+SQLITE_TILE_DATA = 'CASE WHEN t.hash IS NULL THEN t.data ELSE b.data END'
+
 
 @lru_cache(SQLITE_CON_CACHE)
 def get_tile_db(db_path):
@@ -70,26 +102,118 @@ def get_tile_db(db_path):
 
     # CREATE TABLE IF NOT EXISTS causes SQLite database lock. So check the tile
     # table existance before table creation.
-    table_exists = cur.execute("""
-        SELECT 1 FROM sqlite_master
-        WHERE type='table' AND name='tile'
-    """).fetchone() is not None
-
-    if not table_exists:
+    tables = set(r[0] for r in cur.execute("""
+        SELECT name FROM sqlite_master
+        WHERE type IN ('table', 'index')
+            AND name IN ('tile', 'tile_meta', 'tile_blob', 'tile_hash_idx')
+    """).fetchall())
+    changed = False
+
+    # Tile images are stored in tile_blob table once per content hash and
+    # tile table rows refer them by hash. Data column is empty then and
+    # it's used only by tiles written before deduplication.
+    if b'tile' not in tables:
         cur.execute("""
             CREATE TABLE IF NOT EXISTS tile (
                 z INTEGER, x INTEGER, y INTEGER,
                 tstamp INTEGER NOT NULL,
                 data BLOB NOT NULL,
+                hash BLOB,
+                PRIMARY KEY (z, x, y)
+            )
+        """)
+    elif b'hash' not in [r[1] for r in cur.execute("PRAGMA table_info(tile)")]:
+        cur.execute("ALTER TABLE tile ADD COLUMN hash BLOB")
+        changed = True
+
+    # Cleanup looks for images which aren't referenced by tiles
+    if b'tile_hash_idx' not in tables:
+        cur.execute("CREATE INDEX IF NOT EXISTS tile_hash_idx ON tile (hash)")
+        changed = True
+
+    if b'tile_blob' not in tables:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS tile_blob (
+                hash BLOB PRIMARY KEY,
+                data BLOB NOT NULL
+            )
+        """)
+
+    # Tile metadata table is the same as tile_cache."<uuid>" table in
+    # PostgreSQL and it's used when tile_cache.storage = sqlite.
+    if b'tile_meta' not in tables:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS tile_meta (
+                z INTEGER, x INTEGER, y INTEGER,
+                color INTEGER,
+                tstamp INTEGER NOT NULL,
                 PRIMARY KEY (z, x, y)
             )
         """)
 
+    if changed or len(tables) < 4:
         connection.commit()
 
     return connection, Lock()
 
 
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _sqlite_upsert(tilestor, table, update, rows):
+    """ Insert or update (z, x, y, ...) rows with multi-row INSERT """
+
+    ncols = 3 + len(update)
+    placeholder = '(' + ', '.join(['?'] * ncols) + ')'
+
+    for chunk in _chunks(rows, SQLITE_MAX_VARIABLES // ncols):
+        values = ', '.join([placeholder] * len(chunk))
+        if SQLITE_UPSERT:
+            query = (
+                'INSERT INTO {} VALUES {} ON CONFLICT (z, x, y) DO UPDATE SET '
+                .format(table, values)
+                + ', '.join('{0} = excluded.{0}'.format(c) for c in update))
+        else:
+            query = 'INSERT OR REPLACE INTO {} VALUES {}'.format(table, values)
+
+        tilestor.execute(query, [v for row in chunk for v in row])
+
+
+@lru_cache(COLOR_TILE_CACHE)
+def color_tile_png(color):
+    """ Encode single-color tile to PNG for serving without rendering """
+    buf = BytesIO()
+    Image.new('RGBA', (256, 256), unpack_color(color)).save(buf, format='PNG')
+    return buf.getvalue()
+
+
+class TileMemoryCache:
+    """ Thread-safe LRU cache of encoded tiles limited by total size in
+    bytes. Values are (tstamp, data) tuples and callers must check tstamp
+    against tile metadata. """
+
+    def __init__(self, maxsize):
+        self._cache = LRUCache(maxsize, getsizeof=lambda value: len(value[1]))
+        self._lock = Lock()
+
+    def get(self, key, tstamp):
+        with self._lock:
+            value = self._cache.get(key)
+        if value is not None and value[0] == tstamp:
+            return value[1]
+        return None
+
+    def put(self, key, tstamp, data):
+        with self._lock:
+            try:
+                self._cache[key] = (tstamp, data)
+            except ValueError:
+                # Value is too large for the cache
+                pass
+
+
 class TileWriterQueueException(Exception):
     pass
 
@@ -131,6 +255,9 @@ class TilestorWriter:
         self._shutdown = False
         atexit.register(self.wait_for_shutdown)
 
+        batch_max_tiles = env.render.tile_cache_write_batch_max_tiles
+        batch_deadline = env.render.tile_cache_write_batch_deadline
+
         data = None
         while True:
             self.cstart = None
@@ -151,6 +278,7 @@ class TilestorWriter:
                         continue
 
             db_path = data['db_path']
+            table_uuid = data['uuid']
 
             self.cstart = ptime = time()
 
@@ -159,118 +287,136 @@ class TilestorWriter:
 
             answers = []
 
+            # Rows to be written keyed by (z, x, y), so only the latest
+            # version of a tile in the batch is written.
+            meta_rows = dict()
+            data_rows = dict()
+
+            tilestor = None
+
             # Tile cache writer may fall sometimes in case of database connecti
             # problem for example. So we just skip a tile with error and log an
             # exception.
             try:
+                while data is not None and data['db_path'] == db_path:
+                    z, x, y = data['tile']
+                    tstamp = int((datetime.utcnow() - TIMESTAMP_EPOCH).total_seconds())
 
-                with transaction.manager:
-                    conn = DBSession.connection()
-                    tilestor, lock = get_tile_db(db_path)
+                    img = data['img']
+                    if img is not None and img.mode != 'RGBA':
+                        img = img.convert('RGBA')
 
-                    while data is not None and data['db_path'] == db_path:
-                        z, x, y = data['tile']
-                        tstamp = int((datetime.utcnow() - TIMESTAMP_EPOCH).total_seconds())
+                    colortuple = imgcolor(img)
+                    color = pack_color(colortuple) if colortuple is not None else None
 
-                        img = data['img']
-                        if img is not None and img.mode != 'RGBA':
-                            img = img.convert('RGBA')
+                    meta_rows[(z, x, y)] = (color, tstamp)
 
-                        colortuple = imgcolor(img)
-                        color = pack_color(colortuple) if colortuple is not None else None
+                    if color is None:
+                        buf = BytesIO()
+                        img.save(buf, format='PNG', compress_level=3)
+                        data_rows[(z, x, y)] = (tstamp, buf.getvalue())
+                    else:
+                        data_rows.pop((z, x, y), None)
 
-                        self._write_tile_meta(conn, data['uuid'], dict(
-                            z=z, x=x, y=y, color=color, tstamp=tstamp))
+                    if 'answer_queue' in data:
+                        answers.append(data['answer_queue'])
 
-                        if color is None:
-                            buf = BytesIO()
-                            img.save(buf, format='PNG', compress_level=3)
-                            value = buf.getvalue()
+                    tiles_written += 1
 
-                            with lock:
-                                self._write_tile_data(
-                                    tilestor, z, x, y,
-                                    tstamp, value)
+                    ctime = time()
+                    time_taken += ctime - ptime
 
-                        if 'answer_queue' in data:
-                            answers.append(data['answer_queue'])
+                    if tiles_written >= batch_max_tiles:
+                        # Break the batch
+                        data = None
+                    else:
+                        # Try to get next tile for the batch. Or break
+                        # the batch if there is no tiles left.
+                        if time_taken < batch_deadline:
+                            try:
+                                data = self.queue.get(timeout=(
+                                    batch_deadline - time_taken))
+                            except Empty:
+                                data = None
+                        else:
+                            data = None
 
-                        tiles_written += 1
+                    # Do not account queue block time
+                    ptime = time()
 
-                        ctime = time()
-                        time_taken += ctime - ptime
+                sqlite_meta = env.render.tile_cache_storage == 'sqlite'
+                tilestor, lock = get_tile_db(db_path)
 
-                        if tiles_written >= BATCH_MAX_TILES:
-                            # Break the batch
-                            data = None
-                        else:
-                            # Try to get next tile for the batch. Or break
-                            # the batch if there is no tiles left.
-                            if time_taken < BATCH_DEADLINE:
-                                try:
-                                    data = self.queue.get(timeout=(
-                                        BATCH_DEADLINE - time_taken))
-                                except Empty:
-                                    data = None
-                            else:
-                                data = None
+                # PostgreSQL isn't involved at all if tile metadata is stored
+                # in SQLite together with tile data.
+                with nullcontext() if sqlite_meta else transaction.manager:
+                    if not sqlite_meta:
+                        self._write_tile_meta(DBSession.connection(), table_uuid, meta_rows)
 
-                        # Do not account queue block time
-                        ptime = time()
+                        # Force zope session management to commit changes
+                        mark_changed(DBSession())
 
-                    # Force zope session management to commit changes
-                    mark_changed(DBSession())
-                    tilestor.commit()
+                    with lock:
+                        if sqlite_meta:
+                            self._write_tile_meta_sqlite(tilestor, meta_rows)
+                        self._write_tile_data(tilestor, data_rows)
+                        tilestor.commit()
 
-                    time_taken += time() - ptime
-                    _logger.debug(
-                        "%d tiles were written in %0.3f seconds (%0.1f per "
-                        "second, qsize = %d)", tiles_written, time_taken,
-                        tiles_written / time_taken, self.queue.qsize())
+                time_taken += time() - ptime
+                _logger.debug(
+                    "%d tiles were written in %0.3f seconds (%0.1f per "
+                    "second, qsize = %d)", tiles_written, time_taken,
+                    tiles_written / time_taken, self.queue.qsize())
 
                 # Report about sucess only after transaction commit
                 for a in answers:
                     a.put_nowait(None)
 
             except Exception as exc:
-                _logger.exception("Uncaught exception in tile writer: %s", exc.message)
+                _logger.exception("Uncaught exception in tile writer: %s", exc)
 
                 data = None
                 self.cstart = None
-                tilestor.rollback()
+                if tilestor is not None:
+                    tilestor.rollback()
+
+    def _write_tile_meta(self, conn, table_uuid, rows):
+        for chunk in _chunks(list(rows.items()), PG_UPSERT_ROWS):
+            values = list()
+            params = dict()
+            for i, ((z, x, y), (color, tstamp)) in enumerate(chunk):
+                values.append('(:z{0}, :x{0}, :y{0}, :color{0}, :tstamp{0})'.format(i))
+                params.update({
+                    'z%d' % i: z, 'x%d' % i: x, 'y%d' % i: y,
+                    'color%d' % i: color, 'tstamp%d' % i: tstamp})
 
-    def _write_tile_meta(self, conn, table_uuid, row):
-        result = conn.execute(db.sql.text(
-            'SELECT true FROM tile_cache."{}" '
-            'WHERE z = :z AND x = :x AND y = :y '
-            'LIMIT 1 FOR UPDATE'.format(table_uuid)
-        ), **row)
-
-        if result.returns_rows:
             conn.execute(db.sql.text(
-                'DELETE FROM tile_cache."{0}" '
-                'WHERE z = :z AND x = :x AND y = :y '
-                ''.format(table_uuid)
-            ), **row)
-
-        conn.execute(db.sql.text(
-            'INSERT INTO tile_cache."{0}" (z, x, y, color, tstamp) '
-            'VALUES (:z, :x, :y, :color, :tstamp)'.format(table_uuid)
-        ), **row)
-
-    def _write_tile_data(self, tilestor, z, x, y, tstamp, value):
-        tilestor.execute(
-            "DELETE FROM tile WHERE z = ? AND x = ? AND y = ?",
-            (z, x, y))
-
-        try:
+                'INSERT INTO tile_cache."{0}" (z, x, y, color, tstamp) '
+                'VALUES {1} ON CONFLICT (z, x, y) DO UPDATE '
+                'SET color = EXCLUDED.color, tstamp = EXCLUDED.tstamp'
+                .format(table_uuid, ', '.join(values))
+            ), **params)
+
+    def _write_tile_meta_sqlite(self, tilestor, rows):
+        _sqlite_upsert(tilestor, 'tile_meta', ('color', 'tstamp'), [
+            (z, x, y, color, tstamp)
+            for (z, x, y), (color, tstamp) in rows.items()])
+
+    def _write_tile_data(self, tilestor, rows):
+        blobs = dict()
+        tiles = list()
+        for (z, x, y), (tstamp, value) in rows.items():
+            digest = sha256(value).digest()
+            blobs[digest] = value
+            tiles.append((z, x, y, tstamp, b'', digest))
+
+        for chunk in _chunks(list(blobs.items()), SQLITE_MAX_VARIABLES // 2):
             tilestor.execute(
-                "INSERT INTO tile VALUES (?, ?, ?, ?, ?)",
-                (z, x, y, tstamp, value))
-        except sqlite3.IntegrityError:
-            # NOTE: Race condition with other proccess may occurs here.
-            # TODO: ON CONFLICT DO ... in SQLite >= 3.24.0 (python 3)
-            pass
+                'INSERT OR IGNORE INTO tile_blob VALUES '
+                + ', '.join(['(?, ?)'] * len(chunk)),
+                [v for row in chunk for v in row])
+
+        _sqlite_upsert(tilestor, 'tile', ('tstamp', 'data', 'hash'), tiles)
 
     def wait_for_shutdown(self, timeout=SHUTDOWN_TIMEOUT):
         if not self._worker.is_alive():
@@ -325,6 +471,8 @@ class ResourceTileCache(Base):
         self._sameta = None
         self._tiletab = None
         self._tilestor = None
+        self._invalidate_txn = None
+        self._invalidate_bounds = None
 
     def init_metadata(self):
         self._sameta = MetaData(schema='tile_cache')
@@ -351,6 +499,11 @@ class ResourceTileCache(Base):
             self.init_metadata()
         return self._tiletab
 
+    @property
+    def sqlite_meta(self):
+        """ Tile metadata is stored in SQLite instead of PostgreSQL """
+        return env.render.tile_cache_storage == 'sqlite'
+
     def get_tilestor(self):
         if self._tilestor is None:
             self._tilestor, self._lock = get_tile_db(self.tilestor_path)
@@ -364,26 +517,72 @@ class ResourceTileCache(Base):
 
         return os.path.join(tcpath, suuid[0:2], suuid[2:4], suuid)
 
-    def get_tile(self, tile):
+    def get_tile_meta(self, tile):
+        """ Get (color, tstamp) tuple of a cached tile or None if tile
+        doesn't exist or is expired """
+
         z, x, y = tile
 
-        conn = DBSession.connection()
-        trow = conn.execute(db.sql.text(
-            'SELECT color, tstamp '
-            'FROM tile_cache."{}" '
-            'WHERE z = :z AND x = :x AND y = :y'.format(self.uuid.hex)
-        ), z=z, x=x, y=y).fetchone()
+        if self.sqlite_meta:
+            tilestor, lock = self.get_tilestor()
+            with lock:
+                trow = tilestor.execute(
+                    'SELECT color, tstamp FROM tile_meta '
+                    'WHERE z = ? AND x = ? AND y = ?',
+                    (z, x, y)).fetchone()
+        else:
+            conn = DBSession.connection()
+            trow = conn.execute(db.sql.text(
+                'SELECT color, tstamp '
+                'FROM tile_cache."{}" '
+                'WHERE z = :z AND x = :x AND y = :y'.format(self.uuid.hex)
+            ), z=z, x=x, y=y).fetchone()
 
         if trow is None:
-            return False, None
+            return None
 
         color, tstamp = trow
 
         if self.ttl is not None:
             expdt = TIMESTAMP_EPOCH + timedelta(seconds=tstamp + self.ttl)
             if expdt <= datetime.utcnow():
+                return None
+
+        return color, tstamp
+
+    def _get_tile_data(self, z, x, y, tstamp):
+        memcache = env.render.tile_cache_memory
+        if memcache is not None:
+            key = (self.uuid.hex, z, x, y)
+            data = memcache.get(key, tstamp)
+            if data is not None:
+                return data
+
+        tilestor, lock = self.get_tilestor()
+        with lock:
+            srow = tilestor.execute(
+                'SELECT ' + SQLITE_TILE_DATA + ' FROM ' + SQLITE_TILE_JOIN
+                + ' WHERE t.z = ? AND t.x = ? AND t.y = ?',
+                (z, x, y)).fetchone()
+
+        if srow is None or srow[0] is None:
+            return None
+
+        if memcache is not None:
+            memcache.put(key, tstamp, srow[0])
+
+        return srow[0]
+
+    def get_tile(self, tile, meta=None):
+        z, x, y = tile
+
+        if meta is None:
+            meta = self.get_tile_meta(tile)
+            if meta is None:
                 return False, None
 
+        color, tstamp = meta
+
         if color is not None:
             colors = unpack_color(color)
             if colors[3] == 0:
@@ -391,16 +590,105 @@ class ResourceTileCache(Base):
             return True, Image.new('RGBA', (256, 256), colors)
 
         else:
+            data = self._get_tile_data(z, x, y, tstamp)
+            if data is None:
+                return False, None
+
+            return True, Image.open(BytesIO(data))
+
+    def get_tile_raw(self, tile, meta=None):
+        """ Get tile as PNG-encoded bytes without decoding. Returns (exists,
+        tstamp, data) tuple, data is None for empty tiles. """
+
+        z, x, y = tile
+
+        if meta is None:
+            meta = self.get_tile_meta(tile)
+            if meta is None:
+                return False, None, None
+
+        color, tstamp = meta
+
+        if color is not None:
+            if unpack_color(color)[3] == 0:
+                return True, tstamp, None
+            return True, tstamp, color_tile_png(color)
+
+        data = self._get_tile_data(z, x, y, tstamp)
+        if data is None:
+            return False, None, None
+
+        return True, tstamp, data
+
+    def get_tiles_meta(self, z, x_range, y_range):
+        """ Get metadata of tiles from ranges of tile coordinates at once.
+        Ranges are (min, max) with max excluded. Returns dict with (x, y)
+        keys and (color, tstamp) values for existing tiles only. """
+
+        xmin, xmax = x_range
+        ymin, ymax = y_range
+
+        if self.sqlite_meta:
             tilestor, lock = self.get_tilestor()
             with lock:
-                srow = tilestor.execute(
-                    'SELECT data FROM tile WHERE z = ? AND x = ? AND y = ?',
-                    (z, x, y)).fetchone()
+                trows = tilestor.execute(
+                    'SELECT x, y, color, tstamp FROM tile_meta WHERE z = ? '
+                    '   AND x >= ? AND x < ? AND y >= ? AND y < ?',
+                    (z, xmin, xmax, ymin, ymax)).fetchall()
+        else:
+            conn = DBSession.connection()
+            trows = conn.execute(db.sql.text(
+                'SELECT x, y, color, tstamp '
+                'FROM tile_cache."{}" '
+                'WHERE z = :z AND x >= :xmin AND x < :xmax '
+                '   AND y >= :ymin AND y < :ymax'.format(self.uuid.hex)
+            ), z=z, xmin=xmin, xmax=xmax, ymin=ymin, ymax=ymax).fetchall()
 
-            if srow is None:
-                return False, None
+        if self.ttl is not None:
+            expts = int((datetime.utcnow() - TIMESTAMP_EPOCH).total_seconds()) - self.ttl
+        else:
+            expts = None
+
+        result = dict()
+        for x, y, color, tstamp in trows:
+            if expts is not None and tstamp <= expts:
+                continue
+            result[(x, y)] = (color, tstamp)
+
+        return result
+
+    def get_tiles(self, z, x_range, y_range, meta=None):
+        """ Get tiles from ranges of tile coordinates at once. Ranges are
+        (min, max) with max excluded. Returns dict with (x, y) keys for
+        existing tiles only. """
+
+        if meta is None:
+            meta = self.get_tiles_meta(z, x_range, y_range)
+
+        result = dict()
+        data_keys = set()
+
+        for (x, y), (color, tstamp) in meta.items():
+            if color is not None:
+                colors = unpack_color(color)
+                result[(x, y)] = None if colors[3] == 0 \
+                    else Image.new('RGBA', (256, 256), colors)
+            else:
+                data_keys.add((x, y))
+
+        if len(data_keys) > 0:
+            tilestor, lock = self.get_tilestor()
+            with lock:
+                srows = tilestor.execute(
+                    'SELECT t.x, t.y, ' + SQLITE_TILE_DATA + ' FROM ' + SQLITE_TILE_JOIN
+                    + ' WHERE t.z = ? AND t.x >= ? AND t.x < ? AND t.y >= ? AND t.y < ?',
+                    (z, x_range[0], x_range[1], y_range[0], y_range[1])).fetchall()
 
-            return True, Image.open(BytesIO(srow[0]))
+            for x, y, data in srows:
+                if (x, y) in data_keys and data is not None:
+                    result[(x, y)] = Image.open(BytesIO(data))
+
+        return result
 
     def put_tile(self, tile, img, timeout=None):
         params = dict(
@@ -447,45 +735,97 @@ class ResourceTileCache(Base):
         self.initialize()
 
     def invalidate(self, geom):
-        srs = self.resource.srs
         with transaction.manager:
-            conn = DBSession.connection()
+            self._invalidate([geom.bounds])
 
-            # TODO: This query uses sequnce scan and should be rewritten
-            query_z = db.sql.text(
-                'SELECT DISTINCT z FROM tile_cache."{}"'
-                .format(self.uuid.hex))
+    def invalidate_deferred(self, geom):
+        """ Invalidate tiles at the end of the current transaction. So many
+        data changes within a transaction lead to a single invalidation. """
 
-            query_delete = db.sql.text(
-                'DELETE FROM tile_cache."{0}" '
-                'WHERE z = :z '
-                '   AND x BETWEEN :xmin AND :xmax '
-                '   AND y BETWEEN :ymin AND :ymax '
-                .format(self.uuid.hex))
+        txn = transaction.get()
+        if self._invalidate_txn is not txn:
+            self._invalidate_txn = txn
+            self._invalidate_bounds = list()
+            txn.addBeforeCommitHook(self._invalidate_flush)
 
-            zlist = [a[0] for a in conn.execute(query_z).fetchall()]
-            for z in zlist:
-                aft = affine_bounds_to_tile((srs.minx, srs.miny, srs.maxx, srs.maxy), z)
+        self._invalidate_bounds.append(geom.bounds)
 
-                xmin, ymax = [int(a) for a in aft * geom.bounds[0:2]]
-                xmax, ymin = [int(a) for a in aft * geom.bounds[2:4]]
+    def _invalidate_flush(self):
+        bounds = self._invalidate_bounds
+        self._invalidate_txn = None
+        self._invalidate_bounds = None
+        self._invalidate(bounds)
 
-                xmin -= 1
-                ymin -= 1
-                xmax += 1
-                ymax += 1
+    def _invalidate(self, bounds):
+        srs = self.resource.srs
+        sqlite_meta = self.sqlite_meta
+        tilestor, lock = self.get_tilestor()
 
+        if sqlite_meta:
+            with lock:
+                zlist = [r[0] for r in tilestor.execute(
+                    SQL_DISTINCT_Z.format('tile_meta')).fetchall()]
+        else:
+            conn = DBSession.connection()
+            zlist = [r[0] for r in conn.execute(db.sql.text(
+                SQL_DISTINCT_Z.format('tile_cache."{}"'.format(self.uuid.hex))
+            )).fetchall()]
+
+        if self.max_z is not None:
+            zlist = [z for z in zlist if z <= self.max_z]
+
+        params = list()
+        for z in zlist:
+            aft = affine_bounds_to_tile((srs.minx, srs.miny, srs.maxx, srs.maxy), z)
+
+            # Tile ranges of many small changes are the same on low zoom
+            # levels, so delete each range once.
+            ranges = set()
+            for b in bounds:
+                xmin, ymax = [int(a) for a in aft * b[0:2]]
+                xmax, ymin = [int(a) for a in aft * b[2:4]]
+                ranges.add((xmin - 1, ymin - 1, xmax + 1, ymax + 1))
+
+            for xmin, ymin, xmax, ymax in ranges:
                 env.render.logger.debug(
                     'Removing tiles for z=%d x=%d..%d y=%d..%d',
                     z, xmin, xmax, ymin, ymax)
 
-                conn.execute(
-                    query_delete, z=z,
-                    xmin=xmin, ymin=ymin,
-                    xmax=xmax, ymax=ymax)
+                params.append(dict(z=z, xmin=xmin, ymin=ymin, xmax=xmax, ymax=ymax))
 
+        if len(params) == 0:
+            return
+
+        query_delete = (
+            'DELETE FROM {} WHERE z = :z '
+            '   AND x BETWEEN :xmin AND :xmax '
+            '   AND y BETWEEN :ymin AND :ymax ')
+
+        if not sqlite_meta:
+            conn.execute(db.sql.text(query_delete.format(
+                'tile_cache."{}"'.format(self.uuid.hex))), params)
             mark_changed(DBSession())
 
+        # Low zoom tiles are requested most often and they are the most
+        # expensive to render, so queue them for background rendering.
+        if env.render.tile_cache_refresh_enabled:
+            tstamp = datetime.utcnow()
+            refresh = [
+                dict(resource_id=self.resource_id, tstamp=tstamp, **p)
+                for p in params if p['z'] <= env.render.tile_cache_refresh_max_z]
+            if len(refresh) > 0:
+                DBSession.connection().execute(
+                    ResourceTileCacheRefresh.__table__.insert(), refresh)
+                mark_changed(DBSession())
+
+        with lock:
+            if sqlite_meta:
+                tilestor.executemany(query_delete.format('tile_meta'), params)
+
+            # Images are deleted by cleanup when no tile refers them
+            tilestor.executemany(query_delete.format('tile'), params)
+            tilestor.commit()
+
     def update_seed_status(self, value, progress=None, total=None):
         self.seed_status = value
         self.seed_progress = progress
@@ -493,6 +833,21 @@ class ResourceTileCache(Base):
         self.seed_tstamp = datetime.utcnow()
 
 
+class ResourceTileCacheRefresh(Base):
+    """ Persistent queue of invalidated tile ranges to be rendered again """
+
+    __tablename__ = 'resource_tile_cache_refresh'
+
+    id = db.Column(db.Integer, primary_key=True)
+    resource_id = db.Column(db.ForeignKey(Resource.id, ondelete='CASCADE'), nullable=False)
+    z = db.Column(db.SmallInteger, nullable=False)
+    xmin = db.Column(db.Integer, nullable=False)
+    xmax = db.Column(db.Integer, nullable=False)
+    ymin = db.Column(db.Integer, nullable=False)
+    ymax = db.Column(db.Integer, nullable=False)
+    tstamp = db.Column(db.TIMESTAMP, nullable=False)
+
+
 db.event.listen(
     ResourceTileCache.__table__, 'after_create',
     db.DDL('CREATE SCHEMA IF NOT EXISTS tile_cache'),
@@ -522,7 +877,7 @@ def on_data_change_handler(resource, geom):
         and resource.tile_cache is not None  # NOQA: W503
         and resource.tile_cache.track_changes  # NOQA: W503
     ):
-        resource.tile_cache.invalidate(geom)
+        resource.tile_cache.invalidate_deferred(geom)
 
 
 class ResourceTileCacheSeializedProperty(SerializedProperty):
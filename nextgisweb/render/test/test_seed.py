@@ -0,0 +1,122 @@
+from argparse import Namespace
+from pathlib import Path
+
+import pytest
+import transaction
+from pyproj import Transformer
+
+from nextgisweb.auth import User
+from nextgisweb.env import env
+from nextgisweb.models import DBSession
+from nextgisweb.raster_layer import RasterLayer
+from nextgisweb.raster_style import RasterStyle
+from nextgisweb.spatial_ref_sys import SRS
+
+from nextgisweb.render import command
+from nextgisweb.render.command import TileCacheSeedCommand, seed_executor
+from nextgisweb.render.model import ResourceTileCache
+
+SEED_Z = 10
+
+
+@pytest.fixture
+def seed_tc(ngw_env, ngw_resource_group, monkeypatch):
+    # Wait for tiles to be written, so they can be read back
+    monkeypatch.setattr(ResourceTileCache, 'async_writing', True)
+
+    with transaction.manager:
+        layer = RasterLayer(
+            parent_id=ngw_resource_group, display_name='test-seed-rlayer',
+            owner_user=User.by_keyname('administrator'),
+            srs=SRS.filter_by(id=3857).one(),
+        ).persist()
+
+        import nextgisweb.raster_layer.test
+        path = Path(nextgisweb.raster_layer.test.__file__).parent \
+            / 'data/sochi-aster-colorized.tif'
+        layer.load_file(str(path), ngw_env)
+
+        style = RasterStyle(
+            parent=layer, display_name='test-seed-rstyle',
+            owner_user=User.by_keyname('administrator'),
+        ).persist()
+
+        tc = ResourceTileCache(resource=style, seed_z=SEED_Z).persist()
+        DBSession.flush()
+        tc.initialize()
+
+    yield style.id
+
+    with transaction.manager:
+        DBSession.delete(RasterStyle.filter_by(id=style.id).one())
+        DBSession.delete(RasterLayer.filter_by(id=layer.id).one())
+
+
+def _seed(resource_id, metatile, skip_empty=False, jobs=1):
+    args = Namespace(metatile=metatile, jobs=jobs, skip_empty=skip_empty)
+    srs_tr = Transformer.from_crs(4326, 3857, always_xy=True)
+
+    executor = seed_executor(env, jobs) if jobs > 1 else None
+    try:
+        with transaction.manager:
+            TileCacheSeedCommand.seed(resource_id, args, executor, srs_tr)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+def _stored(resource_id):
+    with transaction.manager:
+        tc = ResourceTileCache.filter_by(resource_id=resource_id).one()
+
+        result = dict()
+        for z in range(1, SEED_Z + 1):
+            tmax = 2 ** z
+            for (x, y), (color, tstamp) in tc.get_tiles_meta(
+                z, (0, tmax), (0, tmax)
+            ).items():
+                result[(z, x, y)] = color
+        return result
+
+
+def _clear(resource_id):
+    with transaction.manager:
+        ResourceTileCache.filter_by(resource_id=resource_id).one().clear()
+
+
+def test_seed_metatile(seed_tc):
+    _seed(seed_tc, metatile=1)
+    expected = _stored(seed_tc)
+    assert len(expected) >= SEED_Z
+
+    # Tiles sliced from metatiles are stored under the same keys, including
+    # metatiles rendered by worker processes
+    for metatile, jobs in ((2, 1), (4, 1), (4, 2)):
+        _clear(seed_tc)
+        _seed(seed_tc, metatile=metatile, jobs=jobs)
+        assert _stored(seed_tc).keys() == expected.keys()
+
+    # Image data is stored for tiles which aren't a single color
+    assert any(color is None for color in expected.values())
+
+
+@pytest.mark.parametrize('skip_empty', (True, False))
+def test_seed_skip_empty(skip_empty, seed_tc, monkeypatch):
+    rendered = list()
+
+    def render_metatile(rend_res, srs, z, xrange, yrange):
+        rendered.append(z)
+        return []
+
+    # Everything is transparent, so levels below the first one are skipped
+    monkeypatch.setattr(command, 'render_metatile', render_metatile)
+
+    _seed(seed_tc, metatile=2, skip_empty=skip_empty)
+    stored = _stored(seed_tc)
+
+    if skip_empty:
+        assert set(rendered) == {1}
+        assert set(z for z, x, y in stored) == {1}
+    else:
+        assert set(rendered) == set(range(1, SEED_Z + 1))
+        assert set(z for z, x, y in stored) == set(range(1, SEED_Z + 1))
@@ -1,3 +1,4 @@
+from io import BytesIO
 from time import sleep
 from uuid import uuid4
 import logging
@@ -13,12 +14,16 @@ from nextgisweb.vector_layer import VectorLayer
 from nextgisweb.spatial_ref_sys import SRS
 from nextgisweb.auth import User
 
-from nextgisweb.render.model import ResourceTileCache
+from nextgisweb.render.model import (
+    ResourceTileCache, ResourceTileCacheRefresh, TILE_CACHE_STORAGE)
 from nextgisweb.render.util import pack_color, unpack_color
 
 
-@pytest.fixture
-def frtc(ngw_resource_group):
+@pytest.fixture(params=TILE_CACHE_STORAGE)
+def frtc(request, ngw_env, ngw_resource_group):
+    storage = ngw_env.render.tile_cache_storage
+    ngw_env.render.tile_cache_storage = request.param
+
     with transaction.manager:
         vector_layer = VectorLayer(
             parent_id=ngw_resource_group, display_name='from_fields',
@@ -43,6 +48,8 @@ def frtc(ngw_resource_group):
         DBSession.delete(ResourceTileCache.filter_by(resource_id=result.resource_id).one())
         DBSession.delete(VectorLayer.filter_by(id=vector_layer.id).one())
 
+    ngw_env.render.tile_cache_storage = storage
+
 
 @pytest.fixture
 def img_cross_red():
@@ -145,3 +152,107 @@ def test_invalidate(frtc, img_cross_red, img_cross_green, img_fill, caplog):
     frtc.put_tile(tile_invalid, img_cross_green)
     exists, cimg = frtc.get_tile(tile_invalid)
     assert exists and cimg.getextrema() == img_cross_green.getextrema()
+
+
+def test_get_tiles(frtc, img_cross_red, img_fill, img_empty):
+    frtc.put_tile((2, 0, 0), img_cross_red)
+    frtc.put_tile((2, 1, 0), img_fill)
+    frtc.put_tile((2, 0, 1), img_empty)
+    frtc.put_tile((2, 3, 3), img_cross_red)
+
+    tiles = frtc.get_tiles(2, (0, 2), (0, 2))
+    assert set(tiles.keys()) == {(0, 0), (1, 0), (0, 1)}
+    assert tiles[(0, 0)].getextrema() == img_cross_red.getextrema()
+    assert tiles[(1, 0)].getextrema() == img_fill.getextrema()
+    assert tiles[(0, 1)] is None
+
+
+def test_get_tile_raw(frtc, img_cross_red, img_fill, img_empty):
+    frtc.put_tile((1, 0, 0), img_cross_red)
+    frtc.put_tile((1, 1, 0), img_fill)
+    frtc.put_tile((1, 0, 1), img_empty)
+
+    for _ in range(2):  # Second time from the memory cache
+        exists, tstamp, data = frtc.get_tile_raw((1, 0, 0))
+        assert exists and tstamp is not None
+        assert Image.open(BytesIO(data)).getextrema() == img_cross_red.getextrema()
+
+    exists, tstamp, data = frtc.get_tile_raw((1, 1, 0))
+    assert exists and Image.open(BytesIO(data)).getextrema() == img_fill.getextrema()
+
+    exists, tstamp, data = frtc.get_tile_raw((1, 0, 1))
+    assert exists and data is None
+
+    exists, tstamp, data = frtc.get_tile_raw((1, 1, 1))
+    assert not exists
+
+
+def test_get_tile_meta(frtc, img_cross_red):
+    tile = (3, 1, 2)
+    assert frtc.get_tile_meta(tile) is None
+
+    frtc.put_tile(tile, img_cross_red)
+    color, tstamp = frtc.get_tile_meta(tile)
+    assert color is None and tstamp > 0
+
+    meta = frtc.get_tiles_meta(3, (0, 4), (0, 4))
+    assert meta == {(1, 2): (color, tstamp)}
+
+
+def test_deduplication(frtc, img_cross_red, img_cross_green):
+    frtc.put_tile((2, 0, 0), img_cross_red)
+    frtc.put_tile((2, 1, 0), img_cross_red)
+    frtc.put_tile((2, 0, 1), img_cross_green)
+
+    tilestor, lock = frtc.get_tilestor()
+    with lock:
+        count = tilestor.execute('SELECT count(*) FROM tile_blob').fetchone()[0]
+    assert count == 2
+
+    for tile in ((2, 0, 0), (2, 1, 0)):
+        exists, cimg = frtc.get_tile(tile)
+        assert exists and cimg.getextrema() == img_cross_red.getextrema()
+
+
+def test_invalidate_deferred(frtc, img_cross_red):
+    tile = (4, 0, 0)
+    frtc.put_tile(tile, img_cross_red)
+
+    geom = Geometry.from_shape(Point(
+        *frtc.resource.srs.tile_center(tile)),
+        srid=None)
+
+    with transaction.manager:
+        frtc.invalidate_deferred(geom)
+        frtc.invalidate_deferred(geom)
+
+        exists, cimg = frtc.get_tile(tile)
+        assert exists
+
+    exists, cimg = frtc.get_tile(tile)
+    assert not exists
+
+
+def test_invalidate_refresh(ngw_env, frtc, img_cross_red):
+    enabled = ngw_env.render.tile_cache_refresh_enabled
+    ngw_env.render.tile_cache_refresh_enabled = True
+
+    try:
+        # Point inside both tiles, one above the max_z and one below
+        zmax = ngw_env.render.tile_cache_refresh_max_z + 1
+        geom = Geometry.from_shape(Point(
+            *frtc.resource.srs.tile_center((zmax, 0, 0))),
+            srid=None)
+
+        for z in (4, zmax):
+            frtc.put_tile((z, 0, 0), img_cross_red)
+        frtc.invalidate(geom)
+
+        with transaction.manager:
+            items = ResourceTileCacheRefresh.filter_by(
+                resource_id=frtc.resource_id).all()
+            assert [(i.z, i.xmin, i.ymin) for i in items] == [(4, 0, 0)]
+            for i in items:
+                DBSession.delete(i)
+    finally:
+        ngw_env.render.tile_cache_refresh_enabled = enabled
@@ -1,5 +1,7 @@
 import re
+from datetime import datetime, timedelta
 
+import transaction
 from sqlalchemy.orm.exc import NoResultFound
 
 from .. import db
@@ -8,6 +10,7 @@ from ..component import Component, require
 from ..auth import User, Group
 from ..models import DBSession
 
+from .export_job import ResourceExportJob, export_job_handler
 from .model import (
     Base,
     Resource,
@@ -19,6 +22,7 @@ from .serialize import (
     SerializedRelationship,
     SerializedResourceRelationship)
 from .util import _
+from . import command  # NOQA
 
 from .events import *    # NOQA
 from .exception import *    # NOQA
@@ -34,6 +38,8 @@ __all__ = [  # NOQA: F405
     'AfterResourceCollectionPost',
     'AfterResourcePut',
     'Resource',
+    'ResourceExportJob',
+    'export_job_handler',
     'IResourceBase',
     'Serializer',
     'SerializedProperty',
@@ -60,6 +66,9 @@ class ResourceComponent(Component):
 
         self.quota_resource_by_cls = self.parse_quota_resource_by_cls()
 
+        self.export_job_ttl = self.options['export_job.ttl']
+        self.export_job_timeout = self.options['export_job.timeout']
+
     def parse_quota_resource_by_cls(self):
         quota_resource_by_cls = dict()
 
@@ -100,6 +109,28 @@ class ResourceComponent(Component):
         view.setup_pyramid(self, config)
         api.setup_pyramid(self, config)
 
+    def maintenance(self):
+        super().maintenance()
+        self.cleanup_export_jobs()
+
+    def cleanup_export_jobs(self):
+        """ Remove outdated and expired export jobs, result files are
+        removed later by file storage cleanup """
+
+        expired = datetime.utcnow() - self.export_job_ttl
+        query = ResourceExportJob.filter(db.or_(
+            ResourceExportJob.outdated,
+            ResourceExportJob.finished < expired,
+        ), ResourceExportJob.status.in_(('done', 'failed')))
+
+        count = 0
+        with transaction.manager:
+            for job in query:
+                DBSession.delete(job)
+                count += 1
+
+        self.logger.info("Export jobs removed: %d", count)
+
     def query_stat(self):
         query = DBSession.query(Resource.cls, db.func.count(Resource.id)) \
             .group_by(Resource.cls)
@@ -123,4 +154,8 @@ class ResourceComponent(Component):
         Option('quota.limit', int, default=None),
         Option('quota.resource_cls', list, default=None),
         Option('quota.resource_by_cls'),
+        Option('export_job.ttl', timedelta, default=timedelta(days=1),
+               doc="Time to keep results of export jobs."),
+        Option('export_job.timeout', timedelta, default=timedelta(minutes=5),
+               doc="Running export jobs without heartbeat for this time are failed."),
     )
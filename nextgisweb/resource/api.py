@@ -2,8 +2,8 @@ import json
 from collections import OrderedDict
 import zope.event
 
-from pyramid.httpexceptions import HTTPBadRequest
-from pyramid.response import Response
+from pyramid.httpexceptions import HTTPBadRequest, HTTPNotFound
+from pyramid.response import Response, FileResponse
 from sqlalchemy.sql.operators import ilike_op
 from sqlalchemy.sql.expression import collate
 
@@ -14,12 +14,13 @@ from ..models import DBSession
 from ..auth import User
 
 from .model import Resource, ResourceSerializer
-from .scope import ResourceScope
+from .scope import ResourceScope, DataScope
 from .exception import ResourceError, ValidationError
 from .serialize import CompositeSerializer
 from .view import resource_factory
 from .util import _
 from .events import AfterResourcePut, AfterResourceCollectionPost
+from .export_job import ResourceExportJob, find_export_handler
 from .presolver import PermissionResolver, ExplainACLRule, ExplainRequirement, ExplainDefault
 
 
@@ -398,6 +399,53 @@ def resource_export_put(request):
             raise HTTPBadRequest("Invalid key '%s'" % k)
 
 
+def export_job_post(resource, request):
+    request.resource_permission(DataScope.read)
+
+    handler = find_export_handler(resource)
+    if handler is None:
+        raise ValidationError(_("Resource can't be exported."))
+
+    params = request.json_body
+    if not isinstance(params, dict):
+        raise ValidationError(_("Export parameters should be an object."))
+
+    validate = handler[1]
+    if validate is not None:
+        validate(resource, params)
+
+    job = ResourceExportJob.create(resource, params)
+    return job.to_dict()
+
+
+def _export_job(resource, request):
+    request.resource_permission(DataScope.read)
+
+    job = ResourceExportJob.filter_by(
+        id=int(request.matchdict['job_id']),
+        resource_id=resource.id).first()
+    if job is None:
+        raise HTTPNotFound()
+
+    return job
+
+
+def export_job_get(resource, request):
+    return _export_job(resource, request).to_dict()
+
+
+def export_job_download(resource, request):
+    job = _export_job(resource, request)
+    if job.status != 'done':
+        raise ValidationError(_("Export job is not completed yet."))
+
+    response = FileResponse(
+        request.env.file_storage.filename(job.fileobj),
+        content_type=job.content_type, request=request)
+    response.content_disposition = "attachment; filename=%s" % job.filename
+    return response
+
+
 def setup_pyramid(comp, config):
 
     config.add_route(
@@ -444,6 +492,22 @@ def setup_pyramid(comp, config):
         'resource.export', '/api/resource/{id}/export',
         factory=resource_factory)
 
+    config.add_route(
+        'resource.export_job.collection', r'/api/resource/{id:\d+}/export_job/',
+        factory=resource_factory) \
+        .add_view(export_job_post, request_method='POST', renderer='json')
+
+    config.add_route(
+        'resource.export_job.item', r'/api/resource/{id:\d+}/export_job/{job_id:\d+}',
+        factory=resource_factory) \
+        .add_view(export_job_get, request_method='GET', renderer='json')
+
+    config.add_route(
+        'resource.export_job.download',
+        r'/api/resource/{id:\d+}/export_job/{job_id:\d+}/download',
+        factory=resource_factory) \
+        .add_view(export_job_download, request_method='GET')
+
     config.add_route(
         'resource.file_download', r'/api/resource/{id:\d+}/file/{name:.*}',
         factory=resource_factory)
@@ -0,0 +1,104 @@
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from time import monotonic, sleep
+
+import transaction
+
+from ..command import Command
+from ..models import DBSession
+
+from .export_job import ResourceExportJob, _update_job, run_export_job, touch_jobs
+
+_logger = logging.getLogger(__name__)
+
+
+@Command.registry.register
+class ExportWorkerCommand():
+    identity = 'resource.export_worker'
+
+    @classmethod
+    def argparser_setup(cls, parser, env):
+        parser.add_argument(
+            '--jobs', type=int, default=1,
+            help="Number of export processes")
+        parser.add_argument(
+            '--watch', action='store_true', default=False,
+            help="Keep waiting for new export jobs")
+        parser.add_argument(
+            '--interval', type=int, default=5,
+            help="Polling interval in seconds in watch mode")
+
+    @classmethod
+    def execute(cls, args, env):
+        if args.jobs < 1:
+            raise ValueError("Number of jobs should be positive.")
+
+        # Workers are forked with the pool, so don't share database
+        # connections of the parent process with them.
+        transaction.commit()
+        DBSession.remove()
+        env.core.engine.dispose()
+
+        def new_executor():
+            return ProcessPoolExecutor(
+                max_workers=args.jobs,
+                mp_context=multiprocessing.get_context('fork'))
+
+        executor = new_executor()
+        heartbeat_interval = env.resource.export_job_timeout.total_seconds() / 4
+
+        pending = dict()
+        heartbeat = monotonic()
+        try:
+            while True:
+                while len(pending) < args.jobs:
+                    with transaction.manager:
+                        job_id = ResourceExportJob.claim()
+                    if job_id is None:
+                        break
+
+                    # Pool processes are forked on submit
+                    DBSession.remove()
+                    env.core.engine.dispose()
+
+                    _logger.info("Export job %d started", job_id)
+                    pending[job_id] = executor.submit(run_export_job, job_id)
+
+                broken = False
+                for job_id, future in list(pending.items()):
+                    if not future.done():
+                        continue
+                    del pending[job_id]
+
+                    try:
+                        result = future.result()
+                    except Exception as exc:
+                        # Process was killed or exception wasn't handled
+                        # by the job itself, so mark it failed here.
+                        _logger.exception("Export job %d crashed", job_id)
+                        _update_job(
+                            job_id, status='failed', message=str(exc) or repr(exc),
+                            finished=datetime.utcnow())
+                        broken = broken or isinstance(exc, BrokenProcessPool)
+                    else:
+                        _logger.info("Export job %d %s", job_id, (
+                            'completed' if result else 'failed'))
+
+                if broken:
+                    _logger.warning("Export process pool is broken, recreating")
+                    executor.shutdown(wait=False)
+                    executor = new_executor()
+
+                if len(pending) > 0 and monotonic() - heartbeat > heartbeat_interval:
+                    touch_jobs(list(pending))
+                    heartbeat = monotonic()
+
+                if len(pending) == 0 and not args.watch:
+                    break
+
+                sleep(args.interval if len(pending) == 0 else 0.5)
+        finally:
+            executor.shutdown()
@@ -0,0 +1,240 @@
+import json
+import logging
+import os
+import os.path
+import shutil
+import tempfile
+from datetime import datetime
+from weakref import WeakKeyDictionary
+
+import transaction
+from zope.interface.interface import InterfaceClass
+
+from .. import db
+from ..env import env
+from ..file_storage import FileObj
+from ..models import DBSession
+
+from .model import Base, Resource
+
+__all__ = [
+    'ResourceExportJob',
+    'export_job_handler',
+    'run_export_job',
+    'touch_jobs',
+]
+
+_logger = logging.getLogger(__name__)
+
+JOB_STATUS = ('pending', 'running', 'done', 'failed')
+
+_handlers = list()
+
+# Resources with outdated jobs per transaction
+_outdated = WeakKeyDictionary()
+
+
+def export_job_handler(context, validate=None):
+    """ Register export function for resources providing an interface or
+    being instances of a class given in context
+
+    Export function is called as ``export(resource, params, path, progress)``,
+    it should write a single file to path and return its file name and
+    content type. Progress callback accepts a value in 0..1 range. Validate
+    function is called with resource and params when job is created. """
+
+    def _decorator(func):
+        _handlers.append((context, func, validate))
+        return func
+
+    return _decorator
+
+
+def find_export_handler(resource):
+    for context, func, validate in _handlers:
+        if isinstance(context, InterfaceClass):
+            if context.providedBy(resource):
+                return func, validate
+        elif isinstance(resource, context):
+            return func, validate
+    return None
+
+
+class ResourceExportJob(Base):
+    __tablename__ = 'resource_export_job'
+
+    id = db.Column(db.Integer, primary_key=True)
+    resource_id = db.Column(
+        db.ForeignKey(Resource.id, ondelete='CASCADE'), nullable=False, index=True)
+    params = db.Column(db.Unicode, nullable=False)
+    status = db.Column(db.Enum(*JOB_STATUS, native_enum=False), nullable=False, default='pending')
+    progress = db.Column(db.Float, nullable=False, default=0)
+    message = db.Column(db.Unicode)
+    outdated = db.Column(db.Boolean, nullable=False, default=False)
+    fileobj_id = db.Column(db.ForeignKey(FileObj.id))
+    filename = db.Column(db.Unicode)
+    content_type = db.Column(db.Unicode)
+    created = db.Column(db.TIMESTAMP, nullable=False)
+    started = db.Column(db.TIMESTAMP)
+    heartbeat = db.Column(db.TIMESTAMP)
+    finished = db.Column(db.TIMESTAMP)
+
+    resource = db.relationship(Resource, backref=db.backref(
+        'export_jobs', cascade='all, delete-orphan', passive_deletes=True))
+    fileobj = db.relationship(FileObj, cascade='all', single_parent=True)
+
+    @classmethod
+    def create(cls, resource, params):
+        """ Get a job exporting the same data with the same parameters or
+        create a new one """
+
+        params = json.dumps(params, sort_keys=True)
+        query = cls.filter(
+            cls.resource_id == resource.id,
+            cls.params == params,
+            cls.status != 'failed',
+            db.not_(cls.outdated),
+            db.not_(cls._stale()),
+        )
+
+        # Data of resources which don't notify about changes (like PostGIS
+        # tables changed by other applications) may be changed since the
+        # job is completed, so only unfinished jobs are reused.
+        if not getattr(resource, 'fires_data_change', False):
+            query = query.filter(cls.status != 'done')
+
+        job = query.order_by(cls.id.desc()).first()
+
+        if job is None:
+            job = cls(
+                resource=resource, params=params,
+                created=datetime.utcnow()).persist()
+            DBSession.flush()
+
+        return job
+
+    @classmethod
+    def outdate(cls, resource_id):
+        """ Mark jobs of the resource as outdated, so they won't be reused,
+        pending jobs aren't affected as they will read the actual data """
+
+        outdated = _outdated.setdefault(transaction.get(), set())
+        if resource_id in outdated:
+            return
+        outdated.add(resource_id)
+
+        DBSession.query(cls).filter(
+            cls.resource_id == resource_id,
+            cls.status != 'pending',
+            db.not_(cls.outdated),
+        ).update(dict(outdated=True), synchronize_session=False)
+
+    @classmethod
+    def _stale(cls):
+        # Running job without heartbeat for longer than timeout belongs to
+        # a worker which was killed or crashed.
+        deadline = datetime.utcnow() - env.resource.export_job_timeout
+        return db.and_(cls.status == 'running', cls.heartbeat < deadline)
+
+    @classmethod
+    def fail_stale(cls):
+        """ Mark running jobs of dead workers as failed """
+        DBSession.query(cls).filter(cls._stale()).update(dict(
+            status='failed', message="Export worker stopped responding.",
+            finished=datetime.utcnow(),
+        ), synchronize_session=False)
+
+    @classmethod
+    def claim(cls):
+        """ Lock the oldest pending job and mark it as running """
+        cls.fail_stale()
+
+        job = cls.filter_by(status='pending').order_by(cls.id) \
+            .with_for_update(skip_locked=True).first()
+        if job is None:
+            return None
+
+        job.status = 'running'
+        job.started = job.heartbeat = datetime.utcnow()
+        return job.id
+
+    def to_dict(self):
+        return dict(
+            id=self.id,
+            resource=dict(id=self.resource_id),
+            params=json.loads(self.params),
+            status=self.status,
+            progress=self.progress,
+            message=self.message,
+            outdated=self.outdated,
+            filename=self.filename,
+            created=self.created.isoformat(),
+            started=self.started.isoformat() if self.started else None,
+            finished=self.finished.isoformat() if self.finished else None,
+        )
+
+
+def _update_job(job_id, **values):
+    # Job state is updated outside of the export transaction, so the
+    # progress is visible to others while export is running.
+    with env.core.engine.begin() as conn:
+        conn.execute(db.update(ResourceExportJob.__table__).where(
+            ResourceExportJob.__table__.c.id == job_id
+        ).values(**values))
+
+
+def touch_jobs(job_ids):
+    """ Update heartbeat of running jobs, it's done by the worker process
+    as export functions may not report progress for a long time """
+
+    tab = ResourceExportJob.__table__
+    with env.core.engine.begin() as conn:
+        conn.execute(db.update(tab).where(db.and_(
+            tab.c.id.in_(job_ids), tab.c.status == 'running',
+        )).values(heartbeat=datetime.utcnow()))
+
+
+def run_export_job(job_id):
+    """ Execute claimed export job and store its result in file storage """
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        with transaction.manager:
+            job = ResourceExportJob.filter_by(id=job_id).one()
+            resource = job.resource
+            handler = find_export_handler(resource)
+            if handler is None:
+                raise ValueError("Resource (ID=%d) can't be exported." % resource.id)
+
+            def progress(value):
+                _update_job(
+                    job_id, progress=min(max(value, 0), 1),
+                    heartbeat=datetime.utcnow())
+
+            path = os.path.join(tmp_dir, 'result')
+            filename, content_type = handler[0](
+                resource, json.loads(job.params), path, progress)
+
+        with transaction.manager:
+            job = ResourceExportJob.filter_by(id=job_id).one()
+            fileobj = env.file_storage.fileobj(component='resource')
+            shutil.move(path, env.file_storage.filename(fileobj, makedirs=True))
+
+            job.fileobj = fileobj
+            job.filename = filename
+            job.content_type = content_type
+            job.status = 'done'
+            job.progress = 1
+            job.finished = datetime.utcnow()
+
+    except Exception as exc:
+        _logger.exception("Export job %d failed", job_id)
+        _update_job(
+            job_id, status='failed', message=str(exc),
+            finished=datetime.utcnow())
+        return False
+
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    return True
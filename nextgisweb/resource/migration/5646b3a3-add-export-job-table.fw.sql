@@ -0,0 +1,31 @@
+/*** {
+    "revision": "5646b3a3", "parents": ["00000000"],
+    "date": "2026-10-18T10:00:00",
+    "message": "Add export job table"
+} ***/
+
+CREATE TABLE resource_export_job
+(
+    id serial NOT NULL,
+    resource_id integer NOT NULL,
+    params character varying NOT NULL,
+    status character varying(7) NOT NULL,
+    progress double precision NOT NULL,
+    message character varying,
+    outdated boolean NOT NULL,
+    fileobj_id integer,
+    filename character varying,
+    content_type character varying,
+    created timestamp without time zone NOT NULL,
+    started timestamp without time zone,
+    finished timestamp without time zone,
+    CONSTRAINT resource_export_job_pkey PRIMARY KEY (id),
+    CONSTRAINT resource_export_job_status_check CHECK (
+        status IN ('pending', 'running', 'done', 'failed')),
+    CONSTRAINT resource_export_job_resource_id_fkey FOREIGN KEY (resource_id)
+        REFERENCES resource (id) ON DELETE CASCADE,
+    CONSTRAINT resource_export_job_fileobj_id_fkey FOREIGN KEY (fileobj_id)
+        REFERENCES fileobj (id)
+);
+
+CREATE INDEX ix_resource_export_job_resource_id ON resource_export_job (resource_id);
@@ -0,0 +1,3 @@
+/*** { "revision": "5646b3a3" } ***/
+
+DROP TABLE resource_export_job;
@@ -0,0 +1,7 @@
+/*** {
+    "revision": "56473e80", "parents": ["5646b3a3"],
+    "date": "2026-10-18T18:00:00",
+    "message": "Add export job heartbeat"
+} ***/
+
+ALTER TABLE resource_export_job ADD COLUMN heartbeat timestamp without time zone;
@@ -0,0 +1,3 @@
+/*** { "revision": "56473e80" } ***/
+
+ALTER TABLE resource_export_job DROP COLUMN heartbeat;
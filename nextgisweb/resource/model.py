@@ -27,7 +27,7 @@ __all__ = ['Resource', ]
 
 _logger = logging.getLogger(__name__)
 
-Base = declarative_base(dependencies=('auth', ))
+Base = declarative_base(dependencies=('auth', 'file_storage'))
 
 resource_registry = registry_maker()
 
@@ -1,6 +1,11 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
 from ..component import Component, require
 from ..lib.config import Option
+from .cache import UpstreamTileCache
 from .model import Base, Connection, Layer, SCHEME
+from .session_keeper import SessionKeeper
 
 __all__ = ['Connection', 'Layer']
 
@@ -16,6 +21,22 @@ class TMSClientComponent(Component):
             'User-Agent': self.options['user_agent']
         }
 
+        opt_session = self.options.with_prefix('session')
+        self.session_keeper = SessionKeeper(
+            maxsize=opt_session['cache_size'],
+            idle_timeout=opt_session['idle_timeout'].total_seconds(),
+            connection_limit=self.options['connection_limit'])
+
+        fetch_threads = self.options['fetch_threads']
+        self.fetch_pool = ThreadPoolExecutor(
+            max_workers=fetch_threads, thread_name_prefix='tmsclient'
+        ) if fetch_threads > 1 else None
+
+        opt_tcache = self.options.with_prefix('tile_cache')
+        self.tile_cache = UpstreamTileCache(
+            opt_tcache['size'], opt_tcache['ttl'].total_seconds()
+        ) if opt_tcache['enabled'] else None
+
     def client_settings(self, request):
         return dict(schemes=SCHEME.enum)
 
@@ -30,4 +51,18 @@ class TMSClientComponent(Component):
         Option('nextgis_geoservices.url_template', default='https://geoservices.nextgis.com/raster/{layer}/{z}/{x}/{y}.png'),  # NOQA: E501
         Option('user_agent', default="NextGIS Web"),
         Option('timeout', float, default=15),  # seconds
+        Option('fetch_threads', int, default=16,
+               doc="Number of threads fetching upstream tiles concurrently (1 to disable)."),
+        Option('connection_limit', int, default=8,
+               doc="Maximum number of concurrent requests to a single TMS connection."),
+        Option('session.cache_size', int, default=64,
+               doc="Maximum number of kept HTTP sessions of TMS connections."),
+        Option('session.idle_timeout', timedelta, default=timedelta(minutes=10),
+               doc="HTTP sessions not used for this time are closed."),
+        Option('tile_cache.enabled', bool, default=False,
+               doc="Keep upstream tiles in an in-process cache."),
+        Option('tile_cache.size', int, default=64 * 2**20,
+               doc="Size of upstream tile cache in bytes."),
+        Option('tile_cache.ttl', timedelta, default=timedelta(minutes=5),
+               doc="Time to keep upstream tiles in cache."),
     )
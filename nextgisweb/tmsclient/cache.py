@@ -0,0 +1,27 @@
+from threading import Lock
+
+from cachetools import TTLCache
+
+
+__all__ = ['UpstreamTileCache']
+
+
+class UpstreamTileCache(object):
+    """ Thread-safe in-process cache of upstream tiles limited by total size
+    in bytes. Tiles missing upstream are cached as empty values. """
+
+    def __init__(self, maxsize, ttl):
+        self._cache = TTLCache(maxsize, ttl, getsizeof=lambda value: max(len(value), 1))
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._cache.get(key)
+
+    def put(self, key, data):
+        with self._lock:
+            try:
+                self._cache[key] = data
+            except ValueError:
+                # Value is too large for the cache
+                pass
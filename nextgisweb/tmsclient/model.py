@@ -26,7 +26,6 @@ from ..resource import (
     SerializedResourceRelationship as SRR,
 )
 from .util import _, crop_box, render_zoom, quad_key
-from .session_keeper import get_session
 
 
 Base = declarative_base(dependencies=('resource', ))
@@ -73,36 +72,72 @@ class Connection(Base, Resource):
             params[self.apikey_param or 'apikey'] = self.apikey
         return params
 
-    def get_tile(self, tile, layer_name):
-        z, x, y = tile
-        if self.scheme == SCHEME.TMS:
-            y = toggle_tms_xyz_y(z, y)
-
-        session = get_session(self.id, urlparse(self.url_template).scheme,
-                              self.username, self.password)
-
-        result = session.get(
-            self.url_template.format(
+    def tile_fetcher(self, layer_name):
+        """ Get a function fetching a tile image by (z, x, y) tuple. It
+        doesn't access the connection object, so it can be called from
+        other threads. """
+
+        connection_id = self.id
+        url_template = self.url_template
+        scheme = self.scheme
+        username = self.username
+        params = self.query_params
+        verify = not self.insecure
+
+        session = env.tmsclient.session_keeper.get_session(
+            connection_id, urlparse(url_template).scheme,
+            username, self.password)
+        headers = env.tmsclient.headers
+        timeout = env.tmsclient.options['timeout']
+        cache = env.tmsclient.tile_cache
+
+        def fetch(tile):
+            z, x, y = tile
+            if scheme == SCHEME.TMS:
+                y = toggle_tms_xyz_y(z, y)
+
+            url = url_template.format(
                 x=x, y=y, z=z,
                 q=quad_key(x, y, z),
                 layer=layer_name
-            ),
-            params=self.query_params,
-            headers=env.tmsclient.headers,
-            timeout=env.tmsclient.options['timeout'],
-            verify=not self.insecure
-        )
+            )
 
-        if result.status_code == 200:
-            return PIL.Image.open(BytesIO(result.content))
-        elif result.status_code == 401:
-            raise HTTPUnauthorized()
-        elif result.status_code == 403:
-            raise HTTPForbidden()
-        elif result.status_code // 100 == 5:
-            raise OperationalError("Third-party service unavailable.")
-        else:
-            return None
+            data = None
+            if cache is not None:
+                key = (connection_id, username, url, tuple(sorted(params.items())))
+                data = cache.get(key)
+
+            if data is None:
+                result = session.get(
+                    url, params=params, headers=headers,
+                    timeout=timeout, verify=verify)
+
+                if result.status_code == 200:
+                    data = result.content
+                elif result.status_code == 401:
+                    raise HTTPUnauthorized()
+                elif result.status_code == 403:
+                    raise HTTPForbidden()
+                elif result.status_code // 100 == 5:
+                    raise OperationalError("Third-party service unavailable.")
+                else:
+                    data = b''
+
+                if cache is not None:
+                    cache.put(key, data)
+
+            if len(data) == 0:
+                return None
+
+            # Decode the image in the fetching thread rather than on paste
+            image = PIL.Image.open(BytesIO(data))
+            image.load()
+            return image
+
+        return fetch
+
+    def get_tile(self, tile, layer_name):
+        return self.tile_fetcher(layer_name)(tile)
 
 
 class _url_template_attr(SP):
@@ -255,8 +290,7 @@ class Layer(Base, Resource, SpatialLayerMixin):
         x_offset = max(xtile_min - xtile_from, 0)
         y_offset = max(ytile_min - ytile_from, 0)
 
-        image = None
-
+        tiles = []
         for x, xtile in enumerate(
             range(xtile_from + x_offset, min(xtile_to, xtile_max) + 1),
             start=x_offset
@@ -265,12 +299,25 @@ class Layer(Base, Resource, SpatialLayerMixin):
                 range(ytile_from + y_offset, min(ytile_to, ytile_max) + 1),
                 start=y_offset
             ):
-                tile_image = self.connection.get_tile((zoom, xtile, ytile), self.layer_name)
-                if tile_image is None:
-                    continue
-                if image is None:
-                    image = PIL.Image.new('RGBA', (width, height))
-                image.paste(tile_image, (x * self.tilesize, y * self.tilesize))
+                tiles.append(((zoom, xtile, ytile), (x * self.tilesize, y * self.tilesize)))
+
+        # Upstream tiles are fetched concurrently, the number of concurrent
+        # requests to the connection is limited by its session pool.
+        fetch = self.connection.tile_fetcher(self.layer_name)
+        fetch_pool = env.tmsclient.fetch_pool
+        if fetch_pool is not None and len(tiles) > 1:
+            tile_images = fetch_pool.map(fetch, [tile for tile, offset in tiles])
+        else:
+            tile_images = map(fetch, [tile for tile, offset in tiles])
+
+        image = None
+
+        for (tile, offset), tile_image in zip(tiles, tile_images):
+            if tile_image is None:
+                continue
+            if image is None:
+                image = PIL.Image.new('RGBA', (width, height))
+            image.paste(tile_image, offset)
 
         if image is None:
             return None
@@ -1,27 +1,69 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
 import requests
 
 
-_sessions = dict()  # TODO: clear session objects
+__all__ = ['SessionKeeper']
+
+
+class SessionKeeper(object):
+    """ LRU of HTTP sessions with a connection pool per TMS connection.
+    Sessions which aren't used longer than idle timeout are dropped. Evicted
+    sessions aren't closed explicitly as they can still be used by pending
+    fetches, their connections are closed on garbage collection. """
+
+    def __init__(self, maxsize, idle_timeout, connection_limit):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.connection_limit = connection_limit
+
+        self._sessions = OrderedDict()
+        self._lock = Lock()
+
+    def get_session(self, key, scheme, username, password):
+        now = monotonic()
+
+        with self._lock:
+            # Credentials are part of the key, so changes of the connection
+            # take effect without waiting for the session to expire.
+            skey = (key, scheme, username, password)
 
+            entry = self._sessions.pop(skey, None)
+            if entry is None:
+                session = self._new_session(scheme, username, password)
+            else:
+                session = entry[0]
+            self._sessions[skey] = (session, now)
 
-__all__ = ['get_session']
+            while len(self._sessions) > self.maxsize:
+                self._sessions.popitem(last=False)
 
+            for k, (s, last_used) in list(self._sessions.items()):
+                if now - last_used <= self.idle_timeout:
+                    break
+                del self._sessions[k]
 
-def get_session(key, scheme, username, password):
-    if key in _sessions:
-        return _sessions[key]
+        return session
 
-    session = requests.Session()
+    def clear(self):
+        with self._lock:
+            self._sessions.clear()
 
-    adapter = requests.adapters.HTTPAdapter(
-        pool_connections=500,
-        pool_maxsize=500
-    )
-    session.mount(scheme + '://', adapter)
+    def _new_session(self, scheme, username, password):
+        session = requests.Session()
 
-    if username is not None:
-        session.auth = (username, password)
+        # Blocking pool limits the number of concurrent requests to the
+        # same upstream host when tiles are fetched in parallel.
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=10,
+            pool_maxsize=self.connection_limit,
+            pool_block=True,
+        )
+        session.mount(scheme + '://', adapter)
 
-    _sessions[key] = session
+        if username is not None:
+            session.auth = (username, password)
 
-    return session
+        return session
@@ -0,0 +1,43 @@
+from time import sleep
+
+import requests
+
+from nextgisweb.tmsclient.session_keeper import SessionKeeper
+
+
+def test_session_lru(monkeypatch):
+    closed = []
+    monkeypatch.setattr(requests.Session, 'close', lambda s: closed.append(s))
+
+    keeper = SessionKeeper(maxsize=2, idle_timeout=60, connection_limit=4)
+
+    s1 = keeper.get_session(1, 'https', None, None)
+    assert keeper.get_session(1, 'https', None, None) is s1
+
+    s2 = keeper.get_session(2, 'https', None, None)
+    assert keeper.get_session(1, 'https', None, None) is s1
+
+    # Session 2 is the least recently used one
+    keeper.get_session(3, 'https', None, None)
+    assert keeper.get_session(2, 'https', None, None) is not s2
+
+    # Evicted session may still be in use by pending fetches
+    assert s2 not in closed
+
+    # Changed credentials give a new session
+    s1_auth = keeper.get_session(1, 'https', 'user', 'secret')
+    assert s1_auth is not s1
+    assert s1_auth.auth == ('user', 'secret')
+
+    keeper.clear()
+
+
+def test_session_idle():
+    keeper = SessionKeeper(maxsize=10, idle_timeout=0.1, connection_limit=4)
+
+    s1 = keeper.get_session(1, 'https', None, None)
+    sleep(0.2)
+    keeper.get_session(2, 'https', None, None)
+    assert keeper.get_session(1, 'https', None, None) is not s1
+
+    keeper.clear()
@@ -1,10 +1,14 @@
+import io
 import re
 import json
+import struct
 import uuid
 from datetime import datetime, time, date
 from functools import lru_cache
 from html import escape as html_escape
+from threading import Lock
 
+from cachetools import LRUCache
 from zope.interface import implementer
 from osgeo import ogr, osr
 from shapely.geometry import box
@@ -24,6 +28,7 @@ from .. import db
 from ..core.exception import ValidationError
 from ..resource import (
     Resource,
+    ResourceExportJob,
     DataScope,
     DataStructureScope,
     Serializer,
@@ -56,8 +61,13 @@ from ..feature_layer import (
     IFeatureQueryOrderBy,
     IFeatureQueryClipByBox,
     IFeatureQuerySimplify,
+    IFeatureQueryMVT,
+    IFeatureQueryKeyset,
+    IFeatureQueryStream,
     on_data_change,
     query_feature_or_not_found)
+from ..feature_layer.exception import FeatureNotFound
+from ..feature_layer.paging import decode_token, encode_token, explain_rows, keyset_where
 
 from .kind_of_data import VectorLayerData
 from .util import _, COMP_ID, fix_encoding, utf8len
@@ -105,6 +115,15 @@ _FIELD_TYPE_2_DB = dict(zip(FIELD_TYPE.enum, FIELD_TYPE_DB))
 
 SCHEMA = 'vector_layer'
 
+# Number of layers with table metadata cached per process
+TABLEINFO_CACHE_SIZE = 256
+
+# Number of rows in a single statement of bulk feature writes
+WRITE_BATCH_SIZE = 1000
+
+# Number of features written with a single COPY statement on import
+COPY_BATCH_SIZE = 10000
+
 Base = declarative_base(dependencies=('resource', 'feature_layer'))
 
 
@@ -112,6 +131,32 @@ def translate(trstring):
     return env.core.localizer().translate(trstring)
 
 
+_COPY_ESCAPE = str.maketrans({
+    '\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+def _copy_value(value):
+    """ Format a value for COPY statement in text format """
+    if value is None:
+        return '\\N'
+    elif isinstance(value, str):
+        return value.translate(_COPY_ESCAPE)
+    elif isinstance(value, (date, time)):
+        return value.isoformat()
+    return str(value)
+
+
+def _ewkb_hex(wkb, srid):
+    """ Convert little endian WKB to hex encoded EWKB with SRID """
+    gtype, = struct.unpack('<I', wkb[1:5])
+    return (wkb[0:1] + struct.pack('<II', gtype | 0x20000000, srid) + wkb[5:]).hex()
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
 class DRIVERS:
     ESRI_SHAPEFILE = 'ESRI Shapefile'
     GEOJSON = 'GeoJSON'
@@ -180,6 +225,10 @@ class FieldDef(object):
         self.ogrindex = ogrindex
 
 
+_tableinfo_cache = LRUCache(maxsize=TABLEINFO_CACHE_SIZE)
+_tableinfo_lock = Lock()
+
+
 class TableInfo(object):
 
     def __init__(self, srs_id):
@@ -397,6 +446,38 @@ class TableInfo(object):
 
         return self
 
+    @classmethod
+    def from_layer_cached(cls, layer):
+        """ Table info with metadata set up, shared between requests until
+        layer's table or fields change """
+
+        if layer.id is None:
+            self = cls.from_layer(layer)
+            self.setup_metadata(layer._tablename)
+            return self
+
+        revision = (
+            layer.tbl_uuid, layer.srs_id, layer.geometry_type,
+            tuple((f.fld_uuid, f.keyname, f.datatype) for f in layer.fields))
+
+        with _tableinfo_lock:
+            cached = _tableinfo_cache.get(layer.id)
+        if cached is not None and cached[0] == revision:
+            return cached[1]
+
+        self = cls.from_layer(layer)
+        self.setup_metadata(layer._tablename)
+
+        with _tableinfo_lock:
+            _tableinfo_cache[layer.id] = (revision, self)
+
+        return self
+
+    @classmethod
+    def invalidate(cls, layer_id):
+        with _tableinfo_lock:
+            _tableinfo_cache.pop(layer_id, None)
+
     def find_field(self, keyname=None, ogrindex=None):
         for f in self.fields:
             if keyname is not None and f.keyname == keyname:
@@ -469,6 +550,26 @@ class TableInfo(object):
         self.model = model
         self.fmap = {fld.keyname: fld.key for fld in self.fields}
 
+    def _copy_rows(self, rows):
+        """ Write rows of (id, geom, *fields) values with COPY statement """
+
+        buf = io.StringIO()
+        for row in rows:
+            buf.write('\t'.join(_copy_value(v) for v in row))
+            buf.write('\n')
+        buf.seek(0)
+
+        columns = ['id', 'geom'] + [f.key for f in self.fields]
+        stmt = 'COPY "%s"."%s" (%s) FROM STDIN' % (
+            self.table.schema, self.table.name,
+            ', '.join('"%s"' % c for c in columns))
+
+        cursor = DBSession.connection().connection.cursor()
+        try:
+            cursor.copy_expert(stmt, buf)
+        finally:
+            cursor.close()
+
     def load_from_ogr(self, ogrlayer, skip_other_geometry_types,
                       fix_errors, skip_errors):
         source_osr = ogrlayer.GetSpatialRef()
@@ -496,6 +597,7 @@ class TableInfo(object):
             fid_field_name = fld_defn.GetName()
 
         max_fid = None
+        batch = []
         for i, feature in enumerate(ogrlayer, start=1):
             if len(errors) >= error_limit and not skip_errors:
                 break
@@ -703,14 +805,23 @@ class TableInfo(object):
             if len(errors) > 0 and not skip_errors:
                 continue
 
-            geom_bytes = bytearray(geom.ExportToWkb(ogr.wkbNDR))
+            geom_bytes = geom.ExportToWkb(ogr.wkbNDR)
             dynamic_size += len(geom_bytes)
-            obj = self.model(id=fid, geom=ga.elements.WKBElement(
-                geom_bytes, srid=self.srs_id), **fld_values)
+
+            batch.append((fid, _ewkb_hex(geom_bytes, self.srs_id)) + tuple(
+                fld_values.get(f.key) for f in self.fields))
 
             num_features += 1
 
-            DBSession.add(obj)
+            # Nothing will be written if there are errors, but they are
+            # still collected to be reported.
+            if len(batch) >= COPY_BATCH_SIZE:
+                if len(errors) == 0 or skip_errors:
+                    self._copy_rows(batch)
+                batch = []
+
+        if len(batch) > 0 and (len(errors) == 0 or skip_errors):
+            self._copy_rows(batch)
 
         if len(errors) > 0 and not skip_errors:
             detail = '<br>'.join(html_escape(translate(error)) for error in errors)
@@ -751,6 +862,10 @@ class VectorLayer(Base, Resource, SpatialLayerMixin, LayerFieldsMixin):
 
     __field_class__ = VectorLayerField
 
+    # Data is changed only via feature API, so caches can rely on
+    # feature_layer.on_data_change events.
+    fires_data_change = True
+
     # events
     before_feature_create = SafetyEvent()  # args: resource, feature
     after_feature_create = SafetyEvent()   # args: resource, feature_id
@@ -786,6 +901,7 @@ class VectorLayer(Base, Resource, SpatialLayerMixin, LayerFieldsMixin):
         tableinfo.metadata.create_all(bind=DBSession.connection())
 
         self.tableinfo = tableinfo
+        TableInfo.invalidate(self.id)
 
     def setup_from_fields(self, fields):
         tableinfo = TableInfo.from_fields(
@@ -796,6 +912,7 @@ class VectorLayer(Base, Resource, SpatialLayerMixin, LayerFieldsMixin):
         tableinfo.metadata.create_all(bind=DBSession.connection())
 
         self.tableinfo = tableinfo
+        TableInfo.invalidate(self.id)
 
     def load_from_ogr(self, ogrlayer, skip_other_geometry_types=False,
                       fix_errors=ERROR_FIX.default, skip_errors=skip_errors_default):
@@ -835,6 +952,8 @@ class VectorLayer(Base, Resource, SpatialLayerMixin, LayerFieldsMixin):
         column = db.Column('fld_' + uid, _FIELD_TYPE_2_DB[datatype])
         op = migrate_operation()
         op.add_column(self._tablename, column, schema=SCHEMA)
+        TableInfo.invalidate(self.id)
+        ResourceExportJob.outdate(self.id)
 
         return VectorLayerField(datatype=datatype, fld_uuid=uid)
 
@@ -845,14 +964,58 @@ class VectorLayer(Base, Resource, SpatialLayerMixin, LayerFieldsMixin):
         op = migrate_operation()
         with op.batch_alter_table(self._tablename, schema=SCHEMA) as batch_op:
             batch_op.drop_column('fld_' + uid)
+        TableInfo.invalidate(self.id)
+        ResourceExportJob.outdate(self.id)
 
     # IWritableFeatureLayer
 
+    def _check_geometry_type(self, geom):
+        shape = geom.shape
+        geom_type = shape.geom_type.upper()
+        if shape.has_z:
+            geom_type += 'Z'
+        if geom_type != self.geometry_type:
+            raise ValidationError(
+                _("Geometry type (%s) does not match geometry column type (%s).")
+                % (geom_type, self.geometry_type)
+            )
+
+    def _features_bounds(self, table, feature_ids):
+        """ Bounds of existing features geometries, raise FeatureNotFound if
+        some of features don't exist """
+
+        conn = DBSession.connection()
+        geom = table.columns.geom
+
+        bounds = dict()
+        for chunk in _chunks(list(set(feature_ids)), WRITE_BATCH_SIZE):
+            rows = conn.execute(sql.select([
+                table.columns.id,
+                func.st_xmin(geom), func.st_ymin(geom),
+                func.st_xmax(geom), func.st_ymax(geom),
+            ]).where(table.columns.id.in_(chunk)))
+            for row in rows:
+                bounds[row[0]] = row[1:] if row[1] is not None else None
+
+        for fid in feature_ids:
+            if fid not in bounds:
+                raise FeatureNotFound(self.id, fid)
+
+        return [b for b in bounds.values() if b is not None]
+
+    def _fire_data_change(self, bounds):
+        """ Fire a single data change event covering all the bounds """
+        if len(bounds) == 0:
+            on_data_change.fire(self, None)
+        else:
+            on_data_change.fire(self, box(
+                min(b[0] for b in bounds), min(b[1] for b in bounds),
+                max(b[2] for b in bounds), max(b[3] for b in bounds)))
+
     def feature_put(self, feature):
         self.before_feature_update.fire(resource=self, feature=feature)
 
-        tableinfo = TableInfo.from_layer(self)
-        tableinfo.setup_metadata(self._tablename)
+        tableinfo = TableInfo.from_layer_cached(self)
 
         obj = tableinfo.model(id=feature.id)
         for f in tableinfo.fields:
@@ -883,8 +1046,7 @@ class VectorLayer(Base, Resource, SpatialLayerMixin, LayerFieldsMixin):
         """
         self.before_feature_create.fire(resource=self, feature=feature)
 
-        tableinfo = TableInfo.from_layer(self)
-        tableinfo.setup_metadata(self._tablename)
+        tableinfo = TableInfo.from_layer_cached(self)
 
         obj = tableinfo.model()
         for f in tableinfo.fields:
@@ -894,15 +1056,7 @@ class VectorLayer(Base, Resource, SpatialLayerMixin, LayerFieldsMixin):
         obj.geom = ga.elements.WKBElement(
             bytearray(feature.geom.wkb), srid=self.srs_id)
 
-        shape = feature.geom.shape
-        geom_type = shape.geom_type.upper()
-        if shape.has_z:
-            geom_type += 'Z'
-        if geom_type != self.geometry_type:
-            raise ValidationError(
-                _("Geometry type (%s) does not match geometry column type (%s).")
-                % (geom_type, self.geometry_type)
-            )
+        self._check_geometry_type(feature.geom)
 
         DBSession.add(obj)
         DBSession.flush()
@@ -922,8 +1076,7 @@ class VectorLayer(Base, Resource, SpatialLayerMixin, LayerFieldsMixin):
         """
         self.before_feature_delete.fire(resource=self, feature_id=feature_id)
 
-        tableinfo = TableInfo.from_layer(self)
-        tableinfo.setup_metadata(self._tablename)
+        tableinfo = TableInfo.from_layer_cached(self)
 
         query = self.feature_query()
         query.geom()
@@ -939,8 +1092,7 @@ class VectorLayer(Base, Resource, SpatialLayerMixin, LayerFieldsMixin):
         """Remove all records from a layer"""
         self.before_all_feature_delete.fire(resource=self)
 
-        tableinfo = TableInfo.from_layer(self)
-        tableinfo.setup_metadata(self._tablename)
+        tableinfo = TableInfo.from_layer_cached(self)
 
         DBSession.query(tableinfo.model).delete()
 
@@ -949,6 +1101,127 @@ class VectorLayer(Base, Resource, SpatialLayerMixin, LayerFieldsMixin):
         geom = box(self.srs.minx, self.srs.miny, self.srs.maxx, self.srs.maxy)
         on_data_change.fire(self, geom)
 
+    def feature_create_many(self, features):
+        """Insert features with multi-row INSERT statements
+
+        :param features: list of object descriptions
+        :type features:  list
+
+        :return:    list of inserted object IDs in the same order
+        """
+        if len(features) == 0:
+            return []
+
+        for feature in features:
+            self._check_geometry_type(feature.geom)
+            self.before_feature_create.fire(resource=self, feature=feature)
+
+        tableinfo = TableInfo.from_layer_cached(self)
+        table = tableinfo.table
+
+        DBSession.flush()
+        conn = DBSession.connection()
+
+        # Reserve IDs first, so they can be matched with features
+        ids = [row[0] for row in conn.execute(
+            sql.select([tableinfo.sequence.next_value()])
+            .select_from(func.generate_series(1, len(features))))]
+
+        rows = list()
+        for fid, feature in zip(ids, features):
+            row = dict(id=fid, geom=ga.elements.WKBElement(
+                bytearray(feature.geom.wkb), srid=self.srs_id))
+            for f in tableinfo.fields:
+                row[f.key] = feature.fields.get(f.keyname)
+            rows.append(row)
+
+        for chunk in _chunks(rows, WRITE_BATCH_SIZE):
+            conn.execute(table.insert().values(chunk))
+
+        for fid in ids:
+            self.after_feature_create.fire(resource=self, feature_id=fid)
+
+        self._fire_data_change([f.geom.bounds for f in features])
+
+        return ids
+
+    def feature_update_many(self, features):
+        """Update existing objects, features with the same set of fields are
+        updated with a single executemany statement
+
+        :param features: list of object descriptions
+        :type features:  list
+        """
+        if len(features) == 0:
+            return
+
+        tableinfo = TableInfo.from_layer_cached(self)
+        table = tableinfo.table
+
+        DBSession.flush()
+        bounds = self._features_bounds(table, [f.id for f in features])
+
+        groups = dict()
+        for feature in features:
+            self.before_feature_update.fire(resource=self, feature=feature)
+
+            params = dict(_id=feature.id)
+            for f in tableinfo.fields:
+                if f.keyname in feature.fields:
+                    params['_' + f.key] = feature.fields[f.keyname]
+
+            # Same as in feature_put, empty geometry isn't written
+            if feature.geom is not None:
+                params['_geom'] = ga.elements.WKBElement(
+                    bytearray(feature.geom.wkb), srid=self.srs_id)
+                bounds.append(feature.geom.bounds)
+
+            groups.setdefault(tuple(sorted(params.keys())), list()).append(params)
+
+        conn = DBSession.connection()
+        for keys, params in groups.items():
+            values = {
+                k[1:]: db.bindparam(k, type_=table.columns[k[1:]].type)
+                for k in keys if k != '_id'}
+            if len(values) == 0:
+                continue
+
+            conn.execute(table.update().where(
+                table.columns.id == db.bindparam('_id')
+            ).values(values), params)
+
+        for feature in features:
+            self.after_feature_update.fire(resource=self, feature=feature)
+
+        self._fire_data_change(bounds)
+
+    def feature_delete_many(self, feature_ids):
+        """Remove records with ids
+
+        :param feature_ids: record ids
+        :type feature_ids:  list
+        """
+        if len(feature_ids) == 0:
+            return
+
+        for feature_id in feature_ids:
+            self.before_feature_delete.fire(resource=self, feature_id=feature_id)
+
+        tableinfo = TableInfo.from_layer_cached(self)
+        table = tableinfo.table
+
+        DBSession.flush()
+        bounds = self._features_bounds(table, feature_ids)
+
+        conn = DBSession.connection()
+        for chunk in _chunks(list(set(feature_ids)), WRITE_BATCH_SIZE):
+            conn.execute(table.delete().where(table.columns.id.in_(chunk)))
+
+        for feature_id in feature_ids:
+            self.after_feature_delete.fire(resource=self, feature_id=feature_id)
+
+        self._fire_data_change(bounds)
+
     # IBboxLayer implementation:
     @property
     def extent(self):
@@ -963,8 +1236,7 @@ class VectorLayer(Base, Resource, SpatialLayerMixin, LayerFieldsMixin):
         st_ymax = func.st_ymax
         st_ymin = func.st_ymin
 
-        tableinfo = TableInfo.from_layer(self)
-        tableinfo.setup_metadata(self._tablename)
+        tableinfo = TableInfo.from_layer_cached(self)
 
         model = tableinfo.model
 
@@ -992,8 +1264,7 @@ class VectorLayer(Base, Resource, SpatialLayerMixin, LayerFieldsMixin):
 
 
 def estimate_vector_layer_data(resource):
-    tableinfo = TableInfo.from_layer(resource)
-    tableinfo.setup_metadata(resource._tablename)
+    tableinfo = TableInfo.from_layer_cached(resource)
     table = tableinfo.table
 
     static_size = FIELD_TYPE_SIZE[FIELD_TYPE.INTEGER]  # ID field size
@@ -1036,9 +1307,9 @@ event.listen(
 # Drop data table on vector layer deletion
 @event.listens_for(VectorLayer, 'before_delete')
 def drop_verctor_layer_table(mapper, connection, target):
-    tableinfo = TableInfo.from_layer(target)
-    tableinfo.setup_metadata(target._tablename)
+    tableinfo = TableInfo.from_layer_cached(target)
     tableinfo.metadata.drop_all(bind=connection)
+    TableInfo.invalidate(target.id)
 
 
 VE = ValidationError
@@ -1193,6 +1464,14 @@ def _clipbybox2d_exists():
     )
 
 
+@lru_cache()
+def _asmvt_feature_id_supported():
+    # Feature ID argument of ST_AsMVT is available since PostGIS 3.0
+    version = DBSession.connection() \
+        .execute("SELECT postgis_lib_version()").scalar()
+    return int(version.split('.')[0]) >= 3
+
+
 @implementer(
     IFeatureQuery,
     IFeatureQueryFilter,
@@ -1202,6 +1481,9 @@ def _clipbybox2d_exists():
     IFeatureQueryOrderBy,
     IFeatureQueryClipByBox,
     IFeatureQuerySimplify,
+    IFeatureQueryMVT,
+    IFeatureQueryKeyset,
+    IFeatureQueryStream,
 )
 class FeatureQueryBase(object):
 
@@ -1219,6 +1501,8 @@ class FeatureQueryBase(object):
         self._fields = None
         self._limit = None
         self._offset = None
+        self._after = None
+        self._stream = None
 
         self._filter = None
         self._filter_by = None
@@ -1257,6 +1541,12 @@ class FeatureQueryBase(object):
         self._limit = limit
         self._offset = offset
 
+    def after(self, token):
+        self._after = token
+
+    def stream(self):
+        self._stream = True
+
     def filter(self, *args):
         self._filter = args
 
@@ -1278,75 +1568,9 @@ class FeatureQueryBase(object):
     def intersects(self, geom):
         self._intersects = geom
 
-    def __call__(self):
-        tableinfo = TableInfo.from_layer(self.layer)
-        tableinfo.setup_metadata(self.layer._tablename)
-        table = tableinfo.table
-
-        columns = [table.columns.id, ]
+    def _where(self, tableinfo, table):
         where = []
 
-        srsid = self.layer.srs_id if self._srs is None else self._srs.id
-
-        geomcol = table.columns.geom
-        geomexpr = func.st_transform(geomcol, srsid)
-
-        if self._clip_by_box is not None:
-            if _clipbybox2d_exists():
-                clip = func.st_setsrid(
-                    func.st_makeenvelope(*self._clip_by_box.bounds),
-                    self._clip_by_box.srid)
-                geomexpr = func.st_clipbybox2d(geomexpr, clip)
-            else:
-                clip = func.st_setsrid(
-                    func.st_geomfromtext(self._clip_by_box.wkt),
-                    self._clip_by_box.srid)
-                geomexpr = func.st_intersection(geomexpr, clip)
-
-        if self._simplify is not None:
-            geomexpr = func.st_simplifypreservetopology(
-                geomexpr, self._simplify
-            )
-
-        if self._geom:
-
-            if self._single_part:
-
-                class geom(ColumnElement):
-                    def __init__(self, base):
-                        self.base = base
-
-                @compiles(geom)
-                def compile(expr, compiler, **kw):
-                    return "(%s).geom" % str(compiler.process(expr.base))
-
-                geomexpr = geom(func.st_dump(geomexpr))
-
-            if self._geom_format == 'WKB':
-                geomexpr = func.st_asbinary(geomexpr, 'NDR')
-            else:
-                geomexpr = func.st_astext(geomexpr)
-
-            columns.append(geomexpr.label('geom'))
-
-        if self._geom_len:
-            columns.append(func.st_length(func.geography(
-                func.st_transform(geomexpr, 4326))).label('geom_len'))
-
-        if self._box:
-            columns.extend((
-                func.st_xmin(geomexpr).label('box_left'),
-                func.st_ymin(geomexpr).label('box_bottom'),
-                func.st_xmax(geomexpr).label('box_right'),
-                func.st_ymax(geomexpr).label('box_top'),
-            ))
-
-        selected_fields = []
-        for f in tableinfo.fields:
-            if not self._fields or f.keyname in self._fields:
-                columns.append(table.columns[f.key].label(f.keyname))
-                selected_fields.append(f)
-
         if self._filter_by:
             for k, v in self._filter_by.items():
                 if k == 'id':
@@ -1430,16 +1654,139 @@ class FeatureQueryBase(object):
             intgeom = func.st_setsrid(func.st_geomfromtext(
                 self._intersects.wkt), self._intersects.srid)
             where.append(func.st_intersects(
-                geomcol, func.st_transform(
+                table.columns.geom, func.st_transform(
                     intgeom, self.layer.srs_id)))
 
-        order_criterion = []
+        return where
+
+    def mvt(self, name, bounds, extent, buffer):
+        if not _asmvt_feature_id_supported():
+            return None
+
+        tableinfo = TableInfo.from_layer_cached(self.layer)
+        table = tableinfo.table
+
+        srsid = self.layer.srs_id if self._srs is None else self._srs.id
+
+        geomexpr = func.st_transform(table.columns.geom, srsid)
+        if self._simplify is not None:
+            geomexpr = func.st_simplifypreservetopology(geomexpr, self._simplify)
+
+        # ST_AsMVTGeom clips geometries by the tile bounds with the buffer
+        geomexpr = func.st_asmvtgeom(
+            geomexpr, func.st_makeenvelope(*bounds, srsid),
+            extent, buffer, True)
+
+        columns = [
+            table.columns.id.label('__fid'),
+            geomexpr.label('__geom'),
+        ]
+        for f in tableinfo.fields:
+            if not self._fields or f.keyname in self._fields:
+                columns.append(table.columns[f.key].label(f.keyname))
+
+        features = sql.select(
+            columns,
+            whereclause=db.and_(*self._where(tableinfo, table)),
+            order_by=table.columns.id,
+        ).alias('features')
+
+        query = sql.select([func.st_asmvt(
+            db.literal_column(features.name), name, extent,
+            '__geom', '__fid')]).select_from(features)
+
+        result = DBSession.connection().execute(query).scalar()
+        return bytes(result) if result is not None else b''
+
+    def __call__(self):
+        tableinfo = TableInfo.from_layer_cached(self.layer)
+        table = tableinfo.table
+
+        columns = [table.columns.id, ]
+
+        srsid = self.layer.srs_id if self._srs is None else self._srs.id
+
+        geomcol = table.columns.geom
+        geomexpr = func.st_transform(geomcol, srsid)
+
+        if self._clip_by_box is not None:
+            if _clipbybox2d_exists():
+                clip = func.st_setsrid(
+                    func.st_makeenvelope(*self._clip_by_box.bounds),
+                    self._clip_by_box.srid)
+                geomexpr = func.st_clipbybox2d(geomexpr, clip)
+            else:
+                clip = func.st_setsrid(
+                    func.st_geomfromtext(self._clip_by_box.wkt),
+                    self._clip_by_box.srid)
+                geomexpr = func.st_intersection(geomexpr, clip)
+
+        if self._simplify is not None:
+            geomexpr = func.st_simplifypreservetopology(
+                geomexpr, self._simplify
+            )
+
+        if self._geom:
+
+            if self._single_part:
+
+                class geom(ColumnElement):
+                    def __init__(self, base):
+                        self.base = base
+
+                @compiles(geom)
+                def compile(expr, compiler, **kw):
+                    return "(%s).geom" % str(compiler.process(expr.base))
+
+                geomexpr = geom(func.st_dump(geomexpr))
+
+            if self._geom_format == 'WKB':
+                geomexpr = func.st_asbinary(geomexpr, 'NDR')
+            else:
+                geomexpr = func.st_astext(geomexpr)
+
+            columns.append(geomexpr.label('geom'))
+
+        if self._geom_len:
+            columns.append(func.st_length(func.geography(
+                func.st_transform(geomexpr, 4326))).label('geom_len'))
+
+        if self._box:
+            columns.extend((
+                func.st_xmin(geomexpr).label('box_left'),
+                func.st_ymin(geomexpr).label('box_bottom'),
+                func.st_xmax(geomexpr).label('box_right'),
+                func.st_ymax(geomexpr).label('box_top'),
+            ))
+
+        selected_fields = []
+        for f in tableinfo.fields:
+            if not self._fields or f.keyname in self._fields:
+                columns.append(table.columns[f.key].label(f.keyname))
+                selected_fields.append(f)
+
+        where = self._where(tableinfo, table)
+
+        order_columns = []
         if self._order_by:
             for order, colname in self._order_by:
                 field = tableinfo.find_field(keyname=colname)
-                order_criterion.append(dict(asc=db.asc, desc=db.desc)[order](
-                    table.columns[field.key]))
-        order_criterion.append(table.columns.id)
+                order_columns.append((table.columns[field.key], order))
+        order_columns.append((table.columns.id, 'asc'))
+
+        order_criterion = [
+            dict(asc=db.asc, desc=db.desc)[order](column)
+            for column, order in order_columns]
+
+        # Values of ordering columns are selected for continuation token
+        keys = ['__k%d' % idx for idx in range(len(order_columns))]
+        for key, (column, order) in zip(keys, order_columns):
+            columns.append(column.label(key))
+
+        page_where = list(where)
+        if self._after is not None:
+            page_where.append(keyset_where(
+                order_columns, decode_token(self._after, len(keys))))
 
         class QueryFeatureSet(FeatureSet):
             fields = selected_fields
@@ -1451,17 +1798,39 @@ class FeatureQueryBase(object):
             _box = self._box
             _limit = self._limit
             _offset = self._offset
+            _stream = self._stream
+
+            # Continuation token available after iteration over a limited
+            # set, it's None if there are no more features
+            next_token = None
 
             def __iter__(self):
                 query = sql.select(
                     columns,
-                    whereclause=db.and_(*where),
-                    limit=self._limit,
+                    whereclause=db.and_(*page_where),
+                    # One extra row tells if there is a next page
+                    limit=(self._limit + 1) if self._limit is not None
+                    else None,
                     offset=self._offset,
                     order_by=order_criterion,
                 )
-                rows = DBSession.connection().execute(query)
+                conn = DBSession.connection()
+                if self._stream:
+                    # Server-side cursor keeps memory usage flat on large
+                    # layers, but it costs extra round-trips on small ones
+                    conn = conn.execution_options(stream_results=True)
+                rows = conn.execute(query)
+
+                self.next_token = None
+                count = 0
+                last = None
                 for row in rows:
+                    count += 1
+                    if self._limit is not None and count > self._limit:
+                        self.next_token = encode_token([last[k] for k in keys])
+                        break
+                    last = row
+
                     fdict = dict((f.keyname, row[f.keyname])
                                  for f in selected_fields)
                     if self._geom:
@@ -1497,4 +1866,9 @@ class FeatureQueryBase(object):
                 for row in res:
                     return row[0]
 
+            @property
+            def total_count_estimate(self):
+                return explain_rows(DBSession.connection(), sql.select(
+                    [table.columns.id, ], whereclause=db.and_(*where)))
+
         return QueryFeatureSet()
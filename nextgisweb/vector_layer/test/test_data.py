@@ -1,3 +1,4 @@
+import json
 import os.path
 from datetime import date, time, datetime
 from pathlib import Path
@@ -13,7 +14,7 @@ from nextgisweb.auth import User
 from nextgisweb.spatial_ref_sys import SRS
 from nextgisweb.feature_layer import FIELD_TYPE
 from nextgisweb.vector_layer import VectorLayer
-from nextgisweb.vector_layer.model import error_limit, ERROR_FIX
+from nextgisweb.vector_layer.model import error_limit, ERROR_FIX, TableInfo
 
 
 DATA_PATH = os.path.join(os.path.dirname(
@@ -46,6 +47,31 @@ def test_from_fields(ngw_resource_group, ngw_txn):
     DBSession.flush()
 
 
+def test_tableinfo_cache(ngw_resource_group, ngw_txn):
+    res = VectorLayer(
+        parent_id=ngw_resource_group, display_name='tableinfo_cache',
+        owner_user=User.by_keyname('administrator'),
+        geometry_type='POINT',
+        srs=SRS.filter_by(id=3857).one(),
+        tbl_uuid=uuid4().hex,
+    )
+    res.setup_from_fields([dict(keyname='integer', datatype=FIELD_TYPE.INTEGER)])
+    res.persist()
+    DBSession.flush()
+
+    tableinfo = TableInfo.from_layer_cached(res)
+    assert TableInfo.from_layer_cached(res) is tableinfo
+
+    field = res.field_create(FIELD_TYPE.STRING)
+    field.keyname = field.display_name = 'string'
+    res.fields.append(field)
+    DBSession.flush()
+
+    tableinfo_new = TableInfo.from_layer_cached(res)
+    assert tableinfo_new is not tableinfo
+    assert [f.keyname for f in tableinfo_new.fields] == ['integer', 'string']
+
+
 @pytest.mark.parametrize('data', (
     'shapefile-point-utf8.zip/layer.shp',
     'shapefile-point-win1251.zip/layer.shp',
@@ -85,6 +111,42 @@ def test_from_ogr(data, ngw_resource_group, ngw_txn):
     assert fields['unicode'] == 'Значимость этих проблем настолько очевидна, что реализация намеченных плановых заданий требуют определения и уточнения.'  # NOQA: E501
 
 
+def test_copy_special_values(ngw_resource_group, ngw_txn):
+    value = 'tab\tnewline\nbackslash\\N'
+    geojson = {
+        'type': 'FeatureCollection',
+        'features': [{
+            'type': 'Feature',
+            'properties': {'string': value, 'empty': None},
+            'geometry': {'type': 'Point', 'coordinates': [1, 2, 3]},
+        }],
+    }
+
+    dataset = ogr.Open(json.dumps(geojson))
+    layer = dataset.GetLayer(0)
+
+    res = VectorLayer(
+        parent_id=ngw_resource_group, display_name='copy_special_values',
+        owner_user=User.by_keyname('administrator'),
+        srs=SRS.filter_by(id=4326).one(),
+        tbl_uuid=uuid4().hex)
+
+    res.persist()
+
+    res.setup_from_ogr(layer)
+    res.load_from_ogr(layer)
+
+    DBSession.flush()
+
+    query = res.feature_query()
+    query.geom()
+    feature, = query()
+
+    assert feature.fields['string'] == value
+    assert feature.fields['empty'] is None
+    assert feature.geom.shape.has_z
+
+
 def test_type_geojson(ngw_resource_group, ngw_txn):
     src = Path(__file__).parent / 'data' / 'type.geojson'
 
@@ -830,6 +830,37 @@ class WFSHandler():
             _summary = El('TransactionSummary', namespace=_ns_wfs, parent=_response)
             summary = dict(totalInserted=0, totalUpdated=0, totalDeleted=0)
 
+        # Consecutive inserts into the same layer are written at once
+        inserts = list()
+
+        def flush_inserts():
+            while len(inserts) > 0:
+                keyname, feature_layer = inserts[0][0:2]
+                count = 1
+                while count < len(inserts) and inserts[count][0] == keyname:
+                    count += 1
+
+                fids = feature_layer.feature_create_many([
+                    feature for _, _, feature in inserts[:count]])
+                del inserts[:count]
+
+                for fid in fids:
+                    fid_str = fid_encode(fid, keyname)
+
+                    _insert = El('InsertResult' if self.p_version == v100 else 'InsertResults',
+                                 namespace=_ns_wfs, parent=_response)
+                    if self.p_version >= v200:
+                        _feature = El('Feature', namespace=_ns_wfs, parent=_insert)
+                        El('ResourceId', dict(rid=fid_str), namespace=_ns_fes, parent=_feature)
+                    elif self.p_version == v110:
+                        _feature = El('Feature', namespace=_ns_wfs, parent=_insert)
+                        El('FeatureId', dict(fid=fid_str), namespace=_ns_ogc, parent=_feature)
+                    else:
+                        El('FeatureId', dict(fid=fid_str), namespace=_ns_ogc, parent=_insert)
+
+                if show_summary:
+                    summary['totalInserted'] += len(fids)
+
         for _operation in self.root_body:
             operation_tag = ns_trim(_operation.tag)
             if operation_tag == 'Insert':
@@ -854,23 +885,10 @@ class WFSHandler():
                     else:
                         feature.fields[fld_keyname] = _property.text
 
-                fid = feature_layer.feature_create(feature)
-                fid_str = fid_encode(fid, keyname)
-
-                _insert = El('InsertResult' if self.p_version == v100 else 'InsertResults',
-                             namespace=_ns_wfs, parent=_response)
-                if self.p_version >= v200:
-                    _feature = El('Feature', namespace=_ns_wfs, parent=_insert)
-                    El('ResourceId', dict(rid=fid_str), namespace=_ns_fes, parent=_feature)
-                elif self.p_version == v110:
-                    _feature = El('Feature', namespace=_ns_wfs, parent=_insert)
-                    El('FeatureId', dict(fid=fid_str), namespace=_ns_ogc, parent=_feature)
-                else:
-                    El('FeatureId', dict(fid=fid_str), namespace=_ns_ogc, parent=_insert)
-
-                if show_summary:
-                    summary['totalInserted'] += 1
+                inserts.append((keyname, feature_layer, feature))
             else:
+                flush_inserts()
+
                 keyname = ns_trim(_operation.get('typeName'))
                 layer = find_layer(keyname)
                 feature_layer = layer.resource
@@ -920,13 +938,14 @@ class WFSHandler():
                     if show_summary:
                         summary['totalUpdated'] += 1
                 elif operation_tag == 'Delete':
-                    for fid in fids:
-                        feature_layer.feature_delete(fid)
+                    feature_layer.feature_delete_many(fids)
                     if show_summary:
                         summary['totalDeleted'] += 1
                 else:
                     raise ValidationError("Unknown operation: %s" % operation_tag)
 
+        flush_inserts()
+
         if show_summary:
             for param, value in summary.items():
                 if value > 0: